@@ -2,21 +2,32 @@ __all__=[
     "autopyscf",
     "average_tools",
     "bundler",
+    "chainhook",
     "cifparser",
+    "coordinator",
     "crystal2pyscf",
     "crystal2qmc",
     "crystal",
     "crystalrunner",
+    "daemon",
     "dmc",
+    "ledger",
     "linear",
     "manager",
     "postprocess",
     "propertiesreader",
     "pyscf2qwalk",
+    "queuestats",
     "qwalkrunner",
+    "resultcache",
     "runner",
+    "runtimes",
+    "statecache",
     "paths",
+    "pilot",
+    "qmcpipeline",
     "submitter",
     "trialfunc",
     "variance",
+    "workflow",
   ]
@@ -5,6 +5,7 @@ from pymatgen.io.cif import CifParser
 import pyscf
 from pyscf.scf.uhf import UHF,mulliken_meta
 from copy import deepcopy
+from manager_tools import content_hash
 
 
 ####################################################
@@ -85,10 +86,22 @@ class PySCFWriter:
         return False
     return True
     
+  #-----------------------------------------------
+  def fingerprint(self):
+    ''' Hash of the options that go into the driver. The guess (dm_generator) is set while running, so it is excluded.'''
+    return content_hash(self,skip_keys=['completed','chkfile','dm_generator'])
+
+  #-----------------------------------------------
+  def guess_fingerprint(self):
+    ''' Hash of an initial guess set by the user (dm_generator), or None for the default (minao) guess.'''
+    if self.dm_generator in (None,dm_from_rhf_minao(),dm_from_uhf_minao()):
+      return None
+    return content_hash(self,skip_keys=[key for key in self.__dict__ if key!='dm_generator'])
+
   #-----------------------------------------------
   def pyscf_input(self,fname,chkfile):
     f=open(fname,'w')
-    restart_fname = 'restart_'+fname
+    restart_fname = os.path.join(os.path.dirname(fname),'restart_'+os.path.basename(fname))
     re_f = open(restart_fname, 'w')
     add_paths=[]
 
@@ -289,11 +302,23 @@ class PySCFPBCWriter:
           .format(diff['self'],diff['other']))
     return issame
 
+  #-----------------------------------------------
+  def fingerprint(self):
+    ''' Hash of the options that go into the driver. The guess (dm_generator) is set while running, so it is excluded.'''
+    return content_hash(self,skip_keys=['completed','chkfile','dm_generator'])
+
+  #-----------------------------------------------
+  def guess_fingerprint(self):
+    ''' Hash of an initial guess set by the user (dm_generator), or None for the default (minao) guess.'''
+    if self.dm_generator in (None,dm_from_rhf_minao(),dm_from_uhf_minao()):
+      return None
+    return content_hash(self,skip_keys=[key for key in self.__dict__ if key!='dm_generator'])
+
   #-----------------------------------------------
       
   def pyscf_input(self,fname,chkfile):
     f=open(fname,'w')
-    restart_fname = 'restart_'+fname
+    restart_fname = os.path.join(os.path.dirname(fname),'restart_'+os.path.basename(fname))
     re_f = open(restart_fname, 'w')
     add_paths=[]
 
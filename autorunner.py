@@ -5,9 +5,28 @@ import numpy as np
 import subprocess as sub
 import shutil
 import submitter
+import coordinator
+import bundler
+import pilot
+import runtimes
+import queuestats
 
 # TODO organize with inheritance.
 
+####################################################
+def depend_lines(depend):
+  ''' PBS lines making a job run only after the jobs depend (queue ids) have succeeded.'''
+  if len(depend)==0:
+    return []
+  return ["#PBS -W depend=afterok:%s"%':'.join(depend)]
+
+####################################################
+def priority_lines(priority):
+  ''' PBS lines setting the priority of a job (None for the queue's default).'''
+  if priority is None:
+    return []
+  return ["#PBS -p %d"%priority]
+
 ####################################################
 class RunnerLocal:
   ''' Object that can accumulate jobs to run and run them together locally.'''
@@ -52,15 +71,19 @@ class RunnerLocal:
       return False
 
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
+      outf.write('\n'.join(self.exelines))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,path=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name of the job (unused).
+      path (str): directory to run the commands in (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
 
@@ -69,7 +92,7 @@ class RunnerLocal:
     
     try:
       for line in self.exelines:
-        result = sub.check_output(line,shell=True)
+        result = sub.check_output(line,shell=True,cwd=path)
         print(self.__class__.__name__,": executed %s"%line)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error: {0}".format(err))
@@ -88,7 +111,11 @@ class RunnerPBS:
                     prefix=None,
                     postfix=None
                     ):
-    ''' Note: exelines are prefixed by appropriate mpirun commands.'''
+    ''' Note: exelines are prefixed by appropriate mpirun commands.
+    walltime='auto' requests a walltime predicted from the runtime history (see runtimes.py).
+    queue='auto' submits to the queue expected to finish the job first (see queuestats.py).
+    depend can be set to queue ids that the next submitted job only runs after, if they succeed (PBS afterok).
+    priority, if set, is passed to PBS as the priority of the jobs (-1024 to 1023, see Workflow).'''
 
     # Good prefix choices (Blue Waters).
     # These are needed for Crystal runs.
@@ -108,10 +135,35 @@ class RunnerPBS:
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
     self.queueid=[]
+    self.runtimefile=None # Runtime of the last job is written here (see runtimes.py).
+    self.features={} # Features of the calculation, for walltime='auto'.
+    self.depend=[] # Queue ids the next job must run after (afterok). Cleared by submit.
+    self.priority=None # Priority hint for PBS.
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_stati(self.queueid)
+    return self.status_from_snapshot(submitter.queue_snapshot())
+
+  #-------------------------------------
+  def status_from_snapshot(self,jobs):
+    ''' Status of this runner's jobs given a queue snapshot (None if unknown). Prunes finished jobs.
+    Jobs still in the backlog of the submission coordinator count as running, and so do backfill tasks
+    until they exit (see bundler.backfill_status).'''
+    backfill=[qid for qid in self.queueid if bundler.is_backfill(qid)]
+    before=[qid for qid in self.queueid if qid not in backfill]
+    backfill=[qid for qid in backfill if bundler.backfill_status(qid,jobs)=='running']
+    resolved=coordinator.resolve_queueid(before)
+    # Jobs the coordinator submitted just now can be missing from jobs, so they count as pending too.
+    pending=backfill+[qid for qid in resolved if coordinator.is_pending(qid) or qid not in before]
+    if jobs is None:
+      self.queueid=backfill+resolved
+      return 'running' if len(pending)>0 else 'unknown'
+    queued=[qid for qid in resolved if qid not in pending]
+    status=submitter.stati_from_snapshot(queued,jobs)
+    self.queueid=pending+submitter.prune_queueid(queued,jobs)
+    if len(pending)>0:
+      return 'running'
+    return status
 
   def add_command(self,cmdstr):
     ''' Accumulate commands that don't get an MPI command.
@@ -125,12 +177,13 @@ class RunnerPBS:
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+        Bundle launchers put host lists and core binding for mpirun into ${AG_MPI_OPTS} (empty otherwise).
     '''
 
     if self.np=='allprocs':
-      self.exelines.append("mpirun {exe}".format(exe=exestr))
+      self.exelines.append("mpirun ${{AG_MPI_OPTS}} {exe}".format(exe=exestr))
     else:
-      self.exelines.append("mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
+      self.exelines.append("mpirun ${{AG_MPI_OPTS}} -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
 
   #-------------------------------------
   def script(self,scriptfile):
@@ -140,18 +193,27 @@ class RunnerPBS:
     if len(self.exelines)==0:
       return False
 
+    start,end=runtimes.timing_lines(scriptfile+'.runtime')
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
+      outf.write('\n'.join(self.prefix + start + self.exelines + end + self.postfix))
+    self.runtimefile=scriptfile+'.runtime'
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,path=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name to appear in the queue.
+      path (str): directory to run the job in, where the qsub file is written (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
+    if path is None:
+      path=os.getcwd()
+    depend,self.depend=self.depend,[]
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -163,22 +225,30 @@ class RunnerPBS:
       ppnstr=':ppn=%d'%self.np
 
     jobout=jobname+'.qsub.out'
+    walltime=runtimes.walltime(self)
+    queue=queuestats.queue(self,walltime)
+    start,end=runtimes.timing_lines(jobname+'.runtime')
     # Submit all jobs.
     qsub=[
-        "#PBS -q %s"%self.queue,
+        "#PBS -q %s"%queue,
         "#PBS -l nodes=%i%s"%(self.nn,ppnstr),
-        "#PBS -l walltime=%s"%self.walltime,
+        "#PBS -l walltime=%s"%walltime,
         "#PBS -j oe ",
         "#PBS -N %s "%jobname,
         "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
-      ] + self.prefix + self.exelines + self.postfix
+      ] + depend_lines(depend) + priority_lines(self.priority) + [
+        "cd %s"%path,
+      ] + self.prefix + start + self.exelines + end + self.postfix
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(path,qsubfile),'w') as f:
       f.write('\n'.join(qsub))
     try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
+      if coordinator.active() is not None:
+        self.queueid.append(coordinator.active().submit(qsubfile,path,queue,self.nn,self.np,walltime,
+            priority=self.priority))
+      else:
+        self.queueid.append(submitter.qsub(qsubfile,path))
+      self.runtimefile=os.path.join(path,jobname+'.runtime')
       print(self.__class__.__name__,": Submitted as %s"%self.queueid)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
@@ -218,7 +288,7 @@ class FakeRunner:
     return False
 
   #-------------------------------------
-  def submit(self,jobname=None):
+  def submit(self,jobname=None,path=None):
     ''' Submit series of commands.'''
     return ''
 
@@ -251,25 +321,33 @@ class PySCFRunnerLocal:
       return False
 
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
+      outf.write('\n'.join(self.exelines))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,path=None):
     ''' Submit series of commands.
-    Note: jobname is not used because it doesn't submit anything.'''
-    sys.path=ppath+sys.path
+    Note: jobname is not used because it doesn't submit anything.
 
+    Args:
+      ppath (list): python path needed for the run.
+      path (str): directory to run the commands in (default: current directory).
+    '''
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
       return ''    
 
+    # Pass the python path to the commands instead of modifying this process.
+    env=dict(os.environ)
+    if ppath is not None:
+      env['PYTHONPATH']=':'.join([p for p in ppath+[env.get('PYTHONPATH','')] if p!=''])
+
     try:
       for line in self.exelines:
-        result = sub.check_output(line,shell=True)
+        result = sub.check_output(line,shell=True,cwd=path,env=env)
         print(self.__class__.__name__,": executed %s"%line)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error: {0}".format(err))
@@ -278,6 +356,106 @@ class PySCFRunnerLocal:
     self.exelines=[]
     return ''
 
+####################################################
+class RunnerLocalPool(RunnerLocal):
+  ''' Runs jobs locally without blocking: each submission is queued in the local pool of this process
+  (see submitter.LocalPool), which runs jobs concurrently while they fit in the machine's cores.
+  Jobs run detached and leave <jobname>.pid and <jobname>.exit files in their directory, so a restarted
+  driver still knows which jobs are running, finished, or failed.'''
+  def __init__(self,np='allprocs',nn=1):
+    ''' Note: exelines are prefixed by appropriate mpirun commands.
+    Args:
+      np (int): cores per node for each job, or 'allprocs' to use all the cores in the pool.
+      nn (int): number of nodes (jobs hold np*nn cores).
+    '''
+    RunnerLocal.__init__(self,np=np,nn=nn)
+    self.jobname='localjob'
+    self.queueid=[]
+
+  #-------------------------------------
+  def ncores(self):
+    ''' Cores each job holds in the pool.'''
+    if self.np=='allprocs':
+      return submitter.local_pool().ncores
+    return self.np*self.nn
+
+  #-------------------------------------
+  def check_status(self):
+    ''' 'running' if any job of this runner is waiting or running. Forgets the other jobs.
+    Running jobs hold their cores in the pool, also when an earlier driver started them.'''
+    pool=submitter.local_pool()
+    queueid=[]
+    for qid in self.queueid:
+      status=pool.status(qid)
+      if status=='running':
+        pool.adopt(qid,self.ncores())
+      if status in ('queued','running'):
+        queueid.append(qid)
+      elif status=='failed':
+        print(self.__class__.__name__,": %s failed (exit code in %s.exit)."%(qid,qid))
+    self.queueid=queueid
+    if len(self.queueid)>0:
+      return 'running'
+    return 'unknown'
+
+  #-------------------------------------
+  def submit(self,jobname=None,path=None):
+    ''' Queue accumulated commands as one job, run in order and stopping at the first failure. Returns immediately.
+    Args:
+      jobname (str): name of the job, which names its files.
+      path (str): directory to run the commands in (default: current directory).
+    Returns:
+      str: queue id of the job (its directory and name), or '' if there was nothing to run.
+    '''
+    return self._submit(jobname,path,env=None)
+
+  #-------------------------------------
+  def _submit(self,jobname,path,env):
+    if len(self.exelines)==0:
+      return ''
+    if jobname is None:
+      jobname=self.jobname
+    if path is None:
+      path=os.getcwd()
+    jobfile=os.path.join(os.path.abspath(path),jobname)
+    qid=submitter.local_pool().submit(jobfile,self.exelines,self.ncores(),env=env)
+    print(self.__class__.__name__,": queued %s in the local pool."%qid)
+    self.queueid.append(qid)
+
+    # Remove exelines so the runner is ready for the next go.
+    self.exelines=[]
+    return qid
+
+####################################################
+class PySCFRunnerLocalPool(RunnerLocalPool):
+  ''' Local pool runner for OMP python commands.'''
+  def __init__(self,np='allprocs'):
+    RunnerLocalPool.__init__(self,np=np,nn=1)
+
+  #-------------------------------------
+  def add_task(self,exestr):
+    ''' Accumulate executable commands.
+    Args: 
+      exestr (str): executible statement. Threads are set by OMP_NUM_THREADS.
+    '''
+    self.exelines.append(exestr)
+
+  #-------------------------------------
+  def submit(self,jobname=None,ppath=None,path=None):
+    ''' Queue accumulated commands as one job. Returns immediately.
+    Args:
+      jobname (str): name of the job, which names its files.
+      ppath (list): python path needed for the run.
+      path (str): directory to run the commands in (default: current directory).
+    Returns:
+      str: queue id of the job (its directory and name), or '' if there was nothing to run.
+    '''
+    env=dict(os.environ)
+    if ppath is not None:
+      env['PYTHONPATH']=':'.join([p for p in ppath+[env.get('PYTHONPATH','')] if p!=''])
+    env['OMP_NUM_THREADS']=str(self.ncores())
+    return self._submit(jobname,path,env=env)
+
 ####################################################
 class PySCFRunnerPBS(RunnerPBS):
   ''' Specialized Runner for dealing with OMP python commands.'''
@@ -303,6 +481,10 @@ class PySCFRunnerPBS(RunnerPBS):
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
     self.queueid=[]
+    self.runtimefile=None
+    self.features={}
+    self.depend=[]
+    self.priority=None
 
   #-------------------------------------
   def add_task(self,exestr):
@@ -321,11 +503,13 @@ class PySCFRunnerPBS(RunnerPBS):
       return False
 
     # Prepend mp specs.
-    actions=["export OMP_NUM_THREADS=%d"%(self.nn*self.np)]+actions
+    actions=["export OMP_NUM_THREADS=%d"%(self.nn*self.np)]+self.exelines
 
     # Dump script.
+    start,end=runtimes.timing_lines(scriptfile+'.runtime')
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + actions + self.postfix))
+      outf.write('\n'.join(self.prefix + start + actions + end + self.postfix))
+    self.runtimefile=scriptfile+'.runtime'
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
@@ -333,15 +517,18 @@ class PySCFRunnerPBS(RunnerPBS):
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,path=None):
     ''' Submit any accumulated tasks.
 
     Args:
       jobname (str): name to appear in the queue.
       ppath (list): python path needed for the run (default: current path).
+      path (str): directory to run the job in, where the qsub file is written (default: current directory).
     '''
       
     if ppath is None: ppath=sys.path
+    if path is None: path=os.getcwd()
+    depend,self.depend=self.depend,[]
 
     if len(self.exelines)==0: 
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -349,8 +536,11 @@ class PySCFRunnerPBS(RunnerPBS):
     if jobname is None: jobname=self.jobname
 
     jobout=jobname+".jobout"
+    walltime=runtimes.walltime(self)
+    queue=queuestats.queue(self,walltime)
+    start,end=runtimes.timing_lines(jobname+'.runtime')
     qsublines=[
-         "#PBS -q %s"%self.queue,
+         "#PBS -q %s"%queue,
        ]
     if self.np == 'allprocs' :
       qsublines+=[
@@ -361,21 +551,26 @@ class PySCFRunnerPBS(RunnerPBS):
            "#PBS -l nodes=%i:ppn=%i"%(self.nn,self.np),
          ]
     qsublines+=[
-         "#PBS -l walltime=%s"%self.walltime,
+         "#PBS -l walltime=%s"%walltime,
          "#PBS -j oe",
          "#PBS -N %s"%self.jobname,
          "#PBS -o %s"%jobout,
+       ] + depend_lines(depend) + priority_lines(self.priority) + [
          "cd ${PBS_O_WORKDIR}",
          "export OMP_NUM_THREADS=%d"%(self.nn*self.np),
          "export PYTHONPATH=%s"%(':'.join(ppath)),
          "cwd=`pwd`"
-       ] + self.prefix + self.exelines + self.postfix
+       ] + self.prefix + start + self.exelines + end + self.postfix
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(path,qsubfile),'w') as f:
       f.write('\n'.join(qsublines))
     try: 
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
+      if coordinator.active() is not None:
+        self.queueid.append(coordinator.active().submit(qsubfile,path,queue,self.nn,self.np,walltime,
+            priority=self.priority))
+      else:
+        self.queueid.append(submitter.qsub(qsubfile,path))
+      self.runtimefile=os.path.join(path,jobname+'.runtime')
       print(self.__class__.__name__,": Submitted as %s"%self.queueid)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
@@ -385,3 +580,99 @@ class PySCFRunnerPBS(RunnerPBS):
 
 # TODO Specialize a runner for running QWalk jobs in the same directory together. 
 # Should just have to specialize the run command.
+
+####################################################
+class RunnerPilot:
+  ''' Runner that hands its commands to the pilot task queue instead of the batch queue.'''
+  def __init__(self,dbfile='pilot.db',np=1,nn=1,mpi=True,prefix=None,postfix=None):
+    '''
+    Args:
+      dbfile (str): task queue database, shared with the workers (see `pilot.submit_pilots`).
+      np (int): cores for each task.
+      nn (int): nodes for each task. Only 1 is supported, since a task runs on the node of a pilot worker.
+      mpi (bool): prefix tasks with mpirun (False for OMP python commands, like PySCF).
+      prefix (list): commands run before the tasks.
+      postfix (list): commands run after the tasks.
+    '''
+    assert nn==1,"nn should be 1: pilot tasks run on one node (the node of a pilot worker)."
+    self.dbfile=os.path.abspath(dbfile)
+    self.np=np
+    self.nn=nn
+    self.mpi=mpi
+    self.jobname='pilottask'
+    if prefix is None: self.prefix=[]
+    else:              self.prefix=prefix
+    if postfix is None: self.postfix=[]
+    else:               self.postfix=postfix
+    self.exelines=[]
+    self.queueid=[]
+
+  #-------------------------------------
+  def check_status(self):
+    ''' 'running' if any task of this runner is queued or running in the pilots. Forgets the other tasks.'''
+    queue=pilot.TaskQueue(self.dbfile)
+    queueid=[]
+    for qid in self.queueid:
+      status=queue.status(int(qid[len(pilot.PILOT_PREFIX):]))
+      if status in ('queued','running'):
+        queueid.append(qid)
+      elif status=='failed':
+        print(self.__class__.__name__,": task %s failed."%qid)
+    self.queueid=queueid
+    if len(self.queueid)>0:
+      return 'running'
+    return 'unknown'
+
+  #-------------------------------------
+  def add_command(self,cmdstr):
+    ''' Accumulate commands that don't get an MPI command.'''
+    self.exelines.append(cmdstr)
+
+  #-------------------------------------
+  def add_task(self,exestr):
+    ''' Accumulate executable commands.
+    Args:
+      exestr (str): executible statement. Will be prepended with mpirun if mpi is set.
+    '''
+    if self.mpi:
+      self.exelines.append("mpirun -n {tnp} {exe}".format(tnp=self.np,exe=exestr))
+    else:
+      self.exelines.append("export OMP_NUM_THREADS={tnp}; {exe}".format(tnp=self.np,exe=exestr))
+
+  #-------------------------------------
+  def script(self,scriptfile):
+    ''' Dump accumulated commands into a script for another job to run.
+    Returns true if the runner had lines to actually execute.'''
+    if len(self.exelines)==0:
+      return False
+    with open(scriptfile,'w') as outf:
+      outf.write('\n'.join(self.prefix + self.exelines + self.postfix))
+    self.exelines=[]
+    return True
+
+  #-------------------------------------
+  def submit(self,jobname=None,path=None,ppath=None):
+    ''' Queue accumulated commands as one pilot task.
+    Args:
+      jobname (str): name of the task.
+      path (str): directory to run the task in (default: current directory).
+      ppath (list): python path needed for the task.
+    Returns:
+      str: queue id of the task ('pilot-<n>'), or '' if there was nothing to run.
+    '''
+    if len(self.exelines)==0:
+      return ''
+    if jobname is None: jobname=self.jobname
+    if path is None: path=os.getcwd()
+    commands=list(self.prefix)
+    if ppath is not None:
+      commands+=["export PYTHONPATH=%s"%':'.join(ppath+['${PYTHONPATH}'])]
+    commands+=self.exelines+self.postfix
+    taskid=pilot.TaskQueue(self.dbfile).add(os.path.abspath(path),jobname,commands,self.np)
+    qid=pilot.PILOT_PREFIX+str(taskid)
+    self.queueid.append(qid)
+    print(self.__class__.__name__,": queued as %s"%qid)
+
+    # Remove exelines so the runner is ready for the next go.
+    self.exelines=[]
+    return qid
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 ''' Simple utilities for interacting with autogen runs.'''
 
-import pickle as pkl
+import statecache
 import sys
 import argparse
 
 def get_info(pickle):
   print("Info about %s..."%pickle)
-  man=pkl.load(open(pickle,'rb'))
+  man=statecache.load(pickle)
 
   print("  Queue id: {}".format(man.runner.queueid))
   try:
@@ -15,12 +15,25 @@ def get_info(pickle):
   except AttributeError:
     pass
 
+def list_ledger(dbfile,status=None,mtype=None,path=None):
+  ''' List managers recorded in a ledger (see ledger.py), without opening any pickles.'''
+  from ledger import Ledger
+  for row in Ledger(dbfile).query(status=status,type=mtype,path=path):
+    print("{key}  {type}  {status}  queue id: {queueid}  restarts: {restarts}".format(**row))
+
 if __name__=='__main__':
 
   parser=argparse.ArgumentParser("Autogen untilities.")
-  parser.add_argument('manager',type=str,help='Pickle file to look at.')
+  parser.add_argument('manager',type=str,nargs='?',help='Pickle file to look at.')
+  parser.add_argument('--ledger',type=str,default=None,help='Ledger database to query instead of a pickle.')
+  parser.add_argument('--status',type=str,default=None,help='Only list managers with this ledger status (done, queued, pending).')
+  parser.add_argument('--type',type=str,default=None,help='Only list managers of this class (e.g. QWalkManager).')
+  parser.add_argument('--path',type=str,default=None,help='Only list managers in this directory.')
   # Can add more options as needed.
 
   args=parser.parse_args()
-  get_info(args.manager)
+  if args.ledger is not None:
+    list_ledger(args.ledger,args.status,args.type,args.path)
+  else:
+    get_info(args.manager)
   
@@ -1,23 +1,343 @@
-import numpy as np
+import os
+import sys
+import json
+import time
+import socket
+import argparse
 import subprocess as sub
+import submitter
+import runtimes
+import queuestats
 
+MPI_FLAVORS=('openmpi','mpich')
+
+#######################################################################
+def read_nodefile(nodefile=None):
+  ''' Hosts of the allocation and their cores, in order, from $PBS_NODEFILE (one line per core).
+  Outside of a job, the local host with all its cores.
+  Returns:
+    list: (host, ncores) pairs.
+  '''
+  if nodefile is None: nodefile=os.environ.get('PBS_NODEFILE')
+  if nodefile is None or not os.path.exists(nodefile):
+    return [(socket.gethostname(),os.cpu_count())]
+  hosts=[]
+  with open(nodefile,'r') as inpf:
+    for line in inpf:
+      host=line.strip()
+      if host=='':
+        continue
+      if len(hosts)>0 and hosts[-1][0]==host:
+        hosts[-1]=(host,hosts[-1][1]+1)
+      elif host in [h for h,n in hosts]:
+        idx=[h for h,n in hosts].index(host)
+        hosts[idx]=(host,hosts[idx][1]+1)
+      else:
+        hosts.append((host,1))
+  return hosts
+
+#######################################################################
+def place(task,free,ncores):
+  ''' Choose nodes and cores for a task among the free cores of an allocation.
+  Tasks of one node and fewer cores than the node share nodes with other tasks. Other tasks get whole nodes.
+  Args:
+    task (dict): needs 'nn' (nodes) and 'np' (cores per node or 'allprocs').
+    free (dict): free core indices of each host; the chosen cores are removed.
+    ncores (dict): number of cores of each host.
+  Returns:
+    list: (host, cores) pairs, or None if the task doesn't fit in the free cores now.
+  '''
+  nn,ppn=task['nn'],task['np']
+  shared=nn==1 and ppn!='allprocs'
+  if shared:
+    for host in free:
+      if ppn<ncores[host] and len(free[host])>=ppn:
+        cores=free[host][:ppn]
+        free[host]=free[host][ppn:]
+        return [(host,cores)]
+  hosts=[host for host in free if len(free[host])==ncores[host]][:nn]
+  if len(hosts)<nn:
+    return None
+  layout=[]
+  for host in hosts:
+    if ppn=='allprocs' or ppn>=ncores[host]:
+      cores=free[host]
+    else:
+      cores=free[host][:ppn]
+    free[host]=[c for c in free[host] if c not in cores]
+    layout.append((host,cores))
+  return layout
+
+#######################################################################
+def mpi_options(layout,hostfile,rankfile,mpi='openmpi'):
+  ''' Write the host list (and rank file) of a task, and return the mpirun options that use them.
+  Args:
+    layout (list): (host, cores) pairs from place.
+    hostfile (str): file name for the host list.
+    rankfile (str): file name for the rank file (Open MPI only).
+    mpi (str): 'openmpi' (hostfile and rankfile) or 'mpich' (Hydra hostfile and user binding).
+  Returns:
+    str: options for mpirun.
+  '''
+  assert mpi in MPI_FLAVORS,"mpi should be one of %s."%(MPI_FLAVORS,)
+  if mpi=='openmpi':
+    with open(hostfile,'w') as outf:
+      outf.write('\n'.join("%s slots=%d"%(host,len(cores)) for host,cores in layout)+'\n')
+    ranklines=[]
+    for host,cores in layout:
+      for core in cores:
+        ranklines.append("rank %d=%s slot=%d"%(len(ranklines),host,core))
+    with open(rankfile,'w') as outf:
+      outf.write('\n'.join(ranklines)+'\n')
+    return "--hostfile %s --rankfile %s"%(hostfile,rankfile)
+  else:
+    with open(hostfile,'w') as outf:
+      outf.write('\n'.join("%s:%d"%(host,len(cores)) for host,cores in layout)+'\n')
+    return "-f %s -bind-to user:%s"%(hostfile,','.join(str(c) for c in layout[0][1]))
+
+#######################################################################
+# Backfill tasks are small tasks that a bundle runs on cores its own tasks leave idle, if they can finish
+# before the bundle's walltime ends. Every bundle may run any of them, so a task is claimed with a
+# <script>.claim file before it starts, and its exit code goes into <script>.exit. Their managers follow them
+# with the queue id 'backfill-<bundle queue id>|<script>' (see backfill_status).
+BACKFILL_PREFIX='backfill-'
+BACKFILL_SAFETY=1.2 # Factor on the estimated runtime of backfill tasks, to be sure they finish in time.
+
+#----------------------------------------------------------------------
+def backfill_id(queueid,script):
+  return "%s%s|%s"%(BACKFILL_PREFIX,queueid,script)
+
+#----------------------------------------------------------------------
+def is_backfill(qid):
+  ''' Whether qid follows a backfill task.'''
+  return qid.startswith(BACKFILL_PREFIX)
+
+#----------------------------------------------------------------------
+def backfill_status(qid,jobs):
+  ''' Status of a backfill task given a queue snapshot (None if unknown): 'done' once it has exited,
+  'running' while its bundle is in the queue (it may still start), and 'done' after the bundle has left
+  without running it.'''
+  queueid,script=qid[len(BACKFILL_PREFIX):].split('|',1)
+  if os.path.exists(script+'.exit'):
+    return 'done'
+  if jobs is None:
+    return 'running'
+  if queueid in jobs and jobs[queueid]['state'] in submitter.ACTIVE_STATES:
+    return 'running'
+  return 'done'
+
+#----------------------------------------------------------------------
+def _claim(base):
+  ''' Claim a backfill task for this bundle. False if another bundle already has it.'''
+  try:
+    os.close(os.open(base+'.claim',os.O_CREAT|os.O_EXCL|os.O_WRONLY))
+    return True
+  except FileExistsError:
+    return False
+
+#----------------------------------------------------------------------
+def _write_exit(base,code):
+  tmpfn=base+'.exit.tmp'
+  with open(tmpfn,'w') as outf:
+    outf.write("%d\n"%code)
+  os.replace(tmpfn,base+'.exit')
+
+#######################################################################
+def launch(bundlefile,poll=2):
+  ''' Run the tasks of a bundle inside its allocation, each on its own nodes and cores.
+  Tasks start in order as soon as their cores are free, and get their mpirun options in $AG_MPI_OPTS
+  (see RunnerPBS.add_task). Once all of them have started, idle cores run backfill tasks that are predicted
+  to finish before the walltime ends. This is what the qsub files of the Bundler run.
+  Args:
+    bundlefile (str): JSON file written by Bundler, with the MPI flavor, the walltime in seconds, the tasks
+      (path, script, nn, np), and the backfill tasks (also with their estimated time).
+    poll (float): seconds between checks of the running tasks.
+  Returns:
+    int: number of tasks that failed or couldn't be placed.
+  '''
+  started=time.time()
+  with open(bundlefile,'r') as inpf:
+    bundle=json.load(inpf)
+  deadline=started+bundle.get('walltime',0)
+  hosts=read_nodefile()
+  ncores={host:n for host,n in hosts}
+  free={host:list(range(n)) for host,n in hosts}
+  waiting=list(bundle['tasks'])
+  backfill=list(bundle.get('backfill',[]))
+  running=[]
+  nfailed=0
+  for task in list(waiting):
+    if place(task,{host:list(range(n)) for host,n in hosts},ncores) is None:
+      print("launch : %s needs more than the allocation (%s); skipping it."%(task['path'],hosts))
+      waiting.remove(task)
+      nfailed+=1
+
+  def start(task,layout):
+    base=os.path.join(task['path'],task['script'])
+    if os.path.exists(base+'.exit'): os.remove(base+'.exit')
+    env=dict(os.environ)
+    env['AG_MPI_OPTS']=mpi_options(layout,base+'.hosts',base+'.rankfile',bundle['mpi'])
+    print("launch : %s on %s"%(base,', '.join("%s:%s"%(h,','.join(map(str,c))) for h,c in layout)))
+    proc=sub.Popen(['bash','./'+task['script']],cwd=task['path'],env=env)
+    running.append((proc,task,layout))
+
+  def release(layout):
+    for host,cores in layout:
+      free[host]=sorted(free[host]+cores)
+
+  while True:
+    for task in list(waiting):
+      layout=place(task,free,ncores)
+      if layout is None:
+        continue
+      start(task,layout)
+      waiting.remove(task)
+    if len(waiting)==0:
+      for task in list(backfill):
+        if time.time()+task['time']*BACKFILL_SAFETY>deadline:
+          backfill.remove(task) # Too long for the time left, which only gets shorter.
+          continue
+        layout=place(task,free,ncores)
+        if layout is None:
+          continue
+        backfill.remove(task)
+        if not _claim(os.path.join(task['path'],task['script'])):
+          release(layout)
+          continue
+        start(task,layout)
+    if len(waiting)+len(running)==0:
+      break
+    time.sleep(poll)
+    for proc,task,layout in list(running):
+      if proc.poll() is None:
+        continue
+      _write_exit(os.path.join(task['path'],task['script']),proc.returncode)
+      if proc.returncode!=0:
+        print("launch : %s failed with exit code %d."%(task['path'],proc.returncode))
+        nfailed+=1
+      release(layout)
+      running.remove((proc,task,layout))
+  return nfailed
+
+#######################################################################
+def pack(items,npb,ppn):
+  ''' Pack tasks into bundles on (nodes x time), first-fit-decreasing.
+  Tasks are taken longest first. Each bundle lasts as long as its first (longest) task; later tasks are placed
+  on the nodes (or the cores of a node, for small tasks) that free up earliest, after other tasks if needed,
+  in the first bundle where they still finish in time. So the tasks of a bundle finish close together,
+  and short tasks fill the node-hours left beside and after the long ones.
+  Args:
+    items (list): tasks as dicts with 'nn' (nodes), 'np' (cores per node or 'allprocs'), and 'time' (seconds),
+      Other keys are kept (Bundler orders the bundles by the 'priority' of their tasks).
+    npb (int): maximum nodes of a bundle (larger tasks get a bundle of their own size).
+    ppn (int): cores of a node.
+  Returns:
+    list: bundles as dicts with 'items' (in order of planned start), 'nodes' (nodes used), and 'time' (seconds).
+  '''
+  bundles=[]
+  order=sorted(range(len(items)),key=lambda i:(-items[i]['time'],-items[i]['nn']))
+  for i in order:
+    item=items[i]
+    for bundle in bundles:
+      start=_plan(bundle,item,ppn)
+      if start is not None:
+        break
+    else:
+      bundle={'lanes':[],'maxnodes':max(npb,item['nn']),'time':item['time'],'plan':[]}
+      bundles.append(bundle)
+      start=_plan(bundle,item,ppn)
+    bundle['plan'].append((start,i))
+  return [{'items':[items[i] for start,i in sorted(bundle['plan'])],
+           'nodes':len(bundle['lanes']),
+           'time':bundle['time']} for bundle in bundles]
+
+#----------------------------------------------------------------------
+def _plan(bundle,item,ppn):
+  ''' Reserve nodes or cores of a bundle for item, if it finishes within the bundle's time.
+  Lanes hold the time each core of each node becomes free. Nodes already in the bundle are used first
+  (earliest free first), so short tasks stack up in time before new nodes are added.
+  Returns the start time, or None if it doesn't fit.'''
+  lanes=bundle['lanes']
+  room=bundle['maxnodes']-len(lanes)
+  if item['nn']==1 and item['np']!='allprocs' and item['np']<ppn:
+    starts=[sorted(lane)[item['np']-1] for lane in lanes]
+    fits=[n for n in range(len(lanes)) if starts[n]+item['time']<=bundle['time']]
+    if len(fits)>0:
+      node=min(fits,key=lambda n:starts[n])
+      start=starts[node]
+    elif room>0 and item['time']<=bundle['time']:
+      lanes.append([0.0]*ppn)
+      node=len(lanes)-1
+      start=0.0
+    else:
+      return None
+    cores=sorted(range(ppn),key=lambda c:lanes[node][c])[:item['np']]
+    for core in cores:
+      lanes[node][core]=start+item['time']
+    return start
+  fits=sorted([n for n in range(len(lanes)) if max(lanes[n])+item['time']<=bundle['time']],
+      key=lambda n:max(lanes[n]))[:item['nn']]
+  if len(fits)+room<item['nn'] or item['time']>bundle['time']:
+    return None
+  nodes=fits
+  while len(nodes)<item['nn']:
+    lanes.append([0.0]*ppn)
+    nodes.append(len(lanes)-1)
+  start=max(max(lanes[n]) for n in nodes)
+  for n in nodes:
+    lanes[n][:]=[start+item['time']]*ppn
+  return start
+
+#######################################################################
 class Bundler:
   ''' Class for handling the bundling of several jobs of approximately the same 
-  length, but possibly in different locations. ''' 
+  length, but possibly in different locations. 
+
+  The bundle job runs `launch`, which divides the allocation between the managers' scripts according to
+  their runners' nn and np: small tasks share nodes, and every mpirun is given its own hosts and pinned cores
+  instead of all starting on the first node.
+
+  Managers are packed into bundles by their estimated runtimes (see `pack`), so that the jobs of a bundle finish
+  close together, and each bundle requests the walltime of its longest job.
+
+  Small tasks added with `add_backfill` get no bundle of their own: every bundle may run them on cores its
+  own jobs leave idle, if they are predicted to finish before the bundle's walltime ends.''' 
   def __init__(self,queue='normal',
                     walltime='48:00:00',
                     jobname='AGBundler',
                     npb=16,ppn=32,
+                    mpi='openmpi',
+                    estimator=None,
+                    margin=0.1,
+                    priority=None,
+                    path=None,
                     prefix=None,
                     postfix=None
                     ):
-    ''' npb is the number of nodes desired per bundle. '''
+    ''' npb is the number of nodes desired per bundle, and ppn the cores of a node.
+    mpi is the MPI flavor of the runs, for the host lists and core binding ('openmpi' or 'mpich').
+    walltime is the longest walltime a bundle may request.
+    estimator is a function giving the estimated runtime of a manager in seconds, or None if unknown, for example
+    runtimes.estimate (default, and for unknown runtimes: the walltime of the manager's runner).
+    margin is the fraction added to the estimated runtime of a bundle for its walltime request.
+    priority is a function giving the priority of a manager, for example Workflow.priority (its critical path).
+    Bundles with higher priority managers are submitted first, and get the highest PBS priority (#PBS -p)
+    of their managers' runners, if set.
+    path is the directory for the qsub and bundle files (default: current directory).'''
+    assert mpi in MPI_FLAVORS,"mpi should be one of %s."%(MPI_FLAVORS,)
     self.npb=npb
     self.ppn=ppn
+    self.mpi=mpi
+    self.estimator=estimator
+    self.margin=margin
+    self.priority=priority
     self.jobname=jobname
     self.jobs=[]
+    self.backfill=[]
     self.queue=queue
     self.walltime=walltime
+    if path is None: path=os.getcwd()
+    self.path=path
     if prefix is None: self.prefix=[]
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
@@ -27,52 +347,242 @@ class Bundler:
   def add_job(self,mgr):
     ''' mgr is a Manager. Add Managers that have a script ready 
     to run in their current directory.'''
-    if mgr._runready: self.jobs.append(mgr)
+    if getattr(mgr,'bundle_ready',False): self.jobs.append(mgr)
 
-  def _submit_bundle(self,mgrs,jobname=None,nn=None):
-    if nn is None:      nn=sum([mgr.runner.nn for mgr in mgrs])
-    if jobname is None: jobname=self.jobname
+  def add_backfill(self,mgr):
+    ''' Add a Manager with a short script ready (a conversion, postprocessing, a short optimization)
+    to run on spare cores of the bundles instead of in its own.'''
+    if getattr(mgr,'bundle_ready',False): self.backfill.append(mgr)
+
+  def estimate(self,mgr):
+    ''' Estimated runtime of a manager's script in seconds.'''
+    runtime=None
+    if self.estimator is not None:
+      runtime=self.estimator(mgr)
+    if runtime is None:
+      runtime=submitter.walltime_seconds(runtimes.walltime(mgr.runner))
+    return runtime
+
+  def _task(self,mgr):
+    return {'path':mgr.path,'script':mgr.scriptfile,'nn':mgr.runner.nn,'np':mgr.runner.np}
+
+  def nodes(self,mgrs):
+    ''' Number of nodes that run all mgrs at once, with small tasks sharing nodes.'''
+    free={}
+    ncores={}
+    for mgr in mgrs:
+      task=self._task(mgr)
+      while place(task,free,ncores) is None:
+        host='node%d'%len(free)
+        free[host]=list(range(self.ppn))
+        ncores[host]=self.ppn
+    return len(free)
+
+  def _submit_bundle(self,mgrs,jobname=None,nn=None,walltime=None,backfill=None):
+    if nn is None:       nn=self.nodes(mgrs)
+    if jobname is None:  jobname=self.jobname
+    if walltime is None: walltime=self.walltime
+    if backfill is None: backfill=[]
+
+    for mgr in mgrs:
+      # This might be better without an error-out.
+      assert mgr.bundle_ready, "One of the Managers is not prepped for run."
+    bundlefile=os.path.join(self.path,jobname+".bundle")
+    with open(bundlefile,'w') as f:
+      json.dump({
+          'mpi':self.mpi,
+          'walltime':submitter.walltime_seconds(walltime),
+          'tasks':[self._task(mgr) for mgr in mgrs],
+          'backfill':[dict(self._task(mgr),time=self.estimate(mgr)) for mgr in backfill]
+        },f,indent=1)
 
     qsublines=[
         "#PBS -q %s"%self.queue,
         "#PBS -l nodes=%i:ppn=%i:xe"%(nn,self.ppn),
-        "#PBS -l walltime=%s"%self.walltime,
+        "#PBS -l walltime=%s"%walltime,
         "#PBS -j oe ",
         "#PBS -A bahu",
         "#PBS -N %s "%jobname,
         "#PBS -o %s.out "%jobname,
-      ] + self.prefix
-    for mgr in mgrs:
-      # This might be better without an error-out.
-      assert mgr._runready, "One of the Managers is not prepped for run."
-      qsublines+=[
-          "cd %s"%mgr.location,
-          "bash %s &"%mgr.scriptfile
-        ]
-    qsublines+=["wait"]+self.postfix
+      ]
+    priorities=[mgr.runner.priority for mgr in mgrs if getattr(mgr.runner,'priority',None) is not None]
+    if len(priorities)>0:
+      qsublines+=["#PBS -p %d"%max(priorities)]
+    qsublines+=self.prefix + [
+        "%s %s launch %s"%(sys.executable,os.path.abspath(__file__),bundlefile)
+      ] + self.postfix
 
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(self.path,qsubfile),'w') as f:
       f.write('\n'.join(qsublines))
     try:
-      result=sub.check_output("qsub %s"%(qsubfile),shell=True)
-      queueid=result.decode().split()[0].split('.')[0]
-      print("Submitted as %s"%queueid)
-    except sub.CalledProcessError:
-      print("Error submitting job. Check queue settings.")
+      queueid=submitter.qsub(qsubfile,self.path)
+      print(self.__class__.__name__,": Submitted as %s"%queueid)
+    except sub.CalledProcessError as err:
+      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+      return None
 
+    self.queueid.append(queueid)
     for mgr in mgrs:
       mgr.update_queueid(queueid)
-
+    for mgr in backfill:
+      mgr.update_queueid(backfill_id(queueid,os.path.join(mgr.path,mgr.scriptfile)))
+    return queueid
 
   def submit(self,jobname=None):
     ''' Submit all the jobs in the Managers that were added.'''
     if jobname is None: jobname=self.jobname
+    if len(self.jobs)==0:
+      if len(self.backfill)>0:
+        print(self.__class__.__name__,": no bundles to backfill %d jobs into."%len(self.backfill))
+      return
+
+    # Stale claims and exit files would keep backfill tasks from running or look like they finished.
+    for mgr in self.backfill:
+      for suffix in ('.claim','.exit'):
+        if os.path.exists(os.path.join(mgr.path,mgr.scriptfile)+suffix):
+          os.remove(os.path.join(mgr.path,mgr.scriptfile)+suffix)
+
+    items=[{'mgr':mgr,'nn':mgr.runner.nn,'np':mgr.runner.np,'time':self.estimate(mgr)} for mgr in self.jobs]
+    if self.priority is not None:
+      for item in items:
+        item['priority']=self.priority(item['mgr'])
+    bundles=pack(items,self.npb,self.ppn)
+    # Highest priority bundles first (the sort is stable, so without priorities the order is kept).
+    bundles.sort(key=lambda bundle:-max(item.get('priority',0) for item in bundle['items']))
+    maxtime=submitter.walltime_seconds(self.walltime)
+    for bidx,bundle in enumerate(bundles):
+      walltime=submitter.format_walltime(min(bundle['time']*(1+self.margin),maxtime))
+      print(self.__class__.__name__,": bundle %d: %d jobs on %d nodes for %s."%\
+          (bidx,len(bundle['items']),bundle['nodes'],walltime))
+      self._submit_bundle([item['mgr'] for item in bundle['items']],"%s_%d"%(jobname,bidx),
+          nn=bundle['nodes'],walltime=walltime,backfill=self.backfill)
+    self.jobs=[]
+    self.backfill=[]
+
+#######################################################################
+class ArrayBundler:
+  ''' Submit sibling managers (for example one per k-point) as a single PBS job array.
+
+  Managers should be created with bundle=True, so that nextstep writes their commands into a script
+  instead of submitting. Managers with the same resource request (queue, walltime, nodes, processors) are
+  grouped into one array job, whose element i runs the script of the i-th manager in its directory.
+  Each manager is given the queue id of its own element (for example '1234[5]'), so it follows the
+  status of its element only.
+  '''
+  def __init__(self,jobname='AGArray',flavor='torque',path=None,prefix=None,postfix=None):
+    '''
+    Args:
+      jobname (str): name of the array jobs; groups are numbered after it.
+      flavor (str): 'torque' (#PBS -t, $PBS_ARRAYID) or 'pbspro' (#PBS -J, $PBS_ARRAY_INDEX).
+      path (str): directory for the qsub and array map files (default: current directory).
+      prefix (list): commands run by every element before its script.
+      postfix (list): commands run by every element after its script.
+    '''
+    assert flavor in ('torque','pbspro'),"flavor should be 'torque' or 'pbspro'."
+    self.jobname=jobname
+    self.flavor=flavor
+    if path is None: path=os.getcwd()
+    self.path=path
+    if prefix is None: self.prefix=[]
+    else:              self.prefix=prefix
+    if postfix is None: self.postfix=[]
+    else:               self.postfix=postfix
+    self.jobs=[]
+    self.queueid=[]
+
+  #------------------------------------------------
+  def add_job(self,mgr):
+    ''' Add a manager if it has a script ready to run.'''
+    if getattr(mgr,'bundle_ready',False):
+      self.jobs.append(mgr)
+
+  #------------------------------------------------
+  @staticmethod
+  def resources(mgr):
+    ''' Resource request of a manager's runner. Only managers with the same request share an array.'''
+    runner=mgr.runner
+    return (runner.queue,runner.walltime,runner.nn,runner.np)
 
-    assign=np.cumsum([mgr.runner.nn for mgr in self.jobs])
-    assign=((assign-0.1)//self.npb).astype(int)
+  #------------------------------------------------
+  def groups(self):
+    ''' Added managers, grouped by resource request (in order of addition).'''
+    groups={}
+    for mgr in self.jobs:
+      groups.setdefault(self.resources(mgr),[]).append(mgr)
+    return list(groups.values())
 
-    print(assign)
+  #------------------------------------------------
+  def _submit_array(self,mgrs,jobname):
+    queue,walltime,nn,ppn=self.resources(mgrs[0])
+    walltime=runtimes.walltime(mgrs[0].runner)
+    queue=queuestats.queue(mgrs[0].runner,walltime)
+    if ppn=='allprocs':
+      ppnstr=',flags=allprocs'
+    else:
+      ppnstr=':ppn=%d'%ppn
+    if len(mgrs)==1:
+      # Not an array: PBS Pro refuses arrays with one element.
+      arrayline=[]
+      index='0'
+    elif self.flavor=='torque':
+      arrayline=["#PBS -t 0-%d"%(len(mgrs)-1)]
+      index='${PBS_ARRAYID}'
+    else:
+      arrayline=["#PBS -J 0-%d"%(len(mgrs)-1)]
+      index='${PBS_ARRAY_INDEX}'
+
+    qsublines=[
+        "#PBS -q %s"%queue,
+        "#PBS -l nodes=%i%s"%(nn,ppnstr),
+        "#PBS -l walltime=%s"%walltime,
+      ] + arrayline + [
+        "#PBS -j oe ",
+        "#PBS -N %s "%jobname,
+      ] + self.prefix
+    qsublines+=["case %s in"%index]
+    for idx,mgr in enumerate(mgrs):
+      qsublines+=["  %d) cd %s && bash %s ;;"%(idx,mgr.path,mgr.scriptfile)]
+    qsublines+=["esac"]+self.postfix
+
+    qsubfile=jobname+".qsub"
+    with open(os.path.join(self.path,qsubfile),'w') as f:
+      f.write('\n'.join(qsublines))
+    with open(os.path.join(self.path,jobname+".arraymap"),'w') as f:
+      json.dump({idx:mgr.path+mgr.name for idx,mgr in enumerate(mgrs)},f,indent=1)
+
+    try:
+      queueid=submitter.qsub(qsubfile,self.path)
+      print(self.__class__.__name__,": Submitted %d elements as %s"%(len(mgrs),queueid))
+    except sub.CalledProcessError as err:
+      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+      return None
+
+    self.queueid.append(queueid)
+    if len(mgrs)==1:
+      mgrs[0].update_queueid(queueid)
+    else:
+      for idx,mgr in enumerate(mgrs):
+        mgr.update_queueid("%s[%d]"%(queueid,idx))
+    return queueid
+
+  #------------------------------------------------
+  def submit(self,jobname=None):
+    ''' Submit one array job per group of added managers.
+    Returns:
+      list: queue ids of the arrays (None for failed submissions).'''
+    if jobname is None: jobname=self.jobname
+    queueids=[]
+    for gidx,mgrs in enumerate(self.groups()):
+      queueids.append(self._submit_array(mgrs,"%s_%d"%(jobname,gidx)))
+    self.jobs=[]
+    return queueids
 
-    for bidx in range(assign[-1]+1):
-      self._submit_bundle(np.array(self.jobs)[assign==bidx],"%s_%d"%(jobname,bidx))
+#######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Run the tasks of a bundle in its allocation.")
+  parser.add_argument('command',choices=['launch'],help='What to do.')
+  parser.add_argument('bundlefile',type=str,help='Bundle file written by the Bundler.')
+  parser.add_argument('--poll',type=float,default=2,help='Seconds between checks of running tasks.')
+  args=parser.parse_args()
+  sys.exit(launch(args.bundlefile,poll=args.poll)>0)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+''' Post-stage hooks, run at the end of a job so that jobs chained after it (see QWalkManager's chain option)
+find their input files ready when the scheduler starts them, and so that the stages of a QMC pipeline
+(see qmcpipeline.py) can follow each other in one job.'''
+import os
+import sys
+import json
+import argparse
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from manager_tools import separate_jastrow
+from variance import VarianceReader
+from linear import LinearReader
+
+READERS={'VarianceReader':VarianceReader,'LinearReader':LinearReader}
+
+#######################################################################
+def jastrow(wfout,jastout):
+  ''' Extract the Jastrow factor of the optimized wave function wfout into jastout (as export_qwalk does).'''
+  newjast=separate_jastrow(wfout)
+  tmpfn=jastout+'.tmp'
+  with open(tmpfn,'w') as outf:
+    outf.write(newjast)
+  os.replace(tmpfn,jastout)
+
+#######################################################################
+def check(planfile,stage):
+  ''' Check that an optimization stage of a QMC pipeline converged, and extract its Jastrow factor for the next stage.
+  Args:
+    planfile (str): JSON plan written by QMCPipelineManager, with the reader of each stage (class name and
+      attributes), and its output, wave function and Jastrow files.
+    stage (str): name of the stage.
+  Returns:
+    bool: whether the stage converged.
+  '''
+  with open(planfile,'r') as inpf:
+    plan=json.load(inpf)[stage]
+  reader=READERS[plan['reader']]()
+  reader.__dict__.update(plan['params'])
+  status=reader.collect(plan['outfile'])
+  print("check : %s status= %s"%(stage,status))
+  if status!='ok':
+    return False
+  jastrow(plan['wfout'],plan['jastout'])
+  return True
+
+#######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Post-stage hooks for chained jobs.")
+  subparsers=parser.add_subparsers(dest='command')
+  jparser=subparsers.add_parser('jastrow',help='Extract the Jastrow factor of an optimized wave function.')
+  jparser.add_argument('wfout',type=str,help='Wave function file written by QWalk.')
+  jparser.add_argument('jastout',type=str,help='File for the Jastrow section.')
+  cparser=subparsers.add_parser('check',help='Check an optimization stage of a QMC pipeline, and extract its Jastrow factor.')
+  cparser.add_argument('plan',type=str,help='Plan of the pipeline (JSON).')
+  cparser.add_argument('stage',type=str,help='Name of the stage.')
+
+  args=parser.parse_args()
+  if args.command=='jastrow':
+    jastrow(args.wfout,args.jastout)
+  elif args.command=='check':
+    if not check(args.plan,args.stage):
+      sys.exit(1)
+  else:
+    parser.print_help()
+    sys.exit(1)
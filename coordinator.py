@@ -0,0 +1,305 @@
+''' Optional submission coordinator, for sites that limit the number of jobs a user has in the queue.
+
+When a coordinator is active (see `use`), PBS runners hand their qsub files to it instead of calling qsub.
+It submits them while the user has fewer jobs in the queue than the queue's limit, and otherwise keeps them
+in a backlog, saved in a JSON file so that a restarted driver picks it up. Failed submissions also stay in the
+backlog, behind the jobs of their queue that haven't failed, so that they don't hold those up. After MAX_FAILURES
+failed tries, a job is dropped from the backlog, and its manager sees it as not submitted.
+The backlog is drained as jobs leave the queue.
+
+A job held in the backlog gets a placeholder queue id, 'pending-<token>', which the runner resolves into
+the real queue id once the job is submitted. If merging is allowed, small backlogged jobs with the same
+queue, processors per node, and walltime are submitted together as one job, run by the Bundler's launcher.
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import getpass
+import fcntl
+import shlex
+import threading
+import subprocess as sub
+from contextlib import contextmanager
+import submitter
+import bundler
+
+PENDING_PREFIX='pending-'
+KEEP_SUBMITTED=7*24*3600 # Seconds resolved placeholders are remembered.
+MAX_FAILURES=3 # Failed qsub calls before a job is dropped from the backlog.
+
+#######################################################################
+def is_pending(qid):
+  ''' Whether qid is a placeholder for a job in the backlog.'''
+  return qid.startswith(PENDING_PREFIX)
+
+#######################################################################
+class SubmissionCoordinator:
+  ''' Backlog of qsub files, submitted within per-queue limits.'''
+  def __init__(self,limits=None,default_limit=None,merge=0,statefile='coordinator.json',user=None,
+      drain_interval=None,mpi='openmpi'):
+    '''
+    Args:
+      limits (dict): maximum number of jobs (queued or running) the user may have in each queue.
+      default_limit (int): limit for queues not in limits (None means no limit).
+      merge (int): if nonzero, backlogged jobs of at most this many nodes are merged into jobs of up to this many nodes.
+      statefile (str): JSON file keeping the backlog between drivers.
+      user (str): user whose jobs count against the limits (default: current user).
+      drain_interval (float): minimum seconds between automatic drains (default: submitter.QSTAT_TTL).
+      mpi (str): MPI flavor of the runs, for the host lists and core binding of merged jobs ('openmpi' or 'mpich').
+    '''
+    assert mpi in bundler.MPI_FLAVORS,"mpi should be one of %s."%(bundler.MPI_FLAVORS,)
+    if limits is None: limits={}
+    self.limits=limits
+    self.default_limit=default_limit
+    self.merge=merge
+    self.statefile=os.path.abspath(statefile)
+    if user is None: user=getpass.getuser()
+    self.user=user
+    if drain_interval is None: drain_interval=submitter.QSTAT_TTL
+    self.drain_interval=drain_interval
+    self.mpi=mpi
+    self._lastdrain=None
+    self._used=None # Jobs of the user in each queue: last snapshot, plus submissions since.
+    self._usedtime=None
+    self._lock=threading.RLock()
+
+  #------------------------------------------------
+  @contextmanager
+  def _state(self):
+    ''' Read-modify-write the state file, locked against other threads and processes.'''
+    with self._lock:
+      with open(self.statefile+'.lock','w') as lockf:
+        fcntl.flock(lockf,fcntl.LOCK_EX)
+        try:
+          with open(self.statefile,'r') as inpf:
+            state=json.load(inpf)
+        except (OSError,ValueError):
+          state={'backlog':[],'submitted':{}}
+        yield state
+        now=time.time()
+        state['submitted']={token:entry for token,entry in state['submitted'].items()
+            if now-entry['time']<KEEP_SUBMITTED}
+        tmpfn=self.statefile+'.tmp'
+        with open(tmpfn,'w') as outf:
+          json.dump(state,outf,indent=1)
+        os.replace(tmpfn,self.statefile)
+
+  #------------------------------------------------
+  def limit(self,queue):
+    return self.limits.get(queue,self.default_limit)
+
+  #------------------------------------------------
+  def submit(self,qsubfile,path,queue,nn=1,np=1,walltime='',priority=None):
+    ''' Submit a qsub file now if the queue has room, otherwise keep it in the backlog.
+    Args:
+      qsubfile (str): name of the qsub file in path.
+      path (str): directory of the job.
+      queue (str): queue the job is for.
+      nn (int): nodes of the job.
+      np (int or str): processors per node of the job.
+      walltime (str): walltime of the job.
+      priority (int): priority of the job. Backlogged jobs of a queue are submitted highest priority first.
+    Returns:
+      str: queue id of the job, or a 'pending-' placeholder if it is in the backlog.
+    '''
+    token=PENDING_PREFIX+uuid.uuid4().hex[:12]
+    with open(os.path.join(path,qsubfile),'r') as inpf:
+      depend=any(line.startswith('#PBS -W depend=') for line in inpf)
+    entry={'token':token,'qsubfile':qsubfile,'path':path,'queue':queue,'nn':nn,'np':np,
+        'walltime':walltime,'priority':priority,'depend':depend,'time':time.time(),'failures':0}
+    with self._state() as state:
+      state['backlog'].append(entry)
+    self.drain(force=True)
+    return self.resolve(token)
+
+  #------------------------------------------------
+  def resolve(self,qid):
+    ''' Queue id for qid: the real id of a submitted placeholder, qid itself if it is still in the backlog
+    or not a placeholder, or None if the placeholder is unknown.'''
+    if not is_pending(qid):
+      return qid
+    self.drain()
+    with self._state() as state:
+      if qid in state['submitted']:
+        return state['submitted'][qid]['queueid']
+      if qid in [entry['token'] for entry in state['backlog']]:
+        return qid
+    return None
+
+  #------------------------------------------------
+  def _usage(self):
+    ''' Number of jobs of the user in each queue (array elements count separately), or None if unknown.
+    The queue is only looked at every drain_interval seconds; jobs submitted in between are counted here.'''
+    if self._used is None or time.time()-self._usedtime>=self.drain_interval:
+      jobs=submitter.queue_snapshot()
+      if jobs is None:
+        return None
+      used={}
+      for qid,job in jobs.items():
+        if job.get('user')==self.user and job['state'] in submitter.ACTIVE_STATES and not qid.endswith('[]'):
+          used[job['queue']]=used.get(job['queue'],0)+1
+      self._used=used
+      self._usedtime=time.time()
+    return self._used
+
+  #------------------------------------------------
+  def _groups(self,entries):
+    ''' Split backlogged entries of one queue into submissions (lists of entries), merging small ones if allowed.
+    Jobs that wait for other jobs (PBS depend) are not merged, so they keep waiting.'''
+    groups=[]
+    for entry in entries:
+      if self.merge and entry['nn']<self.merge and not entry.get('depend',False):
+        for group in groups:
+          first=group[0]
+          if first['nn']<self.merge and not first.get('depend',False) and first['np']==entry['np'] and first['walltime']==entry['walltime']\
+              and sum(e['nn'] for e in group)+entry['nn']<=self.merge:
+            group.append(entry)
+            break
+        else:
+          groups.append([entry])
+      else:
+        groups.append([entry])
+    return groups
+
+  #------------------------------------------------
+  def _merged_qsub(self,group):
+    ''' Write a qsub file running the bodies of the qsub files in group side by side. Returns (qsubfile, path).
+    Each body runs in its own directory on its own nodes: bundler.launch places them and gives their mpirun
+    the host list and core binding in $AG_MPI_OPTS.'''
+    first=group[0]
+    if first['np']=='allprocs':
+      ppnstr=',flags=allprocs'
+    else:
+      ppnstr=':ppn=%d'%first['np']
+    jobname='AGMerged_%s'%first['token'][len(PENDING_PREFIX):]
+    path=os.path.dirname(self.statefile)
+    tasks=[]
+    for entry in group:
+      with open(os.path.join(entry['path'],entry['qsubfile']),'r') as inpf:
+        body=[line for line in inpf.read().split('\n') if not line.startswith('#PBS')]
+      # Bodies that cd ${PBS_O_WORKDIR} should stay in their own directory.
+      body=["export PBS_O_WORKDIR=%s"%shlex.quote(os.path.abspath(entry['path']))]+body
+      with open(os.path.join(entry['path'],entry['qsubfile']+'.sh'),'w') as outf:
+        outf.write('\n'.join(body))
+      tasks.append({'path':os.path.abspath(entry['path']),'script':entry['qsubfile']+'.sh',
+        'nn':entry['nn'],'np':entry['np']})
+    bundlefile=os.path.join(path,jobname+'.bundle')
+    with open(bundlefile,'w') as outf:
+      json.dump({
+          'mpi':self.mpi,
+          'walltime':submitter.walltime_seconds(first['walltime']),
+          'tasks':tasks,
+          'backfill':[]
+        },outf,indent=1)
+    qsublines=[
+        "#PBS -q %s"%first['queue'],
+        "#PBS -l nodes=%i%s"%(sum(e['nn'] for e in group),ppnstr),
+        "#PBS -l walltime=%s"%first['walltime'],
+        "#PBS -j oe ",
+        "#PBS -N %s "%jobname,
+      ]
+    priorities=[entry['priority'] for entry in group if entry.get('priority') is not None]
+    if len(priorities)>0:
+      qsublines+=["#PBS -p %d"%max(priorities)]
+    qsublines+=["%s %s launch %s"%(sys.executable,os.path.abspath(bundler.__file__),bundlefile)]
+    qsubfile=jobname+'.qsub'
+    with open(os.path.join(path,qsubfile),'w') as outf:
+      outf.write('\n'.join(qsublines))
+    return qsubfile,path
+
+  #------------------------------------------------
+  def drain(self,force=False):
+    ''' Submit backlogged jobs while their queues have free slots.
+    Args:
+      force (bool): drain even if the last drain was less than drain_interval ago.
+    Returns:
+      int: number of qsub calls made.
+    '''
+    with self._lock:
+      if not force and self._lastdrain is not None and time.time()-self._lastdrain<self.drain_interval:
+        return 0
+      self._lastdrain=time.time()
+      nsubmit=0
+      with self._state() as state:
+        if len(state['backlog'])==0:
+          return 0
+        used=self._usage()
+        if used is None:
+          print(self.__class__.__name__,": queue state unknown, holding %d jobs."%len(state['backlog']))
+          return 0
+
+        byqueue={}
+        for entry in state['backlog']:
+          byqueue.setdefault(entry['queue'],[]).append(entry)
+        done=set()
+        for queue,entries in byqueue.items():
+          # Jobs that failed to submit last, then highest priority first, then oldest first.
+          entries=sorted(entries,key=lambda entry:(entry['failures']>0,-(entry.get('priority') or 0)))
+          for group in self._groups(entries):
+            limit=self.limit(queue)
+            if limit is not None and used.get(queue,0)>=limit:
+              break
+            try:
+              if len(group)==1:
+                queueid=submitter.qsub(group[0]['qsubfile'],group[0]['path'])
+              else:
+                queueid=submitter.qsub(*self._merged_qsub(group))
+            except (sub.CalledProcessError,OSError) as err:
+              print(self.__class__.__name__,": Error submitting %d jobs to %s.\n\t%s"%(len(group),queue,err))
+              for entry in group:
+                entry['failures']+=1
+                if entry['failures']>=MAX_FAILURES:
+                  print(self.__class__.__name__,": dropping %s after %d failed submissions."%\
+                      (os.path.join(entry['path'],entry['qsubfile']),entry['failures']))
+                  done.add(entry['token'])
+              break
+            nsubmit+=1
+            used[queue]=used.get(queue,0)+1
+            for entry in group:
+              state['submitted'][entry['token']]={'queueid':queueid,'time':time.time()}
+              done.add(entry['token'])
+            print(self.__class__.__name__,": Submitted %d backlogged jobs as %s"%(len(group),queueid))
+        state['backlog']=[entry for entry in state['backlog'] if entry['token'] not in done]
+      return nsubmit
+
+  #------------------------------------------------
+  def backlog(self):
+    ''' Entries waiting to be submitted.'''
+    with self._state() as state:
+      return list(state['backlog'])
+
+#######################################################################
+_active=None
+
+#----------------------------------------------------------------------
+def use(coordinator):
+  ''' Make runners submit through coordinator from now on (None goes back to calling qsub directly).'''
+  global _active
+  _active=coordinator
+  return _active
+
+#----------------------------------------------------------------------
+def active():
+  ''' The active coordinator, or None.'''
+  return _active
+
+#----------------------------------------------------------------------
+def drain():
+  ''' Drain the backlog of the active coordinator, if there is one.'''
+  if _active is not None:
+    return _active.drain()
+  return 0
+
+#----------------------------------------------------------------------
+def resolve_queueid(queueid):
+  ''' Replace placeholders in a list of queue ids by the real ids of submitted jobs.
+  Placeholders still in the backlog are kept; unknown ones (or all, without an active coordinator) are dropped.'''
+  resolved=[]
+  for qid in queueid:
+    if is_pending(qid):
+      qid=None if _active is None else _active.resolve(qid)
+    if qid is not None and qid not in resolved:
+      resolved.append(qid)
+  return resolved
@@ -7,6 +7,7 @@ from pymatgen.io.cif import CifParser
 from pymatgen.io.xyz import XYZ
 from pymatgen.core.periodic_table import Element
 from crystal2qmc import periodic_table # TODO should this be in crystal2qmc?
+from manager_tools import content_hash
 from xml.etree.ElementTree import ElementTree
 import numpy as np
 import os
@@ -100,6 +101,11 @@ class CrystalWriter:
       assert len(d['spinedit'])==0 or ('guess_fort' in d and d['guess_fort'] is not None),\
           "spinedit requires guess_fort."
 
+  #-----------------------------------------------
+  def fingerprint(self):
+    ''' Hash of the options that go into the input file. Excludes state set while running (restarts, the guess, symmetry set from initial_spins).'''
+    return content_hash(self,skip_keys=['completed','restart','guess_fort','_elements','modisymm'])
+
   #-----------------------------------------------
   def crystal_input(self,section4=[]):
 
@@ -725,9 +725,12 @@ def convert_crystal(
     base="qwalk",
     propoutfn="prop.in.o",
     kset='complex',
-    nvirtual=50):
+    nvirtual=50,
+    path=''):
   """
   Files are named by [base]_[kindex].sys etc.
+  GRED.DAT and KRED.DAT are read from, and files are written into, path.
+  Returned file names are relative to path.
   """
   # kfmt='coord' is probably a bad thing because it doesn't always work and can 
   # lead to unexpected changes in file name conventions.
@@ -735,8 +738,10 @@ def convert_crystal(
   # keeps track of the files that get produced.
   files={}
 
-  info, lat_parm, ions, basis, pseudo = read_gred()
-  eigsys = read_kred(info,basis)
+  if path!='' and path[-1]!='/': path+='/'
+
+  info, lat_parm, ions, basis, pseudo = read_gred(path+"GRED.DAT")
+  eigsys = read_kred(info,basis,path+"KRED.DAT")
 
   if eigsys['nspin'] > 1:
     eigsys['totspin'] = read_outputfile(propoutfn)
@@ -765,8 +770,8 @@ def convert_crystal(
       'sys':{},
       'slater':{}
     }
-  write_basis(basis,ions,files['basis'])
-  write_jast2(lat_parm,ions,files['jastrow2'])
+  write_basis(basis,ions,path+files['basis'])
+  write_jast2(lat_parm,ions,path+files['jastrow2'])
  
   for kpt in eigsys['kpt_coords']:
     if eigsys['ikpt_iscmpx'][kpt] and kset=='real': continue
@@ -777,23 +782,25 @@ def convert_crystal(
     files['orb'][kidx]="%s_%d.orb"%(base,kidx)
     files['sys'][kidx]="%s_%d.sys"%(base,kidx)
     write_slater(basis,eigsys,kpt,
-        outfn=files['slater'][kidx],
+        outfn=path+files['slater'][kidx],
         orbfn=files['orb'][kidx],
         basisfn=files['basis'],
         maxmo_spin=maxmo_spin)
     write_orbplot(basis,eigsys,kpt,
-        outfn=files['orbplot'][kidx],
+        outfn=path+files['orbplot'][kidx],
         orbfn=files['orb'][kidx],
         basisfn=files['basis'],
         sysfn=files['sys'][kidx],
         maxmo_spin=maxmo_spin)
     normalize_eigvec(eigsys,basis,kpt)
-    write_orb(eigsys,basis,ions,kpt,files['orb'][kidx],maxmo_spin)
-    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,files['sys'][kidx])
+    write_orb(eigsys,basis,ions,kpt,path+files['orb'][kidx],maxmo_spin)
+    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,path+files['sys'][kidx])
 
   return files
 
 if __name__ == "__main__":
+  import os
+  import json
   from argparse import ArgumentParser
   parser=ArgumentParser('Convert a crystal file (defaults in brackets).')
   parser.add_argument('-b','--base',type=str,default='qwalk',
@@ -804,7 +811,15 @@ if __name__ == "__main__":
       help="[='complex'] 'real' or 'complex' kpoints.")
   parser.add_argument('-v','--nvirtual',type=int,default=50,
       help="[=50] Number of unoccupied or virtual orbitals to allow access to.")
+  parser.add_argument('-d','--path',type=str,default='',
+      help="[=''] Directory containing GRED.DAT and KRED.DAT, where files are written.")
+  parser.add_argument('-j','--json',type=str,default=None,
+      help="[=None] File to write the names of the produced files into, as JSON.")
   args=parser.parse_args()
 
-  convert_crystal(args.base,args.propout,args.kset,args.nvirtual)
+  files=convert_crystal(args.base,args.propout,args.kset,args.nvirtual,args.path)
+  if args.json is not None:
+    with open(args.json+'.tmp','w') as outf:
+      json.dump(files,outf,default=int) # k-point coordinates are numpy integers.
+    os.replace(args.json+'.tmp',args.json)
 
@@ -1,11 +1,16 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, update_writer
 from crystal import CrystalReader
 from propertiesreader import PropertiesReader
 from autorunner import RunnerPBS
 import os
-import pickle as pkl
+import sys
+import json
+import statecache
+import runtimes
 import shutil as sh
+from copy import deepcopy
 import crystal2qmc
+from resultcache import cache_key
 from autopaths import paths
 
 class CrystalManager:
@@ -13,7 +18,7 @@ class CrystalManager:
   Has authority over file names associated with this task."""
   def __init__(self,writer,runner,creader=None,name='crystal_run',path=None,
       preader=None,prunner=None,
-      trylev=False,bundle=False,max_restarts=2):
+      trylev=False,bundle=False,max_restarts=2,cache=None,fuse=False):
     ''' CrystalManager manages the writing of a Crystal input file, it's running, and keeping track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -26,6 +31,9 @@ class CrystalManager:
       trylev (bool): When restarting use LEVSHIFT option to encourage convergence, then do a rerun without LEVSHIFT.
       bundle (bool): Whether you'll use a bundling tool to run these jobs.
       max_restarts (int): maximum number of times you'll allow restarting before giving up (and manually intervening).
+      cache (ResultCache): reuse the results of identical calculations from this cache, and store results into it (None implies no cache).
+      fuse (bool): run properties and the conversion to QWalk files in the CRYSTAL job, if the SCF converges,
+        with the CRYSTAL runner. The manager picks up all three results at once.
     '''
     # Where to save self.
     self.name=name
@@ -33,7 +41,7 @@ class CrystalManager:
 
     # Ensure path is set up correctly.
     if path is None:
-      path=os.path.getcwd()
+      path=os.getcwd()
     if path[-1]!='/': path+='/'
     self.path=path
 
@@ -57,11 +65,17 @@ class CrystalManager:
     self.propinpfn=self.name+'.prop'
     self.crysoutfn=self.crysinpfn+'.o'
     self.propoutfn=self.propinpfn+'.o'
+    self.qwfilesfn=self.name+'.qwfiles.json' # Written by the conversion in fused jobs.
     self.restarts=0
     self._runready=False
+    self.bundle_ready=False
     self.scriptfile=None
     self.completed=False
+    self.input_hash=None # Fingerprint of the writer when the inputs were last written.
     self.bundle=bundle
+    self.fuse=fuse
+    self.cache=cache
+    self.result_key=None if cache is None else cache_key(writer,self.path) # None also means no caching.
     self.qwfiles={ 
         'kpoints':[],
         'basis':'',
@@ -81,33 +95,34 @@ class CrystalManager:
     # Handle old results if present.
     if os.path.exists(self.path+self.pickle):
       #print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=statecache.load(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Recover old class by copying over data. Retain variables from old that may change final answer.'''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    if other is self:
+      return # Nothing to copy: the state cache handed back this instance.
 
     update_attributes(copyto=self,copyfrom=other,
         skip_keys=['writer','runner','creader','preader','prunner','lev','savebroy',
                    'path','logname','name',
-                   'trylev','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles'])
+                   'trylev','max_restarts','bundle','cache','result_key','fuse'],
+        take_keys=['restarts','completed','qwfiles','input_hash'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
-        take_keys=['queueid'])
+        skip_keys=['queue','walltime','np','nn','jobname','features','priority'],
+        take_keys=['queueid','runtimefile'])
     update_attributes(copyto=self.prunner,copyfrom=other.prunner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
-        take_keys=['queueid'])
+        skip_keys=['queue','walltime','np','nn','jobname','features','priority'],
+        take_keys=['queueid','runtimefile'])
 
     update_attributes(copyto=self.creader,copyfrom=other.creader,
         skip_keys=[],
@@ -117,93 +132,140 @@ class CrystalManager:
         skip_keys=[],
         take_keys=['completed','output'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
+    update_writer(copyto=self.writer,copyfrom=other.writer,input_hash=self.input_hash,
         skip_keys=['maxcycle','edifftol'],
         take_keys=['completed','modisymm','restart','guess_fort','_elements'])
-    if updated:
-      self.writer.completed=False
 
   #----------------------------------------
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
-
-    print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
-
-    # Generate input files.
-    if not self.writer.completed:
-      if self.writer.guess_fort is not None:
-        sh.copy(self.writer.guess_fort,'fort.20')
-      with open(self.crysinpfn,'w') as f:
-        self.writer.write_crys_input(self.crysinpfn)
-      with open(self.propinpfn,'w') as f:
-        self.writer.write_prop_input(self.propinpfn)
-
-    # Check on the CRYSTAL run
-    status=resolve_status(self.runner,self.creader,self.crysoutfn)
-    print(self.logname,": status= %s"%(status))
-
-    if status=="not_started":
-      self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+    with statecache.deferred(self.path+self.pickle):
+      self.recover(statecache.load(self.path+self.pickle))
+
+      print(self.logname,": next step.")
+
+      # Generate input files.
+      if not self.writer.completed:
+        if self.writer.guess_fort is not None:
+          sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.20')
+        self.writer.write_crys_input(self.path+self.crysinpfn)
+        self.writer.write_prop_input(self.path+self.propinpfn)
+        self.input_hash=self.writer.fingerprint()
+
+      # Reuse the results of an identical calculation, if there is one and this one hasn't been submitted.
+      if self.result_key is not None and resolve_status(self.runner,self.creader,self.path+self.crysoutfn)=='not_started'\
+          and len(getattr(self.runner,'queueid',[]))==0:
+        self.cache.fetch(self.result_key,'crystal',self.path,self._cache_files('crystal'),{'creader':self.creader})
+
+      # Check on the CRYSTAL run
+      status=resolve_status(self.runner,self.creader,self.path+self.crysoutfn)
+      print(self.logname,": status= %s"%(status))
+
+      if status=="not_started":
+        self.runner.add_command("cp %s INPUT"%self.crysinpfn)
+        self._add_crystal_task()
+
+      elif status=="ready_for_analysis":
+        #This is where we (eventually) do error correction and resubmits
+        status=self.creader.collect(self.path+self.crysoutfn)
+        print(self.logname,": status %s"%status)
+        if status=='killed':
+          if self.restarts >= self.max_restarts:
+            print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
+          else:
+            print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
+            self.writer.restart=True
+            if self.trylev:
+              print(self.logname,": trying LEVSHIFT.")
+              self.writer.levshift=[10,1] # No mercy.
+              self.savebroy=deepcopy(self.writer.broyden)
+              self.writer.broyden=[]
+              self.lev=True
+            self._save_restart()
+            self._add_crystal_task()
+            self.restarts+=1
+      elif status=='done' and self.lev:
+        # We used levshift to converge. Now let's restart to be sure.
+        print("Recovering from LEVSHIFTer.")
+        self.writer.restart=True
+        self.writer.levshift=[]
+        self.creader.completed=False
+        self.lev=False
+        self._save_restart()
+        self._add_crystal_task()
+        self.restarts+=1
+
+      # Ready for bundler or else just submit the jobs as needed.
+      if self.bundle:
+        self.scriptfile="%s.run"%self.name
+        self.bundle_ready=self.runner.script(self.path+self.scriptfile)
+      else:
+        self.runner.features=runtimes.features(self)
+        qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,path=self.path)
 
-    elif status=="ready_for_analysis":
-      #This is where we (eventually) do error correction and resubmits
-      status=self.creader.collect(self.crysoutfn)
-      print(self.logname,": status %s"%status)
-      if status=='killed':
-        if self.restarts >= self.max_restarts:
-          print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
-        else:
-          print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-          self.writer.restart=True
-          if self.trylev:
-            print(self.logname,": trying LEVSHIFT.")
-            self.writer.levshift=[10,1] # No mercy.
-            self.savebroy=deepcopy(self.writer.broyden)
-            self.writer.broyden=[]
-            self.lev=True
-          sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-          sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-          sh.copy('fort.79',"%d.fort.79"%(self.restarts))
-          self.writer.guess_fort='./fort.79'
-          sh.copy(self.writer.guess_fort,'fort.20')
-          self.writer.write_crys_input(self.crysinpfn)
-          sh.copy(self.crysinpfn,'INPUT')
-          self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
-          self.restarts+=1
-    elif status=='done' and self.lev:
-      # We used levshift to converge. Now let's restart to be sure.
-      print("Recovering from LEVSHIFTer.")
-      self.writer.restart=True
-      self.writer.levshift=[]
-      self.creader.completed=False
-      self.lev=False
-      sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-      sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-      sh.copy('fort.79',"%d.fort.79"%(self.restarts))
-      self.writer.guess_fort='./fort.79'
-      sh.copy(self.writer.guess_fort,'fort.20')
-      self.writer.write_crys_input(self.crysinpfn)
-      sh.copy(self.crysinpfn,'INPUT')
+      self.completed=self.creader.completed
+      if self.completed:
+        runtimes.record(self)
+        if self.fuse and not self.lev:
+          self._collect_fused()
+      if self.result_key is not None and self.completed and not self.lev\
+          and not self.cache.contains(self.result_key,'crystal'):
+        self.cache.store(self.result_key,'crystal',self.path,self._cache_files('crystal'),{'creader':self.creader})
+
+      # Update the file.
+      statecache.save(self,self.path+self.pickle)
+
+  #----------------------------------------
+  def _add_crystal_task(self):
+    ''' Run CRYSTAL from INPUT. In fused mode, a converged SCF is followed by properties and the conversion to QWalk.
+    Runs with LEVSHIFT are rerun without it, so they are not fused.'''
+    if not self.fuse or self.lev:
       self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
-      self.restarts+=1
+      return
+    converter=os.path.join(os.path.dirname(os.path.abspath(__file__)),'crystal2qmc.py')
+    self.runner.add_command("rm -f %s GRED.DAT KRED.DAT"%self.qwfilesfn)
+    self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+    self.runner.add_command("if grep -q 'SCF ENDED - CONVERGENCE ON ENERGY' %s; then"%self.crysoutfn)
+    self.runner.add_command("cp %s INPUT"%self.propinpfn)
+    self.runner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
+    self.runner.add_command("%s %s -b %s -p %s --json %s"%(sys.executable,converter,self.name,self.propoutfn,self.qwfilesfn))
+    self.runner.add_command("fi")
 
-    # Ready for bundler or else just submit the jobs as needed.
-    if self.bundle:
-      self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile)
-    else:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+  #----------------------------------------
+  def _collect_fused(self):
+    ''' Pick up the properties and QWalk files of a fused job, if it made them.'''
+    if not self.preader.completed and os.path.exists(self.path+self.propoutfn):
+      self.preader.collect(self.path+self.propoutfn)
+      if self.preader.completed and self.result_key is not None and not self.cache.contains(self.result_key,'properties'):
+        self.cache.store(self.result_key,'properties',self.path,self._cache_files('properties'),{'preader':self.preader})
+    if self.preader.completed and len(self.qwfiles['slater'])==0 and os.path.exists(self.path+self.qwfilesfn):
+      print(self.logname,": reading QWalk files converted in the job.")
+      with open(self.path+self.qwfilesfn,'r') as inpf:
+        qwfiles=json.load(inpf)
+      # JSON keys are strings, and k-points lists.
+      for key in ('kpoints','orbplot','orb','sys','slater'):
+        qwfiles[key]={int(kidx):value for kidx,value in qwfiles[key].items()}
+      qwfiles['kpoints']={kidx:tuple(kpt) for kidx,kpt in qwfiles['kpoints'].items()}
+      self.qwfiles=qwfiles
 
-    self.completed=self.creader.completed
+  #----------------------------------------
+  def _save_restart(self):
+    ''' Keep the previous attempt and set up the input to restart from its wave function.'''
+    sh.copy(self.path+self.crysinpfn,self.path+"%d.%s"%(self.restarts,self.crysinpfn))
+    sh.copy(self.path+self.crysoutfn,self.path+"%d.%s"%(self.restarts,self.crysoutfn))
+    sh.copy(self.path+'fort.79',self.path+"%d.fort.79"%(self.restarts))
+    self.writer.guess_fort='./fort.79'
+    sh.copy(self.path+'fort.79',self.path+'fort.20')
+    self.writer.write_crys_input(self.path+self.crysinpfn)
+    self.input_hash=self.writer.fingerprint()
+    sh.copy(self.path+self.crysinpfn,self.path+'INPUT')
 
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+  #----------------------------------------
+  def _cache_files(self,stage):
+    ''' Files of stage ('crystal' or 'properties') kept in the result cache, keyed by their name in the cache.'''
+    if stage=='crystal':
+      return {'crystal.o':self.crysoutfn,'fort.9':'fort.9','fort.79':'fort.79'}
+    return {'properties.o':self.propoutfn,'GRED.DAT':'GRED.DAT','KRED.DAT':'KRED.DAT'}
 
   #----------------------------------------
   def collect(self):
@@ -212,20 +274,35 @@ class CrystalManager:
     self.creader.collect(self.path+self.crysoutfn)
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #------------------------------------------------
   def script(self,jobname=None):
     ''' Script execution lines for a bundler to pick up and run.'''
     if jobname is None: jobname=self.runner.jobname
     self.scriptfile="%s.run"%jobname
-    self._runready=self.runner.script(self.scriptfile)
+    self._runready=self.runner.script(self.path+self.scriptfile)
+
+  #------------------------------------------------
+  def update_queueid(self,qid):
+    ''' If a bundler handles the submission, it can update the queue info with this.
+    Args:
+      qid (str): new queue id from submitting a job. The Manager will check if this is running.
+    '''
+    # Once CRYSTAL is done, the script being run is the properties job.
+    if self.creader.completed:
+      self.prunner.queueid.append(qid)
+    else:
+      self.runner.queueid.append(qid)
+    self.bundle_ready=False # After running, we won't run again without more analysis.
+
+    # Update the file.
+    statecache.save(self,self.path+self.pickle)
 
   #------------------------------------------------
   def submit(self,jobname=None):
     ''' Submit the runner's job to the queue. '''
-    qsubfile=self.runner.submit(jobname)
+    qsubfile=self.runner.submit(jobname,path=self.path)
     return qsubfile
 
   #----------------------------------------
@@ -241,52 +318,58 @@ class CrystalManager:
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
-
-    ready=False
-    if len(self.qwfiles['slater'])==0:
-      self.nextstep()
-
-      if not self.completed:
-        return False
-
-      cwd=os.getcwd()
-      os.chdir(self.path)
-
-      print(self.logname,": %s attempting to generate QWalk files."%self.name)
-
-      # Check on the properties run
-      status=resolve_status(self.prunner,self.preader,self.propoutfn)
-      print(self.logname,": properties status= %s"%(status))
-      if status=='not_started':
-        ready=False
-        self.prunner.add_command("cp %s INPUT"%self.propinpfn)
-        self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
-
-        if self.bundle:
-          self.scriptfile="%s.run"%self.name
-          self.bundle_ready=self.prunner.script(self.scriptfile,self.driverfn)
+    with statecache.deferred(self.path+self.pickle):
+      self.recover(statecache.load(self.path+self.pickle))
+
+      ready=False
+      if len(self.qwfiles['slater'])==0:
+        self.nextstep()
+
+        if not self.completed:
+          return False
+
+      # The fused job may have made the QWalk files, otherwise properties and the conversion are run separately.
+      if len(self.qwfiles['slater'])==0:
+        print(self.logname,": %s attempting to generate QWalk files."%self.name)
+
+        if self.result_key is not None and resolve_status(self.prunner,self.preader,self.path+self.propoutfn)=='not_started'\
+            and len(getattr(self.prunner,'queueid',[]))==0:
+          self.cache.fetch(self.result_key,'properties',self.path,self._cache_files('properties'),{'preader':self.preader})
+
+        # Check on the properties run
+        status=resolve_status(self.prunner,self.preader,self.path+self.propoutfn)
+        print(self.logname,": properties status= %s"%(status))
+        if status=='not_started':
+          ready=False
+          self.prunner.add_command("cp %s INPUT"%self.propinpfn)
+          self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
+
+          if self.bundle:
+            self.scriptfile="%s.run"%self.name
+            self.bundle_ready=self.prunner.script(self.path+self.scriptfile)
+          else:
+            self.prunner.features=runtimes.features(self,'prunner')
+            qsubfile=self.prunner.submit(self.path.replace('/','-')+self.name,path=self.path)
+        elif status=='ready_for_analysis':
+          self.preader.collect(self.path+self.propoutfn)
+
+        if self.preader.completed:
+          ready=True
+          runtimes.record(self,'prunner')
+          if self.result_key is not None and not self.cache.contains(self.result_key,'properties'):
+            self.cache.store(self.result_key,'properties',self.path,self._cache_files('properties'),{'preader':self.preader})
+          print(self.logname,": converting crystal to QWalk input now.")
+          self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.path+self.propoutfn,path=self.path)
         else:
-          qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
-      elif status=='ready_for_analysis':
-        self.preader.collect(self.propoutfn)
+          ready=False
+          print(self.logname,": conversion postponed because properties is not finished.")
 
-      if self.preader.completed:
-        ready=True
-        print(self.logname,": converting crystal to QWalk input now.")
-        self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.propoutfn)
       else:
-        ready=False
-        print(self.logname,": conversion postponed because properties is not finished.")
-
-      os.chdir(cwd)
-    else:
-      ready=True
+        ready=True
 
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+      statecache.save(self,self.path+self.pickle)
 
-    return ready
+      return ready
     
   #----------------------------------------
   def status(self):
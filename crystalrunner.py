@@ -1,7 +1,6 @@
 from __future__ import print_function
 import os
 import numpy as np
-import subprocess as sub
 import shutil
 import submitter
 from submitter import LocalSubmitter
@@ -89,8 +88,7 @@ class CrystalRunnerPBS:
     qsubfile=crysinpfn+".qsub"
     with open(qsubfile,'w') as f:
       f.write(qsub)
-    result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-    self.queueid = result.decode().split()[0]
+    self.queueid = submitter.qsub(qsubfile)
     print("Submitted as %s"%self.queueid)
 
 ####################################################
@@ -145,8 +143,7 @@ class CrystalRunnerVeritas:
     qsubfile=crysinpfn+".qsub"
     with open(qsubfile,'w') as f:
       f.write(qsub)
-    result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-    self.queueid = result.decode().split()[0]
+    self.queueid = submitter.qsub(qsubfile)
     print("Submitted as %s"%self.queueid)
     
 
@@ -0,0 +1,167 @@
+''' Resident polling loop that keeps managers in memory and checks each on its own schedule.'''
+from __future__ import print_function
+import os
+import time
+import heapq
+from workflow import Workflow
+import coordinator
+
+#######################################################################
+def output_file(mgr):
+  ''' Name of the main output file of a manager (None if unknown).'''
+  for attr in ('crysoutfn','outfile'):
+    fn=getattr(mgr,attr,None)
+    if type(fn)==str:
+      return fn
+  return None
+
+#######################################################################
+class WorkflowDaemon:
+  ''' Keep a Workflow resident and re-check every manager on an adaptive schedule.
+
+  * A manager that just submitted a job, or changed state, is checked again after `min_interval`.
+  * A manager whose state did not change backs off by `backoff`, up to `max_interval`.
+  * A manager whose output file appears is checked immediately.
+    This is detected with one stat per directory every `watch_interval`.
+  * When a manager changes state, the managers downstream of it that are now ready are checked immediately:
+    all of them once it finishes, and chain managers (see Workflow.is_ready) as soon as it has a job queued.
+  Only managers that are due are stepped, so the cost of a sweep scales with the
+  number of changes rather than the number of managers.
+  '''
+  def __init__(self,workflow,min_interval=30,max_interval=3600,backoff=2.0,watch_interval=10):
+    '''
+    Args:
+      workflow (Workflow or list): workflow to drive (a list of managers is converted into one).
+      min_interval (float): seconds before rechecking a manager that just changed.
+      max_interval (float): longest time between checks of a manager.
+      backoff (float): factor the interval grows by each time a manager is found unchanged.
+      watch_interval (float): seconds between scans of the managers' directories.
+    '''
+    if not isinstance(workflow,Workflow):
+      workflow=Workflow(workflow)
+    self.workflow=workflow
+    self.min_interval=min_interval
+    self.max_interval=max_interval
+    self.backoff=backoff
+    self.watch_interval=watch_interval
+
+    self.interval={}
+    self.due={}
+    self._heap=[]
+    self._dirmtime={}
+    self._present={}
+    self._lastwatch=0.0
+    for key in self.workflow.ready():
+      self.schedule(key,0.0)
+
+  #------------------------------------------------
+  def schedule(self,key,delay):
+    ''' Check key in delay seconds (or sooner, if it is already due sooner).'''
+    when=time.time()+delay
+    if key in self.due and self.due[key]<=when:
+      return
+    self.due[key]=when
+    heapq.heappush(self._heap,(when,key))
+
+  #------------------------------------------------
+  def _pop_due(self,now):
+    ''' Keys whose check time has passed.'''
+    keys=[]
+    while len(self._heap)>0 and self._heap[0][0]<=now:
+      when,key=heapq.heappop(self._heap)
+      if self.due.get(key)!=when: # Stale entry, rescheduled since.
+        continue
+      del self.due[key]
+      keys.append(key)
+    return keys
+
+  #------------------------------------------------
+  def _watch(self):
+    ''' Scan directories that changed since the last scan for new output files.
+    Returns:
+      list: keys whose output file appeared.
+    '''
+    bydir={}
+    for key in self.due:
+      mgr=self.workflow.nodes[key]
+      fn=output_file(mgr)
+      if fn is not None:
+        bydir.setdefault(mgr.path,[]).append((key,fn))
+
+    appeared=[]
+    for path,entries in bydir.items():
+      try:
+        mtime=os.stat(path).st_mtime
+      except OSError:
+        continue
+      if self._dirmtime.get(path)==mtime:
+        continue
+      self._dirmtime[path]=mtime
+      names=set(entry.name for entry in os.scandir(path))
+      for key,fn in entries:
+        present=fn in names
+        if present and self._present.get(key) is False:
+          appeared.append(key)
+        self._present[key]=present
+    return appeared
+
+  #------------------------------------------------
+  def _wake_downstream(self,key):
+    ''' Check the nodes downstream of key that are ready now.'''
+    for down in self.workflow.downstream[key]:
+      if self.workflow.is_ready(down):
+        self.interval[down]=self.min_interval
+        self.schedule(down,0.0)
+
+  #------------------------------------------------
+  def _reschedule(self,key,before,changed):
+    ''' Choose the next check of key based on what its last step did.'''
+    if key in self.workflow.finished:
+      self.interval.pop(key,None)
+      self._wake_downstream(key)
+      return
+    after=self.workflow.state.get(key)
+    submitted=before is not None and after is not None and len(after[2])>len(before[2])
+    if changed or submitted:
+      self._wake_downstream(key)
+    if changed or submitted or key not in self.interval:
+      self.interval[key]=self.min_interval
+    else:
+      self.interval[key]=min(self.interval[key]*self.backoff,self.max_interval)
+    self.schedule(key,self.interval[key])
+
+  #------------------------------------------------
+  def tick(self):
+    ''' Step every manager that is due now.
+    Returns:
+      list: keys that were stepped.'''
+    now=time.time()
+    coordinator.drain()
+    if now-self._lastwatch>=self.watch_interval:
+      self._lastwatch=now
+      for key in self._watch():
+        self.schedule(key,0.0)
+    keys=self._pop_due(now)
+    if len(keys)==0:
+      return keys
+    before={key:self.workflow.state.get(key) for key in keys}
+    # Managers whose jobs are still queued or running are found unchanged without stepping them.
+    changed=set(self.workflow.advance(self.workflow.idle(keys)))
+    for key in keys:
+      self._reschedule(key,before[key],key in changed)
+    print(self.__class__.__name__,": stepped %d, %d changed, %d/%d finished."%\
+        (len(keys),len(changed),len(self.workflow.finished),len(self.workflow.nodes)))
+    return keys
+
+  #------------------------------------------------
+  def run(self):
+    ''' Tick until every manager in the workflow is finished.'''
+    while not self.workflow.done():
+      self.tick()
+      wait=self.watch_interval
+      if len(self._heap)>0:
+        wait=min(wait,self._heap[0][0]-time.time())
+      if len(self.due)==0 and not self.workflow.done():
+        print(self.__class__.__name__,": nothing left to check; unfinished managers are blocked.")
+        break
+      time.sleep(max(wait,0.0))
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import os
 import average_tools as avg
+from manager_tools import content_hash
 ####################################################
 class DMCWriter:
   def __init__(self,options={}):
@@ -46,6 +47,11 @@ class DMCWriter:
     for avg_generator in self.extra_observables:
       avg.check_opts(avg_generator)
 
+  #-----------------------------------------------
+  def fingerprint(self):
+    ''' Hash of the options that go into the input file. The trial function is exported by the manager, so it is excluded.'''
+    return content_hash(self,skip_keys=['completed','trialfunc'])
+
   #-----------------------------------------------
   def qwalk_input(self,infile):
     if self.trialfunc=='':
@@ -58,7 +64,7 @@ class DMCWriter:
       if self.tmoves:
         outlines+=['tmoves']
       if self.savetrace:
-        tracename = "%s.trace"%infile
+        tracename = "%s.trace"%os.path.basename(infile)
         outlines+=['save_trace %s'%tracename]
       for avg_opts in self.extra_observables:
         outlines+=avg.average_section(avg_opts)
@@ -95,7 +101,7 @@ class DMCReader:
     Args:
       outfile (str): output to read.
     '''
-    return json.loads(sub.check_output([self.gosling,"-json",outfile.replace('.o','.log')]).decode())
+    return json.loads(sub.check_output([self.gosling,"-json",os.path.splitext(outfile)[0]+'.log']).decode())
 
   def check_complete(self):
     ''' Check if a DMC run is complete.
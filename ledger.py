@@ -0,0 +1,161 @@
+''' Optional SQLite ledger of managers.
+
+When a ledger is open (see `use`), every time a manager's state is written to disk, a row
+describing it is updated in one SQLite database. Questions like "which DMC runs are still
+in the queue" are then indexed queries instead of unpickling every manager.
+'''
+import os
+import json
+import time
+import pickle as pkl
+import sqlite3
+import threading
+
+SCHEMA=[
+    '''create table if not exists managers (
+         key text primary key,
+         name text,
+         path text,
+         type text,
+         status text,
+         queueid text,
+         restarts integer,
+         results blob,
+         updated real
+       )''',
+    'create index if not exists managers_status on managers (status)',
+    'create index if not exists managers_type on managers (type,status)',
+    'create index if not exists managers_path on managers (path)',
+    'create index if not exists managers_name on managers (name)',
+  ]
+COLUMNS=['key','name','path','type','status','queueid','restarts','results','updated']
+
+#######################################################################
+def manager_status(mgr):
+  ''' Ledger status of a manager: 'done', 'queued' (has jobs in the queue), or 'pending'.'''
+  if mgr.completed:
+    return 'done'
+  if len(manager_queueid(mgr))>0:
+    return 'queued'
+  return 'pending'
+
+#----------------------------------------------------------------------
+def manager_queueid(mgr):
+  ''' Queue ids of all the runners of a manager.'''
+  queueid=[]
+  for attr in ('runner','prunner'):
+    qids=getattr(getattr(mgr,attr,None),'queueid',None)
+    if type(qids)==list:
+      queueid+=[qid for qid in qids if qid not in queueid]
+  return queueid
+
+#----------------------------------------------------------------------
+def manager_results(mgr):
+  ''' Outputs of the readers of a manager.'''
+  results={}
+  for attr in ('reader','creader','preader'):
+    reader=getattr(mgr,attr,None)
+    if reader is not None:
+      results[attr]=getattr(reader,'output',None)
+  return results
+
+#######################################################################
+class Ledger:
+  ''' Table of managers in an SQLite database, indexed by name, path, type, and status.'''
+  def __init__(self,dbfile):
+    self.dbfile=os.path.abspath(dbfile)
+    self._local=threading.local()
+    with self._connection() as conn:
+      for statement in SCHEMA:
+        conn.execute(statement)
+
+  #------------------------------------------------
+  def _connection(self):
+    ''' One connection per thread, since sqlite connections can't be shared between threads.'''
+    conn=getattr(self._local,'conn',None)
+    if conn is None:
+      conn=sqlite3.connect(self.dbfile,timeout=60)
+      self._local.conn=conn
+    return conn
+
+  #------------------------------------------------
+  def record(self,mgr):
+    ''' Insert or update the row of a manager, in one transaction.'''
+    row=(
+        mgr.path+mgr.name,
+        mgr.name,
+        mgr.path,
+        mgr.__class__.__name__,
+        manager_status(mgr),
+        json.dumps(manager_queueid(mgr)),
+        getattr(mgr,'restarts',0),
+        sqlite3.Binary(pkl.dumps(manager_results(mgr))),
+        time.time()
+      )
+    with self._connection() as conn:
+      conn.execute('insert or replace into managers (%s) values (%s)'%\
+          (','.join(COLUMNS),','.join('?'*len(COLUMNS))),row)
+
+  #------------------------------------------------
+  def query(self,status=None,type=None,path=None,name=None,results=False):
+    ''' Rows of managers matching all the given columns.
+    Args:
+      status (str): 'done', 'queued', or 'pending'.
+      type (str): class name of the manager, for example 'QWalkManager'.
+      path (str): directory of the manager.
+      name (str): name of the manager.
+      results (bool): whether to unpickle the reader outputs.
+    Returns:
+      list: a dict for each manager.
+    '''
+    where=[]
+    args=[]
+    for column,value in (('status',status),('type',type),('path',path),('name',name)):
+      if value is not None:
+        where.append('%s=?'%column)
+        args.append(value)
+    sql='select %s from managers'%','.join(COLUMNS)
+    if len(where)>0:
+      sql+=' where '+' and '.join(where)
+    sql+=' order by key'
+
+    rows=[]
+    for values in self._connection().execute(sql,args):
+      row=dict(zip(COLUMNS,values))
+      row['queueid']=json.loads(row['queueid'])
+      if results:
+        row['results']=pkl.loads(row['results'])
+      else:
+        del row['results']
+      rows.append(row)
+    return rows
+
+  #------------------------------------------------
+  def forget(self,key):
+    ''' Remove the row of a manager (key is path+name).'''
+    with self._connection() as conn:
+      conn.execute('delete from managers where key=?',(key,))
+
+#######################################################################
+_active=None
+
+#----------------------------------------------------------------------
+def use(dbfile):
+  ''' Open the ledger in dbfile and record managers into it from now on (None stops recording).'''
+  global _active
+  if dbfile is None:
+    _active=None
+  else:
+    _active=Ledger(dbfile)
+  return _active
+
+#----------------------------------------------------------------------
+def active():
+  ''' The open ledger, or None.'''
+  return _active
+
+#----------------------------------------------------------------------
+def record(mgr):
+  ''' Record mgr into the open ledger, if there is one.'''
+  if _active is not None:
+    _active.record(mgr)
@@ -1,5 +1,7 @@
 import numpy as np
 import os 
+import hashlib
+import submitter
 
 def resolve_status(runner,reader,outfile):
   #Check if the reader is done
@@ -19,6 +21,66 @@ def resolve_status(runner,reader,outfile):
   #We are in an error state or we haven't collected the results. 
   return "ready_for_analysis"
 
+######################################################################
+def status_inputs(mgr):
+  ''' The runner, reader, and output file name that determine the status of a manager's main job.
+  Managers of several stages (QMCPipelineManager) give the ones of their current stage.'''
+  if hasattr(mgr,'status_inputs'):
+    return mgr.status_inputs()
+  if hasattr(mgr,'creader'):
+    return mgr.runner,mgr.creader,mgr.crysoutfn
+  return mgr.runner,mgr.reader,mgr.outfile
+
+######################################################################
+def resolve_status_many(managers):
+  ''' Resolve the status of many managers in one pass.
+
+  Same result as resolve_status for each manager, but all PBS runners share one queue snapshot,
+  and each directory is listed once instead of checking every output file.
+
+  Args:
+    managers (list): managers to check.
+  Returns:
+    dict: status of each manager, keyed by path+name.
+  '''
+  bypath={}
+  for mgr in managers:
+    bypath.setdefault(mgr.path,[]).append(mgr)
+
+  jobs=None
+  fetched=False
+  table={}
+  for path,mgrs in bypath.items():
+    names=None
+    for mgr in mgrs:
+      key=mgr.path+mgr.name
+      runner,reader,outfile=status_inputs(mgr)
+      if reader.completed:
+        table[key]='done'
+        continue
+
+      if hasattr(runner,'status_from_snapshot'):
+        if not fetched:
+          jobs=submitter.queue_snapshot()
+          fetched=True
+        currstat=runner.status_from_snapshot(jobs)
+      else:
+        currstat=runner.check_status()
+      if currstat=='running':
+        table[key]=currstat
+        continue
+
+      if names is None:
+        try:
+          names=set(entry.name for entry in os.scandir(path))
+        except OSError:
+          names=set()
+      if outfile not in names:
+        table[key]='not_started'
+      else:
+        table[key]='ready_for_analysis'
+  return table
+
 ######################################################################
 def deep_compare(d1,d2):
   '''I have to redo dict comparison because numpy will return a bool array when comparing.'''
@@ -68,6 +130,76 @@ def update_attributes(copyto,copyfrom,skip_keys=[],take_keys=[]):
       pass
   return updated
 
+######################################################################
+def _hash_update(hasher,obj):
+  ''' Feed a canonical encoding of obj into hasher: dicts and sets are sorted, numpy arrays hashed by content.'''
+  if isinstance(obj,dict):
+    hasher.update(b'{')
+    for key in sorted(obj.keys(),key=repr):
+      _hash_update(hasher,key)
+      _hash_update(hasher,obj[key])
+    hasher.update(b'}')
+  elif isinstance(obj,(set,frozenset)):
+    hasher.update(b'set(')
+    for item in sorted(obj,key=repr):
+      _hash_update(hasher,item)
+    hasher.update(b')')
+  elif isinstance(obj,(list,tuple)):
+    hasher.update(b'[' if isinstance(obj,list) else b'(')
+    for item in obj:
+      _hash_update(hasher,item)
+    hasher.update(b']' if isinstance(obj,list) else b')')
+  elif isinstance(obj,np.ndarray):
+    hasher.update(('array(%s,%s)'%(obj.dtype.str,obj.shape)).encode())
+    hasher.update(np.ascontiguousarray(obj).tobytes())
+  elif hasattr(obj,'__dict__') and not callable(obj):
+    hasher.update(obj.__class__.__name__.encode())
+    _hash_update(hasher,obj.__dict__)
+  else:
+    hasher.update(repr(obj).encode())
+  hasher.update(b';')
+
+######################################################################
+def content_hash(obj,skip_keys=[]):
+  ''' Stable hash of the attributes of obj. 
+
+  Args:
+    obj (obj): object to hash, usually a writer.
+    skip_keys (list): list of attributes (str) to leave out, for example state that doesn't change the input.
+  Returns:
+    str: hex digest, equal for objects with equal attributes (in any order, and across sessions).
+  '''
+  hasher=hashlib.sha1()
+  _hash_update(hasher,{key:val for key,val in obj.__dict__.items() if key not in skip_keys})
+  return hasher.hexdigest()
+
+######################################################################
+def update_writer(copyto,copyfrom,input_hash,skip_keys=[],take_keys=[]):
+  ''' Update a new writer from the writer of an older instance of the same manager.
+
+  If the fingerprint of copyto matches input_hash (the fingerprint of the inputs that were written last),
+  the inputs are unchanged and only take_keys are copied, without comparing the other attributes.
+  Otherwise, falls back to update_attributes and marks copyto not completed, so the inputs are rewritten.
+
+  Args:
+    copyto (writer): new writer.
+    copyfrom (writer): writer of the older instance.
+    input_hash (str): fingerprint of the last written inputs, or None if unknown.
+    skip_keys (list): passed to update_attributes.
+    take_keys (list): attributes (str) that are state of the older instance, rather than inputs.
+  Returns:
+    bool: Whether the inputs changed.
+  '''
+  if input_hash is not None and copyto.fingerprint()==input_hash:
+    for key in take_keys:
+      if key in copyfrom.__dict__:
+        copyto.__dict__[key]=copyfrom.__dict__[key]
+    return False
+  update_attributes(copyto=copyto,copyfrom=copyfrom,skip_keys=skip_keys,take_keys=take_keys)
+  copyto.completed=False
+  return True
+
+######################################################################
 def separate_jastrow(wffile,optimizebasis=False):
   ''' Seperate the jastrow section of a QWalk wave function file.'''
   # Copied from utils/separate_jastrow TODO: no copy, bad
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+''' Pilot jobs: long-lived worker allocations that run manager tasks from a queue in the project directory.
+
+Short tasks (variance optimizations, small molecules) can wait in the batch queue far longer than they run.
+In pilot mode, managers use an autorunner.RunnerPilot, which puts their commands into an SQLite task queue instead of
+submitting them. A few pilot jobs (see `submit_pilots`) run `pilot.py worker`, which claims tasks that fit in its
+cores, runs them in their directories, and records their exit codes, so runners report them like queued jobs.
+
+Workers send heartbeats for the tasks they run. Tasks whose worker stopped (for example, at the end of its
+walltime) are put back into the queue by the next worker that looks for work.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import subprocess as sub
+
+HEARTBEAT=30     # Seconds between heartbeats of a worker.
+STALE=300        # Seconds without heartbeat before a running task is put back in the queue.
+PILOT_PREFIX='pilot-'
+
+SCHEMA=[
+    '''create table if not exists tasks (
+         id integer primary key autoincrement,
+         path text,
+         jobname text,
+         commands text,
+         ncores integer,
+         status text,
+         worker text,
+         submitted real,
+         started real,
+         heartbeat real,
+         finished real,
+         exitcode integer
+       )''',
+    'create index if not exists tasks_status on tasks (status,id)',
+  ]
+
+#######################################################################
+class TaskQueue:
+  ''' Queue of tasks in an SQLite database, shared by runners and workers.
+  A task is 'queued', 'running', 'finished' (exit code 0), or 'failed'.'''
+  def __init__(self,dbfile):
+    self.dbfile=os.path.abspath(dbfile)
+    self._local=threading.local()
+    with self._connection() as conn:
+      for statement in SCHEMA:
+        conn.execute(statement)
+
+  #------------------------------------------------
+  def _connection(self):
+    ''' One connection per thread, since sqlite connections can't be shared between threads.'''
+    conn=getattr(self._local,'conn',None)
+    if conn is None:
+      conn=sqlite3.connect(self.dbfile,timeout=60,isolation_level=None)
+      self._local.conn=conn
+    return conn
+
+  #------------------------------------------------
+  def add(self,path,jobname,commands,ncores):
+    ''' Queue commands (list of str) to run in directory path, needing ncores cores. Returns the task id.'''
+    conn=self._connection()
+    cur=conn.execute('insert into tasks (path,jobname,commands,ncores,status,submitted) values (?,?,?,?,?,?)',
+        (path,jobname,json.dumps(commands),ncores,'queued',time.time()))
+    return cur.lastrowid
+
+  #------------------------------------------------
+  def claim(self,worker,freecores):
+    ''' Take the oldest queued task that fits in freecores, and mark it running by worker.
+    Returns:
+      dict: the task, or None if no task fits.'''
+    conn=self._connection()
+    conn.execute('begin immediate')
+    try:
+      row=conn.execute("select id,path,jobname,commands,ncores from tasks where status='queued' and ncores<=? "
+          "order by id limit 1",(freecores,)).fetchone()
+      if row is not None:
+        now=time.time()
+        conn.execute("update tasks set status='running',worker=?,started=?,heartbeat=? where id=?",
+            (worker,now,now,row[0]))
+      conn.execute('commit')
+    except Exception:
+      conn.execute('rollback')
+      raise
+    if row is None:
+      return None
+    return {'id':row[0],'path':row[1],'jobname':row[2],'commands':json.loads(row[3]),'ncores':row[4]}
+
+  #------------------------------------------------
+  def heartbeat(self,worker):
+    ''' Record that worker is still running its tasks.'''
+    self._connection().execute("update tasks set heartbeat=? where worker=? and status='running'",
+        (time.time(),worker))
+
+  #------------------------------------------------
+  def finish(self,taskid,exitcode):
+    self._connection().execute('update tasks set status=?,exitcode=?,finished=? where id=?',
+        ('finished' if exitcode==0 else 'failed',exitcode,time.time(),taskid))
+
+  #------------------------------------------------
+  def requeue_stale(self,stale=None):
+    ''' Put running tasks without recent heartbeat back in the queue. Returns how many were requeued.'''
+    if stale is None: stale=STALE
+    cur=self._connection().execute("update tasks set status='queued',worker=null "
+        "where status='running' and heartbeat<?",(time.time()-stale,))
+    return cur.rowcount
+
+  #------------------------------------------------
+  def status(self,taskid):
+    ''' Status of a task, or 'unknown'.'''
+    row=self._connection().execute('select status from tasks where id=?',(taskid,)).fetchone()
+    if row is None:
+      return 'unknown'
+    return row[0]
+
+  #------------------------------------------------
+  def count(self,status='queued'):
+    return self._connection().execute('select count(*) from tasks where status=?',(status,)).fetchone()[0]
+
+#######################################################################
+def run_worker(dbfile,ncores,idle=600,lifetime=None,poll=10):
+  ''' Run tasks from the queue until there has been nothing to do for idle seconds.
+  Args:
+    dbfile (str): task queue database.
+    ncores (int): cores this worker may use at once.
+    idle (float): seconds without any task before the worker stops.
+    lifetime (float): seconds after which no new task is started (for example, a bit less than the walltime).
+    poll (float): seconds between looks at the queue.
+  '''
+  queue=TaskQueue(dbfile)
+  worker="%s:%d"%(socket.gethostname(),os.getpid())
+  start=time.time()
+  lastwork=time.time()
+  lastbeat=0
+  running={} # task id -> (process, cores).
+  print("Pilot worker %s with %d cores."%(worker,ncores))
+  while True:
+    now=time.time()
+    for taskid,(proc,cores) in list(running.items()):
+      if proc.poll() is not None:
+        queue.finish(taskid,proc.returncode)
+        print("Task %d finished with exit code %d."%(taskid,proc.returncode))
+        del running[taskid]
+    if now-lastbeat>=HEARTBEAT:
+      queue.heartbeat(worker)
+      lastbeat=now
+
+    accepting=lifetime is None or now-start<lifetime
+    if accepting:
+      queue.requeue_stale()
+      free=ncores-sum(cores for proc,cores in running.values())
+      while free>0:
+        task=queue.claim(worker,free)
+        if task is None:
+          break
+        print("Running task %d in %s."%(task['id'],task['path']))
+        proc=sub.Popen(['/bin/bash','-c','\n'.join(['set -e']+task['commands'])],cwd=task['path'])
+        running[task['id']]=(proc,task['ncores'])
+        free-=task['ncores']
+
+    if len(running)>0:
+      lastwork=now
+    elif not accepting or now-lastwork>=idle:
+      print("Pilot worker %s stopping."%worker)
+      return
+    time.sleep(poll)
+
+#######################################################################
+def submit_pilots(dbfile='pilot.db',npilots=1,queue='batch',walltime='48:00:00',np=16,
+    idle=600,jobname='AGPilot',path=None,prefix=None):
+  ''' Submit pilot jobs that run tasks from the queue in dbfile.
+  Args:
+    dbfile (str): task queue database (in the project directory, visible from the compute nodes).
+    npilots (int): number of pilot jobs.
+    queue (str): batch queue for the pilots.
+    walltime (str): walltime of each pilot. Workers stop taking tasks 10% before it ends.
+    np (int): cores of each pilot (one node).
+    idle (float): seconds a pilot waits for new tasks before ending.
+    jobname (str): name of the pilot jobs.
+    path (str): directory for the qsub file (default: current directory).
+    prefix (list): commands to run before the worker, for example module loads.
+  Returns:
+    list: queue ids of the pilots.
+  '''
+  import submitter
+  if path is None: path=os.getcwd()
+  if prefix is None: prefix=[]
+  seconds=sum(int(x)*60**i for i,x in enumerate(reversed(walltime.split(':'))))
+  qsub=[
+      "#PBS -q %s"%queue,
+      "#PBS -l nodes=1:ppn=%d"%np,
+      "#PBS -l walltime=%s"%walltime,
+      "#PBS -j oe ",
+      "#PBS -N %s "%jobname,
+      "#PBS -o %s.out "%jobname,
+      "cd %s"%path,
+    ] + prefix + [
+      "%s %s worker --db %s --cores %d --idle %g --lifetime %g"%\
+          (sys.executable,os.path.abspath(__file__),os.path.abspath(dbfile),np,idle,0.9*seconds)
+    ]
+  qsubfile=jobname+".qsub"
+  with open(os.path.join(path,qsubfile),'w') as f:
+    f.write('\n'.join(qsub))
+  queueid=[]
+  for i in range(npilots):
+    try:
+      queueid.append(submitter.qsub(qsubfile,path))
+    except sub.CalledProcessError as err:
+      print("submit_pilots : Error submitting job. Check queue settings.\n\t{0}".format(err))
+  print("submit_pilots : Submitted as %s"%queueid)
+  return queueid
+
+#######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Pilot job tools.")
+  subparsers=parser.add_subparsers(dest='command')
+  wparser=subparsers.add_parser('worker',help='Run tasks from the queue.')
+  wparser.add_argument('--db',type=str,default='pilot.db',help='Task queue database.')
+  wparser.add_argument('--cores',type=int,default=os.cpu_count(),help='Cores to use at once.')
+  wparser.add_argument('--idle',type=float,default=600,help='Seconds without tasks before stopping.')
+  wparser.add_argument('--lifetime',type=float,default=None,help='Seconds after which no task is started.')
+  wparser.add_argument('--poll',type=float,default=10,help='Seconds between looks at the queue.')
+  sparser=subparsers.add_parser('status',help='Count tasks in each state.')
+  sparser.add_argument('--db',type=str,default='pilot.db',help='Task queue database.')
+
+  args=parser.parse_args()
+  if args.command=='worker':
+    run_worker(args.db,args.cores,idle=args.idle,lifetime=args.lifetime,poll=args.poll)
+  elif args.command=='status':
+    queue=TaskQueue(args.db)
+    for status in ('queued','running','finished','failed'):
+      print("%s: %d"%(status,queue.count(status)))
+  else:
+    parser.print_help()
@@ -8,8 +8,10 @@ class PropertiesReader:
     self.out={}
 #-------------------------------------------------      
   def collect(self,outfilename):
-    """ Just check that results are there. The actual data is too large to want to store."""
-    if os.path.isfile("GRED.DAT") and os.path.isfile("KRED.DAT"):
+    """ Just check that results are there. The actual data is too large to want to store.
+    GRED.DAT and KRED.DAT are expected next to the output file."""
+    path=os.path.dirname(outfilename)
+    if os.path.isfile(os.path.join(path,"GRED.DAT")) and os.path.isfile(os.path.join(path,"KRED.DAT")):
       self.completed=True
     else:
       self.completed=False
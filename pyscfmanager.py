@@ -1,14 +1,16 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, update_writer
 from autopyscf import PySCFReader,dm_from_chkfile
 from autorunner import PySCFRunnerPBS
 import os
 import shutil as sh 
-import pickle as pkl
+import statecache
+import runtimes
 import pyscf2qwalk
 from autopaths import paths
+from resultcache import cache_key
 
 class PySCFManager:
-  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False):
+  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False,cache=None):
     ''' PySCFManager manages the writing of a PySCF input file, it's running, and keep track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -17,6 +19,7 @@ class PySCFManager:
       name (str): identifier for this job. This names the files associated with run.
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
+      cache (ResultCache): reuse the results of identical calculations from this cache, and store results into it (None implies no cache).
     '''
     # Where to save self.
     self.name=name
@@ -38,6 +41,8 @@ class PySCFManager:
     if runner is not None: self.runner=runner
     else: self.runner=PySCFRunnerPBS()
     self.bundle=bundle
+    self.cache=cache
+    self.result_key=None if cache is None else cache_key(writer)
 
     self.driverfn="%s.py"%name
     self.outfile=self.driverfn+'.o'
@@ -52,125 +57,132 @@ class PySCFManager:
         'slater':{}
       }
     self.completed=False
+    self.input_hash=None # Fingerprint of the writer when the driver was last written.
     self.bundle_ready=False
     self.restarts=0
 
     # Handle old results if present.
     if os.path.exists(self.path+self.pickle):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=statecache.load(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Safe copy options from other to self. '''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
-    updated=update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader', 'path','logname','name','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles'])
+    if other is self:
+      return # Nothing to copy: the state cache handed back this instance.
+    update_attributes(copyto=self,copyfrom=other,
+        skip_keys=['writer','runner','reader', 'path','logname','name','max_restarts','bundle','cache','result_key'],
+        take_keys=['restarts','completed','qwfiles','input_hash'])
 
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
-        take_keys=['queueid'])
+        skip_keys=['queue','walltime','np','nn','jobname','features','priority'],
+        take_keys=['queueid','runtimefile'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
         skip_keys=[],
         take_keys=['completed','output'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
+    update_writer(copyto=self.writer,copyfrom=other.writer,input_hash=self.input_hash,
         skip_keys=['max_cycle'],
         take_keys=['completed','dm_generator'])
-
-    # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
     
   #------------------------------------------------
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
-    # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    with statecache.deferred(self.path+self.pickle):
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
 
-    print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
+      print(self.logname,": next step.")
 
-    if not self.writer.completed:
-      self.writer.pyscf_input(self.driverfn,self.chkfile)
+      if not self.writer.completed:
+        self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
+        self.input_hash=self.writer.fingerprint()
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
-    print(self.logname,": %s status= %s"%(self.name,status))
-
-    if status=="not_started":
-      self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile))
-    elif status=="ready_for_analysis":
-      status=self.reader.collect(self.outfile,self.chkfile)
-      if status=='killed':
-        print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-        sh.copy(self.driverfn,"%d.%s"%(self.restarts,self.driverfn))
-        sh.copy(self.outfile,"%d.%s"%(self.restarts,self.outfile))
-        sh.copy(self.chkfile,"%d.%s"%(self.restarts,self.chkfile))
-        if os.path.exists(self.chkfile):
-          self.writer.dm_generator=dm_from_chkfile("%d.%s"%(self.restarts,self.chkfile))
-        self.writer.pyscf_input(self.driverfn,self.chkfile)
-        self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile))
-        self.restarts+=1
-      elif status=='done':
-        print(self.logname,": %s status= %s, task complete."%(self.name,status))
-
-    # Ready for bundler or else just submit the jobs as needed.
-    if self.bundle:
-      self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile,self.driverfn)
-    else:
-      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']])
+      # Reuse the results of an identical calculation, if there is one and this one hasn't been submitted.
+      if self.cache is not None and resolve_status(self.runner,self.reader,self.path+self.outfile)=='not_started'\
+          and len(getattr(self.runner,'queueid',[]))==0:
+        self.cache.fetch(self.result_key,'pyscf',self.path,self._cache_files(),{'reader':self.reader})
+
+      status=resolve_status(self.runner,self.reader,self.path+self.outfile)
+      print(self.logname,": %s status= %s"%(self.name,status))
+
+      if status=="not_started":
+        self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile))
+      elif status=="ready_for_analysis":
+        status=self.reader.collect(self.path+self.outfile,self.path+self.chkfile)
+        if status=='killed':
+          print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
+          sh.copy(self.path+self.driverfn,self.path+"%d.%s"%(self.restarts,self.driverfn))
+          sh.copy(self.path+self.outfile,self.path+"%d.%s"%(self.restarts,self.outfile))
+          sh.copy(self.path+self.chkfile,self.path+"%d.%s"%(self.restarts,self.chkfile))
+          if os.path.exists(self.path+self.chkfile):
+            self.writer.dm_generator=dm_from_chkfile("%d.%s"%(self.restarts,self.chkfile))
+          self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
+          self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile))
+          self.restarts+=1
+        elif status=='done':
+          print(self.logname,": %s status= %s, task complete."%(self.name,status))
+
+      # Ready for bundler or else just submit the jobs as needed.
+      if self.bundle:
+        self.scriptfile="%s.run"%self.name
+        self.bundle_ready=self.runner.script(self.path+self.scriptfile)
+      else:
+        self.runner.features=runtimes.features(self)
+        qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']],path=self.path)
+
+      self.completed=self.reader.completed
+      if self.completed:
+        runtimes.record(self)
+      if self.cache is not None and self.completed and not self.cache.contains(self.result_key,'pyscf'):
+        self.cache.store(self.result_key,'pyscf',self.path,self._cache_files(),{'reader':self.reader})
+      # Update the file.
+      statecache.save(self,self.path+self.pickle)
 
-    self.completed=self.reader.completed
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+  #------------------------------------------------
+  def _cache_files(self):
+    ''' Files kept in the result cache, keyed by their name in the cache.'''
+    return {'pyscf.o':self.outfile,'chkfile':self.chkfile}
 
   #------------------------------------------------
   def update_queueid(self,qid):
     ''' If a bundler handles the submission, it can update the queue info with this.'''
     self.runner.queueid.append(qid)
+    self.bundle_ready=False # After running, we won't run again without more analysis.
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    self._runready=False # After running, we won't run again without more analysis.
+    statecache.save(self,self.path+self.pickle)
       
   #------------------------------------------------
   def export_qwalk(self):
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
-    # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
-
-    if len(self.qwfiles['slater'])==0:
-      self.nextstep()
-      if not self.completed:
-        return False
-      print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
-      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.chkfile)
-      os.chdir(cwd)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    return True
+    with statecache.deferred(self.path+self.pickle):
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
+
+      if len(self.qwfiles['slater'])==0:
+        self.nextstep()
+        if not self.completed:
+          return False
+        print(self.logname,": %s generating QWalk files."%self.name)
+        self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.path+self.chkfile,path=self.path)
+      statecache.save(self,self.path+self.pickle)
+      return True
 
   #----------------------------------------
   def status(self):
     ''' Determine the course of action based on info from reader and runner.'''
-    current_status = resolve_status(self.runner,self.reader,self.outfile)
+    current_status = resolve_status(self.runner,self.reader,self.path+self.outfile)
     if current_status == 'done':
       return 'ok'
     elif current_status == 'retry':
@@ -0,0 +1,324 @@
+''' Variance optimization, linear optimization, and DMC at several k-points, run one after another in one job.'''
+from manager_tools import resolve_status, update_attributes, update_writer
+from autorunner import RunnerPBS
+from trialfunc import slater_jastrow_section
+from copy import deepcopy
+import os
+import sys
+import json
+import statecache
+from autopaths import paths
+
+#######################################################################
+class QMCPipelineManager:
+  def __init__(self,trialfunc,vwriter,vreader,lwriter,lreader,dwriter,dreader,
+      runner=None,kpoints=None,name='qmc',path=None,bundle=False):
+    ''' QMCPipelineManager runs in one job the QMC stages that otherwise take a QWalkManager and a queue wait each:
+    variance optimization, linear optimization from its Jastrow factor, and DMC with the optimized Jastrow
+    factor at each k-point. All inputs are written beforehand. Between stages, the job checks the optimization
+    with the stage's reader, and extracts its Jastrow factor for the next stage (see chainhook.check).
+    The job stops at the first stage that doesn't pass, and the next step reruns the job from that stage.
+    Args:
+      trialfunc (SlaterJastrow): Slater determinant (slatman) and starting Jastrow factor (jastman).
+      vwriter (VarianceWriter): writer for the variance optimization (None skips it).
+      vreader (VarianceReader): reader for the variance optimization.
+      lwriter (LinearWriter): writer for the linear optimization.
+      lreader (LinearReader): reader for the linear optimization.
+      dwriter (DMCWriter): writer for the DMC runs, copied for each k-point.
+      dreader (DMCReader): reader for the DMC runs, copied for each k-point.
+      runner (Runner object): to run job. Its walltime must cover all the stages.
+      kpoints (list): k-points of the DMC runs, numbered as in SlaterJastrow (None implies trialfunc.kpoint).
+        The optimizations use trialfunc.kpoint.
+      name (str): identifier for this job. This names the files associated with run.
+      path (str): directory where this manager is free to store information.
+      bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
+    '''
+    self.name=name
+    self.pickle="%s.pkl"%(self.name)
+
+    # Ensure path is set up correctly.
+    if path is None:
+      path=os.getcwd()
+    if path[-1]!='/': path+='/'
+    self.path=path
+
+    self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
+
+    self.trialfunc=trialfunc
+    if runner is not None: self.runner=runner
+    else: self.runner=RunnerPBS()
+    self.bundle=bundle
+    if kpoints is None: kpoints=[trialfunc.kpoint]
+    self.kpoints=kpoints
+
+    # Stages in the order they run, with their writers and readers.
+    self.stages=[]
+    self.writers={}
+    self.readers={}
+    if vwriter is not None:
+      self._add_stage('variance',vwriter,vreader)
+    self._add_stage('linear',lwriter,lreader)
+    for kpoint in kpoints:
+      if type(kpoint)==tuple: kname='_'.join(map(str,kpoint))
+      else:                   kname=str(kpoint)
+      self._add_stage('dmc_%s'%kname,deepcopy(dwriter),deepcopy(dreader))
+
+    self.completed=False
+    self.input_hashes={} # Fingerprint of each writer when its input was last written.
+    self.scriptfile=None
+    self.bundle_ready=False
+    self.planfile="%s.plan.json"%self.name
+    # Note: qwfiles stores file names of results, used for exporting trial wave functions.
+    self.qwfiles={
+        'jastrow2':'',
+        'wfout':''
+      }
+
+    # Handle old results if present.
+    if os.path.exists(self.path+self.pickle):
+      print(self.logname,": rebooting old manager.")
+      old=statecache.load(self.path+self.pickle)
+      self.recover(old)
+
+    # Update the file.
+    if not os.path.exists(self.path): os.mkdir(self.path)
+    statecache.save(self,self.path+self.pickle)
+
+  #------------------------------------------------
+  def _add_stage(self,stage,writer,reader):
+    self.stages.append(stage)
+    self.writers[stage]=writer
+    self.readers[stage]=reader
+
+  #------------------------------------------------
+  def infile(self,stage):
+    return "%s_%s"%(self.name,stage)
+
+  #------------------------------------------------
+  def outfile(self,stage):
+    return "%s.o"%self.infile(stage)
+
+  #------------------------------------------------
+  def stdout(self,stage):
+    return "%s.out"%self.infile(stage)
+
+  #------------------------------------------------
+  def wfout(self,stage):
+    return "%s.wfout"%self.infile(stage)
+
+  #------------------------------------------------
+  def jastfile(self,stage):
+    ''' Jastrow factor extracted from the wave function of an optimization stage, by the job itself.'''
+    return "%s.jast"%self.infile(stage)
+
+  #------------------------------------------------
+  def recover(self,other):
+    ''' Recover old class by copying over data. Retain variables from old that may change final answer.'''
+    # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
+    # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    if other is self:
+      return # Nothing to copy: the state cache handed back this instance.
+
+    update_attributes(copyto=self,copyfrom=other,
+        skip_keys=['writers','readers','runner','path','logname','name','bundle','stages','kpoints'],
+        take_keys=['completed','trialfunc','qwfiles','input_hashes'])
+
+    # Update queue settings, but save queue information.
+    update_attributes(copyto=self.runner,copyfrom=other.runner,
+        skip_keys=['queue','walltime','np','nn','jobname','features','priority'],
+        take_keys=['queueid','runtimefile'])
+
+    for stage in self.stages:
+      if stage not in other.stages:
+        continue
+      update_attributes(copyto=self.readers[stage],copyfrom=other.readers[stage],
+          skip_keys=[],
+          take_keys=['completed','output'])
+
+      update_writer(copyto=self.writers[stage],copyfrom=other.writers[stage],input_hash=self.input_hashes.get(stage),
+          skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace'],
+          take_keys=['completed','tmoves','extra_observables','timestep','trialfunc'])
+
+  #------------------------------------------------
+  def _write_inputs(self):
+    ''' Write the inputs of all stages. Each stage starts from the Jastrow factor of the one before.
+    Returns:
+      bool: whether all inputs are written.'''
+    if all(self.writers[stage].completed for stage in self.stages):
+      return True
+
+    print(self.logname,": checking trial function.")
+    slatman,jastman=self.trialfunc.slatman,self.trialfunc.jastman
+    if not (slatman.export_qwalk() and jastman.export_qwalk()):
+      return False
+
+    def slater_files(kpoint):
+      if type(slatman.qwfiles['slater'])==str:
+        sysfile,slater=slatman.qwfiles['sys'],slatman.qwfiles['slater']
+      else:
+        sysfile,slater=slatman.qwfiles['sys'][kpoint],slatman.qwfiles['slater'][kpoint]
+      return os.path.relpath(slatman.path+sysfile,self.path),os.path.relpath(slatman.path+slater,self.path)
+
+    jastrow=os.path.relpath(jastman.path+jastman.qwfiles['jastrow2'],self.path)
+    dmc_kpoints=iter(self.kpoints)
+    for stage in self.stages:
+      writer=self.writers[stage]
+      if writer.qmc_abr=='dmc':
+        sysfile,slater=slater_files(next(dmc_kpoints))
+      else:
+        sysfile,slater=slater_files(self.trialfunc.kpoint)
+      if not writer.completed:
+        writer.trialfunc=slater_jastrow_section(sysfile,slater,jastrow)
+        writer.qwalk_input(self.path+self.infile(stage))
+        if writer.completed:
+          self.input_hashes[stage]=writer.fingerprint()
+      if writer.qmc_abr!='dmc':
+        jastrow=self.jastfile(stage)
+    return all(self.writers[stage].completed for stage in self.stages)
+
+  #------------------------------------------------
+  def _current_stage(self):
+    ''' First stage that isn't finished, or None.'''
+    for stage in self.stages:
+      if not self.readers[stage].completed:
+        return stage
+    return None
+
+  #------------------------------------------------
+  def status_inputs(self):
+    ''' The runner, reader, and output file name that determine the status of the current stage
+    (see manager_tools.status_inputs). The last stage once all are finished.'''
+    stage=self._current_stage()
+    if stage is None:
+      stage=self.stages[-1]
+    return self.runner,self.readers[stage],self.outfile(stage)
+
+  #------------------------------------------------
+  def _write_plan(self):
+    ''' What the job needs to check the optimization stages (see chainhook.check).'''
+    plan={}
+    for stage in self.stages:
+      if self.writers[stage].qmc_abr=='dmc':
+        continue
+      reader=self.readers[stage]
+      plan[stage]={
+          'reader':reader.__class__.__name__,
+          'params':{key:value for key,value in reader.__dict__.items() if key not in ('output','completed')},
+          'outfile':self.outfile(stage),
+          'wfout':self.wfout(stage),
+          'jastout':self.jastfile(stage)
+        }
+    with open(self.path+self.planfile,'w') as outf:
+      json.dump(plan,outf,indent=1)
+
+  #------------------------------------------------
+  def _add_stages(self,first):
+    ''' Run the stages from first on. Older outputs of these stages are removed, so they aren't mistaken for new ones.'''
+    todo=self.stages[self.stages.index(first):]
+    hook=os.path.join(os.path.dirname(os.path.abspath(__file__)),'chainhook.py')
+    self._write_plan()
+    self.runner.add_command("rm -f %s"%' '.join([self.outfile(stage) for stage in todo]))
+    for stage in todo:
+      self.readers[stage].completed=False
+      self.runner.add_task("%s %s &> %s"%(paths['qwalk'],self.infile(stage),self.stdout(stage)))
+      if self.writers[stage].qmc_abr!='dmc':
+        self.runner.add_command("%s %s check %s %s || exit 1"%(sys.executable,hook,self.planfile,stage))
+    print(self.logname,": stages %s submitted."%', '.join(todo))
+
+  #------------------------------------------------
+  def nextstep(self):
+    ''' Perform next step in calculation. trialfunc managers are updated if they aren't completed yet.'''
+    with statecache.deferred(self.path+self.pickle):
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
+
+      print(self.logname,": next step.")
+
+      if self._write_inputs():
+        current=self._current_stage()
+        if current is not None:
+          status=resolve_status(self.runner,self.readers[current],self.path+self.outfile(current))
+          print(self.logname,": %s status= %s"%(current,status))
+          if status=="not_started":
+            self._add_stages(current)
+          elif status=="ready_for_analysis":
+            # Collect the stages the job got through, and rerun from the first that didn't pass.
+            for stage in self.stages[self.stages.index(current):]:
+              if not os.path.exists(self.path+self.outfile(stage)):
+                break
+              status=self.readers[stage].collect(self.path+self.outfile(stage))
+              print(self.logname,": %s status= %s"%(stage,status))
+              if status!='ok':
+                break
+            current=self._current_stage()
+            if current is not None:
+              print(self.logname,": %s attempting rerun."%current)
+              self._add_stages(current)
+        if current is None:
+          print(self.logname,": all stages complete.")
+          self.completed=True
+
+      # Ready for bundler or else just submit the jobs as needed.
+      if self.bundle:
+        self.scriptfile="%s.run"%self.name
+        self.bundle_ready=self.runner.script(self.path+self.scriptfile)
+      else:
+        qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,path=self.path)
+
+      # Update the file.
+      statecache.save(self,self.path+self.pickle)
+
+  #------------------------------------------------
+  def update_queueid(self,qid):
+    ''' If a bundler handles the submission, it can update the queue info with this.
+    Args:
+      qid (str): new queue id from submitting a job. The Manager will check if this is running.
+    '''
+    self.runner.queueid.append(qid)
+    self.bundle_ready=False # After running, we won't run again without more analysis.
+
+    # Update the file.
+    statecache.save(self,self.path+self.pickle)
+
+  #----------------------------------------
+  def status(self):
+    ''' Check if this Manager has completed all it's tasks.
+    Returns:
+      str: 'ok' or 'not_finished'.
+    '''
+    if self.completed:
+      return 'ok'
+    else:
+      return 'not_finished'
+
+  #----------------------------------------
+  def collect(self):
+    ''' Call the collect routine for readers of the stages with output.'''
+    print(self.logname,": collecting results.")
+    for stage in self.stages:
+      if os.path.exists(self.path+self.outfile(stage)):
+        self.readers[stage].collect(self.path+self.outfile(stage))
+
+    # Update the file.
+    statecache.save(self,self.path+self.pickle)
+
+  #----------------------------------------
+  def export_qwalk(self):
+    ''' Store the wave function of the linear optimization into self.qwfiles['wfout'], and its Jastrow factor
+    (extracted by the job) into self.qwfiles['jastrow2'].
+    Returns:
+      bool: Whether it was successful.'''
+    with statecache.deferred(self.path+self.pickle):
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
+
+      if self.qwfiles['wfout']=='':
+        self.nextstep()
+        if not self.readers['linear'].completed:
+          return False
+        print(self.logname,": %s generating QWalk files."%self.name)
+        self.qwfiles['wfout']=self.wfout('linear')
+        self.qwfiles['jastrow2']=self.jastfile('linear')
+
+      statecache.save(self,self.path+self.pickle)
+      return True
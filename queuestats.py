@@ -0,0 +1,195 @@
+''' Optional queue telemetry, and a queue chooser that uses it.
+
+When an advisor is open (see `use`), every qsub is recorded with its queue and node count, and the
+queue snapshots taken by submitter (see submitter.queue_snapshot) mark when each job starts running.
+The submit-to-start latencies are kept in an SQLite database, so they build up over many drivers.
+
+Runners with queue='auto' ask the advisor for a queue (see `queue`). It expects the wait in each queue
+to be the median of recent waits there for similar node counts, but at least as long as our oldest
+job still waiting in it, and picks the queue where the job would finish first.
+'''
+import os
+import time
+import sqlite3
+import threading
+
+DEFAULT_QUEUE='batch' # Queue of 'auto' runners when no advisor is open.
+GRACE=60 # Seconds after submission during which a job missing from a snapshot is not taken to have started.
+
+SCHEMA=[
+    '''create table if not exists waits (
+         queueid text primary key,
+         queue text,
+         nn integer,
+         submitted real,
+         started real
+       )''',
+    'create index if not exists waits_queue on waits (queue,started)',
+  ]
+
+#######################################################################
+def read_request(qsubfile):
+  ''' Queue and number of nodes requested in a qsub file, or (None, None).'''
+  queue,nn=None,None
+  try:
+    with open(qsubfile,'r') as inpf:
+      for line in inpf:
+        spl=line.split()
+        if len(spl)<3 or spl[0]!='#PBS':
+          continue
+        if spl[1]=='-q':
+          queue=spl[2]
+        elif spl[1]=='-l' and spl[2].startswith('nodes='):
+          nodes=spl[2][len('nodes='):].split(':')[0].split(',')[0]
+          if nodes.isdigit():
+            nn=int(nodes)
+  except OSError:
+    pass
+  return queue,nn
+
+#######################################################################
+class QueueAdvisor:
+  ''' Submit-to-start latencies of our jobs in each queue, and a queue chooser based on them.'''
+  def __init__(self,dbfile,queues,default_wait=3600,window=20):
+    '''
+    Args:
+      dbfile (str): SQLite database of the latencies.
+      queues (dict): queues that may be chosen, with their limits: for example
+        {'batch':{'max_nodes':64,'max_walltime':'48:00:00'},'secondary':{'max_walltime':'4:00:00'}}.
+      default_wait (float): expected wait in seconds in a queue without recorded waits.
+      window (int): number of recent waits the expected wait is taken from.
+    '''
+    self.dbfile=os.path.abspath(dbfile)
+    self.queues=queues
+    self.default_wait=default_wait
+    self.window=window
+    self.live={} # Queue -> seconds our oldest job still waiting there has waited, from the last snapshot.
+    self._local=threading.local()
+    with self._connection() as conn:
+      for statement in SCHEMA:
+        conn.execute(statement)
+
+  #------------------------------------------------
+  def _connection(self):
+    ''' One connection per thread, since sqlite connections can't be shared between threads.'''
+    conn=getattr(self._local,'conn',None)
+    if conn is None:
+      conn=sqlite3.connect(self.dbfile,timeout=60)
+      self._local.conn=conn
+    return conn
+
+  #------------------------------------------------
+  def submitted(self,queueid,queue,nn):
+    ''' Record the submission of a job.'''
+    with self._connection() as conn:
+      conn.execute('insert or replace into waits (queueid,queue,nn,submitted) values (?,?,?,?)',
+          (queueid,queue,nn,time.time()))
+
+  #------------------------------------------------
+  def observe(self,jobs):
+    ''' Mark the jobs that have started since the last snapshot, and update the live waits.
+    Jobs that left the queue before a snapshot saw them running are taken to have started now.
+    Held and waiting jobs ('H', 'W', for example behind afterok dependencies) aren't waiting for the queue:
+    their wait is counted from the last snapshot that saw them held.
+    Args:
+      jobs (dict): queue snapshot, as parsed by submitter.parse_qstat.
+    '''
+    now=time.time()
+    live={}
+    with self._connection() as conn:
+      waiting=conn.execute('select queueid,queue,submitted from waits where started is null').fetchall()
+      for queueid,queue,submitted in waiting:
+        job=jobs.get(queueid,jobs.get(queueid+'[]')) # Job arrays are listed as <id>[].
+        state=job['state'] if job is not None else None
+        if state in ('Q','T'):
+          live[queue]=max(live.get(queue,0),now-submitted)
+        elif state in ('H','W'):
+          conn.execute('update waits set submitted=? where queueid=?',(now,queueid))
+        elif state is None and now-submitted<GRACE:
+          continue # The snapshot may predate the submission.
+        else:
+          conn.execute('update waits set started=? where queueid=?',(now,queueid))
+    self.live=live
+
+  #------------------------------------------------
+  def expected_wait(self,queue,nn):
+    ''' Expected seconds between submission and start of a job of nn nodes in queue.'''
+    conn=self._connection()
+    rows=conn.execute('select started-submitted from waits where queue=? and started is not null '
+        'and nn between ? and ? order by started desc limit ?',(queue,(nn+1)//2,2*nn,self.window)).fetchall()
+    if len(rows)==0:
+      rows=conn.execute('select started-submitted from waits where queue=? and started is not null '
+          'order by started desc limit ?',(queue,self.window)).fetchall()
+    if len(rows)==0:
+      wait=self.default_wait
+    else:
+      waits=sorted(row[0] for row in rows)
+      wait=waits[len(waits)//2]
+    return max(wait,self.live.get(queue,0))
+
+  #------------------------------------------------
+  def choose(self,nn,walltime):
+    ''' Queue where a job of nn nodes and walltime (str) is expected to finish first, among the queues whose
+    limits allow it. Returns None if none does.'''
+    import submitter
+    seconds=submitter.walltime_seconds(walltime)
+    best,besttime=None,None
+    for queue,limits in self.queues.items():
+      if nn>limits.get('max_nodes',nn):
+        continue
+      if 'max_walltime' in limits and seconds>submitter.walltime_seconds(limits['max_walltime']):
+        continue
+      finish=self.expected_wait(queue,nn)+seconds
+      if besttime is None or finish<besttime:
+        best,besttime=queue,finish
+    return best
+
+#######################################################################
+_active=None
+
+#----------------------------------------------------------------------
+def use(dbfile,queues=None,**kwargs):
+  ''' Open the advisor with latencies in dbfile, choosing among queues (see QueueAdvisor), and record
+  submissions into it from now on (None stops recording).'''
+  global _active
+  if dbfile is None:
+    _active=None
+  else:
+    if queues is None: queues={DEFAULT_QUEUE:{}}
+    _active=QueueAdvisor(dbfile,queues,**kwargs)
+  return _active
+
+#----------------------------------------------------------------------
+def active():
+  ''' The open advisor, or None.'''
+  return _active
+
+#----------------------------------------------------------------------
+def submitted(queueid,qsubfile):
+  ''' Record the submission of qsubfile as queueid into the open advisor, if there is one.'''
+  if _active is None:
+    return
+  queue,nn=read_request(qsubfile)
+  if queue is not None:
+    _active.submitted(queueid,queue,nn if nn is not None else 1)
+
+#----------------------------------------------------------------------
+def observe(jobs):
+  ''' Update the open advisor, if there is one, with a queue snapshot.'''
+  if _active is not None and jobs is not None:
+    _active.observe(jobs)
+
+#----------------------------------------------------------------------
+def queue(runner,walltime):
+  ''' Queue to submit a runner's job to: its own, or, for queue='auto', the choice of the open advisor
+  (DEFAULT_QUEUE if there is none or no queue fits).'''
+  if runner.queue!='auto':
+    return runner.queue
+  chosen=None
+  if _active is not None:
+    chosen=_active.choose(runner.nn,walltime)
+  if chosen is None:
+    print(runner.__class__.__name__,": no queue advice, submitting to %s."%DEFAULT_QUEUE)
+    return DEFAULT_QUEUE
+  print(runner.__class__.__name__,": submitting to %s."%chosen)
+  return chosen
@@ -1,13 +1,18 @@
-from manager_tools import resolve_status, update_attributes, separate_jastrow
+from manager_tools import resolve_status, update_attributes, update_writer, separate_jastrow
 from autorunner import RunnerPBS
 import os
-import pickle as pkl
+import sys
+import json
+import submitter
+import chainhook
+import statecache
+import runtimes
 from autopaths import paths
 
 #######################################################################
 class QWalkManager:
   def __init__(self,writer,reader,runner=None,trialfunc=None,
-      name='qw_run',path=None,bundle=False):
+      name='qw_run',path=None,bundle=False,chain=False):
     ''' QWalkManager managers the writing of a QWalk input files, it's running, and keeping track of the results.
     Args:
       writer (qwalk writer): writer for input.
@@ -18,6 +23,9 @@ class QWalkManager:
       name (str): identifier for this job. This names the files associated with run.
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
+      chain (bool): submit ahead of time. The job extracts its own Jastrow factor when it ends, so jobs using it
+        can be queued behind it (see chain_ids), and this job is queued behind queued chain managers of its
+        trial function, with PBS afterok dependencies. Ignored when bundling.
       qwalk (str): absolute path to qwalk executible.
     '''
     self.name=name
@@ -25,7 +33,7 @@ class QWalkManager:
 
     # Ensure path is set up correctly.
     if path is None:
-      path=os.path.getcwd()
+      path=os.getcwd()
     if path[-1]!='/': path+='/'
     self.path=path
 
@@ -39,10 +47,13 @@ class QWalkManager:
     if runner is not None: self.runner=runner
     else: self.runner=RunnerPBS()
     self.bundle=bundle
+    self.chain=chain
 
     self.completed=False
+    self.input_hash=None # Fingerprint of the writer when the input was last written.
     self.scriptfile=None
     self.bundle_ready=False
+    self.chained=[] # Queue ids of the jobs the trial function was exported ahead of.
     self.infile=name
     self.outfile="%s.o"%self.infile
     # Note: qwfiles stores file names of results, used for exporting trial wave functions.
@@ -55,91 +66,165 @@ class QWalkManager:
     # Handle old results if present.
     if os.path.exists(self.path+self.pickle):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=statecache.load(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Recover old class by copying over data. Retain variables from old that may change final answer.'''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    if other is self:
+      return # Nothing to copy: the state cache handed back this instance.
 
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader','path','logname','name','bundle'],
-        take_keys=['restarts','completed','trialfunc','qwfiles'])
+        skip_keys=['writer','runner','reader','path','logname','name','bundle','chain'],
+        take_keys=['restarts','completed','trialfunc','qwfiles','input_hash','chained'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
-        take_keys=['queueid'])
+        skip_keys=['queue','walltime','np','nn','jobname','features','priority'],
+        take_keys=['queueid','runtimefile'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
         skip_keys=[],
         take_keys=['completed','output'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
+    update_writer(copyto=self.writer,copyfrom=other.writer,input_hash=self.input_hash,
         skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace'],
         take_keys=['completed','tmoves','extra_observables','timestep','trialfunc'])
-    if updated:
-      self.writer.completed=False
 
   #------------------------------------------------
   def nextstep(self):
     ''' Perform next step in calculation. trialfunc managers are updated if they aren't completed yet.'''
-    # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    with statecache.deferred(self.path+self.pickle):
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
 
-    print(self.logname,": next step.")
+      print(self.logname,": next step.")
 
-    # Check dependency is completed first.
-    if self.writer.trialfunc=='':
-      print(self.logname,": checking trial function.")
-      self.writer.trialfunc=self.trialfunc.export(self.path)
+      # A job queued behind jobs that failed is removed by the scheduler, and the trial function must be redone.
+      if self._chain_broken():
+        print(self.logname,": chained job didn't run, exporting the trial function again.")
+        self.writer.trialfunc=''
+        self.writer.completed=False
+        self.chained=[]
 
-    # Work on this job.
-    cwd=os.getcwd()
-    os.chdir(self.path)
+      # Check dependency is completed first.
+      if self.writer.trialfunc=='':
+        print(self.logname,": checking trial function.")
+        if self.chain and not self.bundle:
+          self.writer.trialfunc,self.chained=self.trialfunc.export_chained(self.path)
+        else:
+          self.writer.trialfunc=self.trialfunc.export(self.path)
 
-    # Write the input file.
-    if not self.writer.completed:
-      self.writer.qwalk_input(self.infile)
+      # Write the input file.
+      if not self.writer.completed:
+        self.writer.qwalk_input(self.path+self.infile)
+        if self.writer.completed:
+          self.input_hash=self.writer.fingerprint()
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
-    print(self.logname,": %s status= %s"%(self.name,status))
-    if status=="not_started" and self.writer.completed:
-      exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-      self.runner.add_task(exestr)
-      print(self.logname,": %s status= submitted"%(self.name))
-    elif status=="ready_for_analysis":
-      #This is where we (eventually) do error correction and resubmits
-      status=self.reader.collect(self.outfile)
-      if status=='ok':
-        print(self.logname,": %s status= %s, task complete."%(self.name,status))
-        self.completed=True
-      else:
-        print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
+      status=resolve_status(self.runner,self.reader,self.path+self.outfile)
+      print(self.logname,": %s status= %s"%(self.name,status))
+      if status=="not_started" and self.writer.completed:
         exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
         self.runner.add_task(exestr)
-    elif status=='done':
-      self.completed=True
+        self._add_hook()
+        if len(self.chained)>0 and not self.bundle:
+          self.runner.depend=list(self.chained)
+        print(self.logname,": %s status= submitted"%(self.name))
+      elif status=="ready_for_analysis":
+        #This is where we (eventually) do error correction and resubmits
+        status=self.reader.collect(self.path+self.outfile)
+        if status=='ok':
+          print(self.logname,": %s status= %s, task complete."%(self.name,status))
+          self.completed=True
+        else:
+          print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
+          exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
+          self.runner.add_task(exestr)
+          self._add_hook()
+      elif status=='done':
+        self.completed=True
+      if self.completed:
+        self.chained=[]
 
-    # Ready for bundler or else just submit the jobs as needed.
-    if self.bundle:
-      self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile)
-    else:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+      # Ready for bundler or else just submit the jobs as needed.
+      if self.bundle:
+        self.scriptfile="%s.run"%self.name
+        self.bundle_ready=self.runner.script(self.path+self.scriptfile)
+      else:
+        self.runner.features=runtimes.features(self)
+        qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,path=self.path)
+      if self.completed:
+        runtimes.record(self)
 
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+      # Update the file.
+      statecache.save(self,self.path+self.pickle)
+
+  #------------------------------------------------
+  def _add_hook(self):
+    ''' Have the job of a chain manager check its results with its reader and extract its Jastrow factor when
+    QWalk is done (see chainhook.check). The job fails if the run didn't pass, so jobs queued behind it with
+    afterok are not run. Readers chainhook doesn't know only get the Jastrow factor extracted.'''
+    if not self.chain or self.bundle or self.writer.qmc_abr=='dmc':
+      return
+    hook=os.path.join(os.path.dirname(os.path.abspath(__file__)),'chainhook.py')
+    qwfiles=self.chain_qwfiles()
+    readername=self.reader.__class__.__name__
+    if readername not in chainhook.READERS:
+      self.runner.add_command("%s %s jastrow %s %s || exit 1"%(sys.executable,hook,qwfiles['wfout'],qwfiles['jastrow2']))
+      return
+    planfile="%s.plan.json"%self.infile
+    plan={self.name:{
+        'reader':readername,
+        'params':{key:value for key,value in self.reader.__dict__.items() if key not in ('output','completed')},
+        'outfile':self.outfile,
+        'wfout':qwfiles['wfout'],
+        'jastout':qwfiles['jastrow2']
+      }}
+    with open(self.path+planfile,'w') as outf:
+      json.dump(plan,outf,indent=1)
+    self.runner.add_command("%s %s check %s %s || exit 1"%(sys.executable,hook,planfile,self.name))
+
+  #------------------------------------------------
+  def _chain_broken(self):
+    ''' Whether the job queued behind the chained jobs left the queue without running.
+    Not if the queue state is unknown (qstat failed), since the job may still be waiting.'''
+    if len(self.chained)==0 or self.reader.completed or os.path.exists(self.path+self.outfile):
+      return False
+    jobs=submitter.queue_snapshot()
+    if jobs is None:
+      return False
+    return self.runner.status_from_snapshot(jobs)!='running'
+
+  #------------------------------------------------
+  def chain_ids(self):
+    ''' Queue ids of this manager's jobs that are in the queue, and that jobs using its results can be
+    submitted behind with afterok ([] if it isn't a chain manager, or has nothing queued).'''
+    if not self.chain or self.bundle:
+      return []
+    with statecache.deferred(self.path+self.pickle):
+      # This may be a stale copy (held by a trial function), and the manager may be stepping in another thread.
+      self.recover(statecache.load(self.path+self.pickle))
+      if self.completed or self.reader.completed:
+        return []
+      jobs=submitter.queue_snapshot()
+      if jobs is None:
+        return []
+      return [qid for qid in self.runner.queueid if qid in jobs and jobs[qid]['state'] in submitter.ACTIVE_STATES]
 
-    os.chdir(cwd)
+  #------------------------------------------------
+  def chain_qwfiles(self):
+    ''' The files of qwfiles, as written by the job itself when it ends.'''
+    return {
+        'wfout':"%s.wfout"%self.infile,
+        'jastrow2':"%s.jast"%self.infile
+      }
 
   #------------------------------------------------
   def update_queueid(self,qid):
@@ -148,11 +233,10 @@ class QWalkManager:
       qid (str): new queue id from submitting a job. The Manager will check if this is running.
     '''
     self.runner.queueid.append(qid)
-    self._runready=False # After running, we won't run again without more analysis.
+    self.bundle_ready=False # After running, we won't run again without more analysis.
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #----------------------------------------
   def status(self):
@@ -172,35 +256,31 @@ class QWalkManager:
     self.reader.collect(self.path+self.outfile)
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    statecache.save(self,self.path+self.pickle)
 
   #----------------------------------------
   def export_qwalk(self):
     ''' Store resulting wave function into self.qwfiles['wfout']. Extract Jastrow and store in self.qwfiles['jastrow2']
     Returns:
       bool: Whether it was successful.'''
-    # Theoretically more than just Jastrow can be provided, but practically that's the only type of wavefunction we tend to export.
-
-    # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
-
-    assert self.writer.qmc_abr!='dmc',"DMC doesn't provide a wave function."
-
-    if self.qwfiles['wfout']=='':
-      self.nextstep()
-      if not self.completed:
-        return False
-      print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
-      self.qwfiles['wfout']="%s.wfout"%self.infile
-      newjast=separate_jastrow(self.qwfiles['wfout'])
-      self.qwfiles['jastrow2']="%s.jast"%self.infile
-      with open(self.qwfiles['jastrow2'],'w') as outf:
-        outf.write(newjast)
-      os.chdir(cwd)
-
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    return True
+    with statecache.deferred(self.path+self.pickle):
+      # Theoretically more than just Jastrow can be provided, but practically that's the only type of wavefunction we tend to export.
+
+      # Recover old data.
+      self.recover(statecache.load(self.path+self.pickle))
+
+      assert self.writer.qmc_abr!='dmc',"DMC doesn't provide a wave function."
+
+      if self.qwfiles['wfout']=='':
+        self.nextstep()
+        if not self.completed:
+          return False
+        print(self.logname,": %s generating QWalk files."%self.name)
+        self.qwfiles['wfout']="%s.wfout"%self.infile
+        newjast=separate_jastrow(self.path+self.qwfiles['wfout'])
+        self.qwfiles['jastrow2']="%s.jast"%self.infile
+        with open(self.path+self.qwfiles['jastrow2'],'w') as outf:
+          outf.write(newjast)
+
+      statecache.save(self,self.path+self.pickle)
+      return True
@@ -1,7 +1,6 @@
 from __future__ import print_function
 import os
 import numpy as np
-import subprocess as sub
 import shutil
 import submitter
 
@@ -59,7 +58,16 @@ class QWalkRunnerPBS:
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_stati(self.queueid)
+    return self.status_from_snapshot(submitter.queue_snapshot())
+
+  #-------------------------------------
+  def status_from_snapshot(self,jobs):
+    ''' Status of this runner's jobs given a queue snapshot (None if unknown). Prunes finished jobs.'''
+    if jobs is None:
+      return 'unknown'
+    status=submitter.stati_from_snapshot(self.queueid,jobs)
+    self.queueid=submitter.prune_queueid(self.queueid,jobs)
+    return status
   #-------------------------------------
 
   def run(self,qwinps,qwouts,jobname=None):
@@ -85,6 +93,5 @@ class QWalkRunnerPBS:
       qsubfile=qwinp+".qsub"
       with open(qsubfile,'w') as f:
         f.write(qsub)
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
+      self.queueid.append(submitter.qsub(qsubfile))
       print("Submitted as %s"%self.queueid)
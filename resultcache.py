@@ -0,0 +1,157 @@
+''' Optional cache of finished calculations, shared between directories and projects.
+
+Entries are keyed by the class and fingerprint of a writer (see `fingerprint` in the writers) and its starting guess,
+so two managers set up with the same inputs in different directories share one entry.
+An entry is a directory holding the output files of the calculation and the state of its readers.
+A manager given a cache (the `cache` argument of CrystalManager and PySCFManager) stores its results once
+they are finished, and a new manager whose inputs match an entry links the files into its own directory
+and takes the reader state instead of submitting anything.
+
+Cached files are read-only: they may be hard links shared by several directories.
+'''
+import os
+import stat
+import hashlib
+import shutil as sh
+import pickle as pkl
+import threading
+
+#######################################################################
+def cache_key(writer,path=''):
+  ''' Key of the entry for calculations set up by writer.
+  The fingerprint leaves out the starting guess, so it is added to the key: the contents of a CRYSTAL guess
+  (guess_fort, relative to path), or a PySCF guess set by the user (see guess_fingerprint in autopyscf).
+  Returns None if the guess can't be read yet: such calculations aren't cached.'''
+  key="%s-%s"%(writer.__class__.__name__,writer.fingerprint())
+  if hasattr(writer,'guess_fingerprint'):
+    guess=writer.guess_fingerprint()
+    if guess is not None:
+      key="%s-%s"%(key,guess)
+  guess=getattr(writer,'guess_fort',None)
+  if guess is None:
+    return key
+  try:
+    with open(os.path.join(path,guess),'rb') as inpf:
+      return "%s-%s"%(key,hashlib.sha1(inpf.read()).hexdigest())
+  except OSError:
+    return None
+
+#######################################################################
+class ResultCache:
+  ''' Directory of finished calculations, addressed by writer fingerprint.'''
+  def __init__(self,root,link='hard'):
+    '''
+    Args:
+      root (str): directory of the cache. Can be shared between projects (and users, with group permissions).
+      link (str): how to put cached files into a manager's directory: 'hard' (hard links, falling back to
+        symbolic links across file systems) or 'symbolic'.
+    '''
+    assert link in ('hard','symbolic'),"link should be 'hard' or 'symbolic'."
+    self.root=os.path.abspath(root)
+    self.link=link
+    self._lock=threading.Lock()
+    if not os.path.exists(self.root): os.makedirs(self.root)
+
+  #------------------------------------------------
+  def __getstate__(self):
+    # Locks can't be pickled, and managers keep their cache.
+    state=self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  #------------------------------------------------
+  def __setstate__(self,state):
+    self.__dict__.update(state)
+    self._lock=threading.Lock()
+
+  #------------------------------------------------
+  def entry(self,key):
+    ''' Directory of the entry for key.'''
+    return os.path.join(self.root,key[-2:],key)
+
+  #------------------------------------------------
+  def _read_results(self,key):
+    try:
+      with open(os.path.join(self.entry(key),'results.pkl'),'rb') as inpf:
+        return pkl.load(inpf)
+    except (OSError,EOFError,pkl.UnpicklingError):
+      return {}
+
+  #------------------------------------------------
+  def contains(self,key,stage):
+    ''' Whether stage (for example 'crystal' or 'properties') of the calculation for key is cached.'''
+    return stage in self._read_results(key)
+
+  #------------------------------------------------
+  def store(self,key,stage,path,files,readers):
+    ''' Add the results of a finished stage to the entry for key.
+    Args:
+      key (str): key of the calculation (see cache_key).
+      stage (str): name of the stage, for example 'crystal'.
+      path (str): directory of the manager.
+      files (dict): file names in path to cache, keyed by their name in the entry (files missing from path are skipped).
+      readers (dict): readers whose state to cache, keyed by attribute name.
+    '''
+    entry=self.entry(key)
+    with self._lock:
+      if not os.path.exists(entry): os.makedirs(entry)
+      stored={}
+      for name,fname in files.items():
+        src=os.path.join(path,fname)
+        if not os.path.exists(src):
+          continue
+        tmpfn=os.path.join(entry,'.%s.tmp'%name)
+        sh.copyfile(src,tmpfn)
+        os.chmod(tmpfn,stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+        os.replace(tmpfn,os.path.join(entry,name))
+        stored[name]=fname
+
+      results=self._read_results(key)
+      results[stage]={
+          'files':sorted(stored),
+          'readers':{attr:reader.__dict__ for attr,reader in readers.items()}
+        }
+      tmpfn=os.path.join(entry,'.results.pkl.tmp')
+      with open(tmpfn,'wb') as outf:
+        pkl.dump(results,outf)
+      os.replace(tmpfn,os.path.join(entry,'results.pkl'))
+    print(self.__class__.__name__,": stored %s results of %s."%(stage,path))
+
+  #------------------------------------------------
+  def fetch(self,key,stage,path,files,readers):
+    ''' Put the cached results of a stage into a manager's directory.
+    Args:
+      key (str): key of the calculation (see cache_key).
+      stage (str): name of the stage, for example 'crystal'.
+      path (str): directory of the manager.
+      files (dict): file names in path to create, keyed by their name in the entry.
+      readers (dict): readers to update with the cached state, keyed by attribute name.
+    Returns:
+      bool: whether the stage was in the cache.
+    '''
+    results=self._read_results(key)
+    if stage not in results:
+      return False
+    entry=self.entry(key)
+    for name in results[stage]['files']:
+      if name not in files:
+        continue
+      dest=os.path.join(path,files[name])
+      if os.path.lexists(dest):
+        os.remove(dest)
+      self._link(os.path.join(entry,name),dest)
+    for attr,state in results[stage]['readers'].items():
+      if attr in readers:
+        readers[attr].__dict__.update(state)
+    print(self.__class__.__name__,": reused %s results for %s."%(stage,path))
+    return True
+
+  #------------------------------------------------
+  def _link(self,src,dest):
+    if self.link=='hard':
+      try:
+        os.link(src,dest)
+        return
+      except OSError:
+        pass # Different file system.
+    os.symlink(src,dest)
@@ -0,0 +1,271 @@
+''' Optional history of job runtimes, and walltime predictions from it.
+
+PBS runners time their jobs: the job writes its start and end times into <jobname>.runtime (or
+<script>.runtime for bundled scripts), and the runner remembers that file. When a history is open
+(see `use`), managers record the runtime of each finished job together with features of the calculation
+(manager and writer type, atoms, electrons, k-points, basis, blocks, time step, processors) into one SQLite
+database, shared between projects.
+
+Runners with walltime='auto' ask the open history for a walltime (see `walltime`): runtimes of similar past
+jobs are fitted by least squares in the logs of the features, or, with few past jobs, taken from the nearest
+ones, scaled to the number of processors.
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from crystal2qmc import periodic_table
+import submitter
+
+DEFAULT_WALLTIME='48:00:00' # Walltime of 'auto' runners when there is no history to go on.
+SAFETY=1.5                  # Factor between predicted runtime and requested walltime.
+MIN_WALLTIME=600            # Shortest walltime requested, in seconds.
+NEIGHBORS=3                 # Past jobs used for predictions without enough data for a fit.
+NUMERIC=['natoms','nelectrons','nkpts','nblock','timestep','iterations']
+
+SCHEMA=[
+    '''create table if not exists runtimes (
+         id integer primary key autoincrement,
+         kind text,
+         features text,
+         cores integer,
+         nn integer,
+         runtime real,
+         path text,
+         recorded real
+       )''',
+    'create index if not exists runtimes_kind on runtimes (kind)',
+  ]
+
+#######################################################################
+def _atoms(writer):
+  ''' Element symbols of the system of a writer, or None if the writer doesn't hold the geometry.'''
+  struct=getattr(writer,'struct_input',None)
+  if struct is not None:
+    return [periodic_table[coord[0]%200-1] for coord in struct['coords']]
+  struct=getattr(writer,'struct',None)
+  if struct is not None:
+    return [site['species'][0]['element'] for site in struct['sites']]
+  xyz=getattr(writer,'xyz','')
+  if type(xyz)==str and xyz.strip()!='':
+    return [line.split()[0] for line in xyz.replace(';','\n').split('\n') if line.strip()!='']
+  return None
+
+#----------------------------------------------------------------------
+def features(mgr,stage='runner'):
+  ''' Features of a manager's calculation that its runtime depends on (besides processors).
+  stage is the runner of the job ('runner', or 'prunner' for CRYSTAL properties).
+  Fused CRYSTAL jobs (which also run properties) are their own stage, 'fused'.'''
+  writer=mgr.writer
+  if stage=='runner' and getattr(mgr,'fuse',False):
+    stage='fused'
+  feats={
+      'manager':mgr.__class__.__name__,
+      'writer':writer.__class__.__name__,
+      'stage':stage,
+    }
+  atoms=_atoms(writer)
+  if atoms is not None:
+    feats['natoms']=len(atoms)
+    charges=[periodic_table.index(atom.lower())+1 for atom in atoms if atom.lower() in periodic_table]
+    feats['nelectrons']=sum(charges)-getattr(writer,'charge',0)
+  kmesh=getattr(writer,'kmesh',None)
+  if getattr(writer,'boundary','3d')!='3d':
+    kmesh=None
+  if kmesh is None:
+    kmesh=getattr(writer,'kpts',None)
+  if kmesh is not None:
+    feats['nkpts']=int(np.prod(kmesh))
+  for attr in ('basis','basis_params'):
+    if hasattr(writer,attr):
+      feats['basis']=str(getattr(writer,attr))
+  for attr in ('nblock','timestep'):
+    if hasattr(writer,attr):
+      feats[attr]=getattr(writer,attr)
+  if hasattr(writer,'iterations'):
+    feats['iterations']=writer.iterations*getattr(writer,'macro_iterations',1)
+  return feats
+
+#----------------------------------------------------------------------
+def kind(feats):
+  ''' Jobs are only compared with jobs of the same kind: same manager, writer, basis, and stage.'''
+  return '/'.join([feats.get(key,'') for key in ('manager','writer','basis','stage')])
+
+#----------------------------------------------------------------------
+def cores(ppn,nn):
+  ''' Processors of a job, or None for 'allprocs'.'''
+  if ppn=='allprocs':
+    return None
+  return ppn*nn
+
+#----------------------------------------------------------------------
+def _log(value):
+  return float(np.log(max(float(value),1e-10)))
+
+#######################################################################
+def timing_lines(runtimefile):
+  ''' Commands to put before and after the commands of a job, to record its runtime in runtimefile.'''
+  return ['echo "start $(date +%%s)" > %s'%runtimefile],['echo "end $(date +%%s)" >> %s'%runtimefile]
+
+#----------------------------------------------------------------------
+def read_runtime(runtimefile):
+  ''' Seconds between start and end in a runtime file, or None if the job hasn't finished.'''
+  stamps={}
+  try:
+    with open(runtimefile,'r') as inpf:
+      for line in inpf:
+        words=line.split()
+        if len(words)==2:
+          stamps[words[0]]=float(words[1])
+  except (OSError,ValueError):
+    return None
+  if 'start' not in stamps or 'end' not in stamps:
+    return None
+  return stamps['end']-stamps['start']
+
+#######################################################################
+class RuntimeHistory:
+  ''' Runtimes of finished jobs in an SQLite database.'''
+  def __init__(self,dbfile):
+    self.dbfile=os.path.abspath(dbfile)
+    self._local=threading.local()
+    with self._connection() as conn:
+      for statement in SCHEMA:
+        conn.execute(statement)
+
+  #------------------------------------------------
+  def _connection(self):
+    ''' One connection per thread, since sqlite connections can't be shared between threads.'''
+    conn=getattr(self._local,'conn',None)
+    if conn is None:
+      conn=sqlite3.connect(self.dbfile,timeout=60)
+      self._local.conn=conn
+    return conn
+
+  #------------------------------------------------
+  def record(self,feats,ppn,nn,runtime,path=''):
+    ''' Add the runtime (seconds) of a finished job with features feats, run on ppn processors per node and nn nodes.'''
+    with self._connection() as conn:
+      conn.execute('insert into runtimes (kind,features,cores,nn,runtime,path,recorded) values (?,?,?,?,?,?,?)',
+          (kind(feats),json.dumps(feats),cores(ppn,nn),nn,runtime,path,time.time()))
+
+  #------------------------------------------------
+  def rows(self,feats):
+    ''' Past jobs of the same kind as feats: (features, cores, runtime) tuples.'''
+    return [(json.loads(f),c,r) for f,c,r in self._connection().execute(
+        'select features,cores,runtime from runtimes where kind=? order by id',(kind(feats),))]
+
+  #------------------------------------------------
+  def predict(self,feats,ppn,nn):
+    ''' Predicted runtime in seconds of a job with features feats on ppn processors per node and nn nodes,
+    or None without similar past jobs.'''
+    rows=self.rows(feats)
+    ncores=cores(ppn,nn)
+    if ncores is not None:
+      rows=[row for row in rows if row[1] is not None]
+    if len(rows)==0:
+      return None
+    names=[name for name in NUMERIC if name in feats and all(name in row[0] for row in rows)]
+
+    def vector(f,c):
+      return [_log(f[name]) for name in names]+([_log(c)] if ncores is not None else [])
+
+    X=np.array([[1.0]+vector(f,c) for f,c,r in rows])
+    y=np.log([max(r,1.0) for f,c,r in rows])
+    x=np.array([1.0]+vector(feats,ncores))
+    if len(rows)>=2*X.shape[1]:
+      coef,res,rank,sv=np.linalg.lstsq(X,y,rcond=None)
+      spread=np.std(y-X.dot(coef))
+      return float(np.exp(x.dot(coef)+2*spread))
+    # Few past jobs: the slowest of the nearest ones, assuming runtime inversely proportional to processors.
+    dist=np.sum((X[:,1:]-x[1:])**2,axis=1)
+    nearest=np.argsort(dist,kind='stable')[:NEIGHBORS]
+    if ncores is None:
+      return float(max(rows[i][2] for i in nearest))
+    return float(max(rows[i][2]*rows[i][1]/ncores for i in nearest))
+
+  #------------------------------------------------
+  def suggest(self,feats,ppn,nn,maximum=None):
+    ''' Walltime string for a job, or None without similar past jobs.
+    Args:
+      maximum (str): longest walltime to suggest, for example the queue limit.
+    '''
+    runtime=self.predict(feats,ppn,nn)
+    if runtime is None:
+      return None
+    seconds=max(runtime*SAFETY,MIN_WALLTIME)
+    if maximum is not None:
+      seconds=min(seconds,submitter.walltime_seconds(maximum))
+    return submitter.format_walltime(seconds)
+
+  #------------------------------------------------
+  def suggest_nodes(self,feats,ppn,walltime,maxnodes=64):
+    ''' Fewest nodes (with ppn processors each) for which the job is predicted to finish within walltime,
+    or None without similar past jobs or if no node count up to maxnodes is enough.'''
+    for nn in range(1,maxnodes+1):
+      runtime=self.predict(feats,ppn,nn)
+      if runtime is None:
+        return None
+      if runtime*SAFETY<=submitter.walltime_seconds(walltime):
+        return nn
+    return None
+
+#######################################################################
+_active=None
+
+#----------------------------------------------------------------------
+def use(dbfile):
+  ''' Open the runtime history in dbfile and record runtimes into it from now on (None stops recording).'''
+  global _active
+  if dbfile is None:
+    _active=None
+  else:
+    _active=RuntimeHistory(dbfile)
+  return _active
+
+#----------------------------------------------------------------------
+def active():
+  ''' The open runtime history, or None.'''
+  return _active
+
+#----------------------------------------------------------------------
+def record(mgr,attr='runner'):
+  ''' Record the runtime of the last job of a manager's runner (attr names it) into the open history, if there is one.
+  Each timed job is recorded once.'''
+  runner=getattr(mgr,attr)
+  runtimefile=getattr(runner,'runtimefile',None)
+  if _active is None or runtimefile is None:
+    return
+  runtime=read_runtime(runtimefile)
+  if runtime is None:
+    return
+  _active.record(features(mgr,attr),runner.np,runner.nn,runtime,path=mgr.path)
+  runner.runtimefile=None
+
+#----------------------------------------------------------------------
+def walltime(runner):
+  ''' Walltime to request for a runner: its own, or, for walltime='auto', a prediction from the open history
+  (DEFAULT_WALLTIME if there is none).'''
+  if runner.walltime!='auto':
+    return runner.walltime
+  suggested=None
+  if _active is not None and len(getattr(runner,'features',{}))>0:
+    suggested=_active.suggest(runner.features,runner.np,runner.nn)
+  if suggested is None:
+    print(runner.__class__.__name__,": no runtime history, requesting %s."%DEFAULT_WALLTIME)
+    return DEFAULT_WALLTIME
+  print(runner.__class__.__name__,": requesting predicted walltime %s."%suggested)
+  return suggested
+
+#----------------------------------------------------------------------
+def estimate(mgr):
+  ''' Predicted runtime of a manager's next job in seconds, or None. Can be used as the estimator of a Bundler.'''
+  if _active is None or not hasattr(mgr,'writer'):
+    return None # Managers of several stages (QMCPipelineManager) aren't in the history.
+  stage='runner'
+  if getattr(mgr,'creader',None) is not None and mgr.creader.completed:
+    stage='prunner' # CRYSTAL is done, so the next job is properties.
+  runner=getattr(mgr,stage)
+  return _active.predict(features(mgr,stage),runner.np,runner.nn)
@@ -0,0 +1,230 @@
+''' In-memory, write-through cache of the state that managers pickle on disk.
+
+Managers reload their pickle at the start of every public method, and save it at the end.
+With this cache, a pickle is only read from disk when it was modified by something else
+(detected with the files' modification time and size), and the saves made inside a
+`deferred` block are coalesced into one write at the end of the block.
+Each write is also recorded in the ledger, if one is open (see ledger.py).
+
+On disk, the state is a base pickle (fname) and a journal (fname+'.journal').
+A save appends only the attributes that changed since the last write to the journal.
+Once the journal has MAX_JOURNAL records, or is larger than the base, the whole object is
+written to a new base, which atomically replaces the old one (temporary file, fsync, rename),
+and the journal is removed. Journal records are checksummed, so a record cut short by a
+crash is ignored instead of corrupting the state. Records also carry the checksum of the base
+they update, so the records of a journal left behind by a crash after a new base was written
+are ignored instead of being replayed onto it.
+'''
+import os
+import struct
+import zlib
+import hashlib
+import pickle as pkl
+import threading
+from contextlib import contextmanager
+import ledger
+
+MAX_JOURNAL=50 # Number of journal records before the base is rewritten.
+
+_lock=threading.RLock()
+_cache={}    # file name -> (signature of files when last read or written here, object).
+_deferred={} # file name -> [nesting depth, object to write at the end or None].
+_written={}  # file name -> {attribute: digest} of the state on disk, or None to rewrite the base.
+_nrecords={} # file name -> number of records in the journal.
+_basecrc={}  # file name -> checksum of the base, which journal records refer to.
+_blocks={}   # file name -> lock of the deferred blocks of the file.
+
+#----------------------------------------------------------------------
+def journal_name(fname):
+  return fname+'.journal'
+
+#----------------------------------------------------------------------
+def _signature(fname):
+  st=os.stat(fname)
+  sig=(st.st_mtime_ns,st.st_size)
+  try:
+    st=os.stat(journal_name(fname))
+  except OSError:
+    return sig
+  return sig+(st.st_mtime_ns,st.st_size)
+
+#----------------------------------------------------------------------
+def _digests(obj):
+  ''' Digest of each attribute of obj, to find which attributes changed since the last write.'''
+  return {key:hashlib.sha1(pkl.dumps(value)).digest() for key,value in obj.__dict__.items()}
+
+#----------------------------------------------------------------------
+def _fsync_dir(fname):
+  ''' Make a rename or removal in the directory of fname durable.'''
+  try:
+    fd=os.open(os.path.dirname(os.path.abspath(fname)),os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+#----------------------------------------------------------------------
+def _write_base(obj,fname):
+  ''' Atomically replace the base with the whole object, and remove the journal.'''
+  tmpfn=fname+'.tmp'
+  data=pkl.dumps(obj)
+  with open(tmpfn,'wb') as outf:
+    outf.write(data)
+    outf.flush()
+    os.fsync(outf.fileno())
+  os.replace(tmpfn,fname)
+  if os.path.exists(journal_name(fname)):
+    os.remove(journal_name(fname))
+  _fsync_dir(fname)
+  _nrecords[fname]=0
+  _basecrc[fname]=zlib.crc32(data)
+
+#----------------------------------------------------------------------
+def _append_journal(fields,fname):
+  ''' Append one record (length, checksum, pickled base checksum and dict of attributes) to the journal.'''
+  payload=pkl.dumps((_basecrc[fname],fields))
+  with open(journal_name(fname),'ab') as outf:
+    outf.write(struct.pack('<II',len(payload),zlib.crc32(payload))+payload)
+    outf.flush()
+    os.fsync(outf.fileno())
+  _nrecords[fname]=_nrecords.get(fname,0)+1
+
+#----------------------------------------------------------------------
+def _read_journal(fname):
+  ''' Intact records of the journal of fname.
+  Returns:
+    tuple: (list of records: base checksum and dict of attributes, whether the journal ended cleanly).
+  '''
+  try:
+    with open(journal_name(fname),'rb') as inpf:
+      data=inpf.read()
+  except OSError:
+    return [],True
+  records=[]
+  cursor=0
+  while cursor<len(data):
+    if cursor+8>len(data):
+      return records,False
+    size,crc=struct.unpack('<II',data[cursor:cursor+8])
+    payload=data[cursor+8:cursor+8+size]
+    if len(payload)<size or zlib.crc32(payload)!=crc:
+      return records,False
+    records.append(pkl.loads(payload))
+    cursor+=8+size
+  return records,True
+
+#----------------------------------------------------------------------
+def _needs_base(digests,fname):
+  ''' Whether the next write should rewrite the base instead of appending to the journal.'''
+  old=_written.get(fname)
+  if old is None or fname not in _basecrc or not os.path.exists(fname):
+    return True
+  if len(set(old)-set(digests))>0:
+    return True # Removed attributes can't be expressed as an update.
+  if _nrecords.get(fname,0)>=MAX_JOURNAL:
+    return True
+  if os.path.exists(journal_name(fname)):
+    return os.path.getsize(journal_name(fname))>os.path.getsize(fname)
+  return False
+
+#----------------------------------------------------------------------
+def _write(obj,fname):
+  ''' Write the attributes of obj that changed, or the whole object when needed.'''
+  digests=_digests(obj)
+  if _needs_base(digests,fname):
+    _write_base(obj,fname)
+  else:
+    old=_written[fname]
+    changed={key:obj.__dict__[key] for key in digests if old.get(key)!=digests[key]}
+    if len(changed)==0:
+      _cache[fname]=(_signature(fname),obj)
+      return
+    _append_journal(changed,fname)
+  _written[fname]=digests
+  _cache[fname]=(_signature(fname),obj)
+  ledger.record(obj)
+
+#----------------------------------------------------------------------
+def load(fname):
+  ''' Object stored in fname (base and journal). Returns the object in memory if the files haven't changed since they were last read or written here.'''
+  with _lock:
+    sig=_signature(fname)
+    if fname in _cache and _cache[fname][0]==sig:
+      return _cache[fname][1]
+    with open(fname,'rb') as inpf:
+      data=inpf.read()
+    obj=pkl.loads(data)
+    basecrc=zlib.crc32(data)
+    records,clean=_read_journal(fname)
+    stale=0
+    for record in records:
+      if isinstance(record,dict):
+        fields=record # Written before records carried the base checksum.
+      elif record[0]==basecrc:
+        fields=record[1]
+      else:
+        stale+=1
+        continue
+      obj.__dict__.update(fields)
+    _nrecords[fname]=len(records)
+    _basecrc[fname]=basecrc
+    if stale>0:
+      # The base was replaced but the crash came before its old journal was removed.
+      print("statecache : ignoring %d records of an older base in %s."%(stale,journal_name(fname)))
+      _written[fname]=None
+    elif clean:
+      _written[fname]=_digests(obj)
+    else:
+      # A write was interrupted: the next save rewrites the base from the recovered state.
+      print("statecache : ignoring incomplete journal record in %s."%journal_name(fname))
+      _written[fname]=None
+    _cache[fname]=(sig,obj)
+    return obj
+
+#----------------------------------------------------------------------
+def save(obj,fname):
+  ''' Save obj into fname, or postpone the write to the end of the enclosing deferred block.'''
+  with _lock:
+    if fname in _deferred and os.path.exists(fname):
+      _deferred[fname][1]=obj
+      # Later loads in the block should see obj, not the older object on disk.
+      _cache[fname]=(_signature(fname),obj)
+      return
+    _write(obj,fname)
+
+#----------------------------------------------------------------------
+@contextmanager
+def deferred(fname):
+  ''' Coalesce all saves of fname made inside this block (including nested blocks) into one write.
+  Only one thread at a time is inside the blocks of a file, so a manager (whose methods run in these blocks)
+  isn't stepped by two threads at once, for example by its own worker and by the export of a downstream manager.'''
+  with _lock:
+    block=_blocks.setdefault(fname,threading.RLock())
+  with block:
+    with _lock:
+      entry=_deferred.setdefault(fname,[0,None])
+      entry[0]+=1
+    try:
+      yield
+    finally:
+      with _lock:
+        entry[0]-=1
+        if entry[0]==0:
+          del _deferred[fname]
+          if entry[1] is not None:
+            _write(entry[1],fname)
+
+#----------------------------------------------------------------------
+def forget(fname=None):
+  ''' Drop fname (or everything) from the cache, so the next load reads the disk.'''
+  with _lock:
+    if fname is None:
+      _cache.clear()
+      _written.clear()
+    else:
+      _cache.pop(fname,None)
+      _written.pop(fname,None)
@@ -1,9 +1,16 @@
 import subprocess as sub
+import asyncio
 import importlib
 import os
+import shlex
 import shutil
 import sys
 import time
+import sqlite3
+import tempfile
+import threading
+import queuestats
+from concurrent.futures import ThreadPoolExecutor
 
 #####################################################################################
 class LocalSubmitter:
@@ -39,38 +46,447 @@ class LocalSubmitter:
     return []
 
 #-------------------------------------------------------
+# Queue commands (qsub, qstat, qdel) as coroutines, so many can be awaited at once.
+# They run the commands directly, without a shell, and raise subprocess.CalledProcessError on failure
+# like subprocess.check_output. The functions without the async_ prefix are blocking wrappers.
+QUEUE_TIMEOUT=300 # Seconds before a queue command is considered hung and killed.
+QUEUE_CONCURRENCY=16 # Maximum queue commands in flight in the *_many coroutines.
 
+#-------------------------------------------------------
+async def async_run(args,cwd=None,timeout=None):
+  """Run a command (list of str) and return its output (stdout and stderr) as a string."""
+  if timeout is None: timeout=QUEUE_TIMEOUT
+  try:
+    proc=await asyncio.create_subprocess_exec(*args,cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.STDOUT)
+  except OSError as err:
+    raise sub.CalledProcessError(127,args,output=str(err).encode())
+  try:
+    output,_=await asyncio.wait_for(proc.communicate(),timeout)
+  except asyncio.TimeoutError:
+    proc.kill()
+    await proc.wait()
+    raise sub.CalledProcessError(-9,args,output=b'timed out')
+  if proc.returncode!=0:
+    raise sub.CalledProcessError(proc.returncode,args,output=output)
+  return output.decode()
+
+#-------------------------------------------------------
+def run_sync(coro):
+  """Run a coroutine to completion from blocking code, even if an event loop is running in this thread."""
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coro)
+  with ThreadPoolExecutor(max_workers=1) as pool:
+    return pool.submit(asyncio.run,coro).result()
+
+#-------------------------------------------------------
+def parse_qsub(output):
+  """Queue id from the output of qsub (without the server name, nor the [] of array jobs)."""
+  return output.split()[0].split('.')[0].replace('[]','')
+
+#-------------------------------------------------------
+async def async_qsub(qsubfile,path=None):
+  """Submit qsubfile (in directory path) and return its queue id."""
+  output=await async_run(['qsub',qsubfile],cwd=path)
+  invalidate_queue_snapshot()
+  queueid=parse_qsub(output)
+  queuestats.submitted(queueid,os.path.join(path if path is not None else os.getcwd(),qsubfile))
+  return queueid
+
+#-------------------------------------------------------
+async def async_qsub_many(qsubs):
+  """Submit many (qsubfile, path) pairs concurrently, at most QUEUE_CONCURRENCY at a time.
+  Returns a list with the queue id of each submission, or the exception it raised."""
+  limit=asyncio.Semaphore(QUEUE_CONCURRENCY)
+  async def one(qsubfile,path):
+    async with limit:
+      return await async_qsub(qsubfile,path)
+  return await asyncio.gather(*[one(qsubfile,path) for qsubfile,path in qsubs],return_exceptions=True)
+
+#-------------------------------------------------------
+async def async_qstat(args=('-t',)):
+  """Output of qstat with args."""
+  return await async_run(['qstat']+list(args))
+
+#-------------------------------------------------------
+async def async_qdel(queueid):
+  """Delete jobs (list of queue ids) from the queue."""
+  if len(queueid)==0:
+    return ''
+  output=await async_run(['qdel']+list(queueid))
+  invalidate_queue_snapshot()
+  return output
+
+#-------------------------------------------------------
+def qsub(qsubfile,path=None):
+  """Blocking async_qsub."""
+  return run_sync(async_qsub(qsubfile,path))
+
+#-------------------------------------------------------
+def qstat(args=('-t',)):
+  """Blocking async_qstat."""
+  return run_sync(async_qstat(args))
+
+#-------------------------------------------------------
+def qdel(queueid):
+  """Blocking async_qdel."""
+  return run_sync(async_qdel(queueid))
+
+#-------------------------------------------------------
 def check_PBS_status(queueid):
   """Utility function to determine the status of a PBS job."""
   try:
-    qstat = sub.check_output(
-        "qstat %s"%queueid, stderr=sub.STDOUT, shell=True
-      ).decode().split('\n')[-2].split()[4]
-  except sub.CalledProcessError:
+    state = qstat([queueid]).split('\n')[-2].split()[4]
+  except (sub.CalledProcessError,IndexError):
     return "unknown"
-  if qstat == "R" or qstat == "Q":
+  if state == "R" or state == "Q":
     return "running"
-  if qstat == "C" or qstat == "E":
+  if state == "C" or state == "E":
     return "finished"
   return 'unknown'
 
 #-------------------------------------------------------
-def check_PBS_stati(queueid):
-  """Utility function to determine the status of a set PBS job.
-  Can be done with one qstat call which can improve speed."""
+# Process-wide cache of the queue state, so that many runners share one qstat call.
+QSTAT_TTL=30 # Seconds a queue snapshot is reused for.
+ACTIVE_STATES=('Q','R','H','W','T','B','S') # Job states that mean queued or running.
+_qstat_lock=threading.Lock()
+_qstat_cache={'time':None,'jobs':None}
+_qstat_inflight={} # event loop -> task fetching the queue for async_queue_snapshot.
+
+#-------------------------------------------------------
+def parse_qstat(output):
+  """Parse the output of qstat into a dict keyed by job id (without the server name).
+  Each entry is a dict with 'state', 'queue', 'name', and 'user' of the job."""
+  jobs={}
+  for line in output.split('\n'):
+    spl=line.split()
+    if len(spl) < 6 or not spl[0][0].isdigit():
+      continue
+    jobs[spl[0].split('.')[0]]={'state':spl[4],'queue':spl[5],'name':spl[1],'user':spl[2]}
+  return jobs
+
+#-------------------------------------------------------
+def queue_snapshot(ttl=None):
+  """Current jobs in the queue, as parsed by parse_qstat. Elements of job arrays are listed separately (qstat -t).
+  qstat is called at most once every ttl seconds (default QSTAT_TTL); callers in between share the result.
+  Returns None if qstat failed."""
+  if ttl is None: ttl=QSTAT_TTL
+  with _qstat_lock:
+    if _qstat_cache['time'] is not None and time.time()-_qstat_cache['time'] < ttl:
+      return _qstat_cache['jobs']
+    try:
+      jobs=parse_qstat(qstat())
+    except sub.CalledProcessError:
+      jobs=None
+    _qstat_cache['time']=time.time()
+    _qstat_cache['jobs']=jobs
+  queuestats.observe(jobs)
+  return jobs
+
+#-------------------------------------------------------
+async def async_queue_snapshot(ttl=None):
+  """Coroutine version of queue_snapshot. Concurrent callers in one event loop share one qstat call."""
+  if ttl is None: ttl=QSTAT_TTL
+  with _qstat_lock:
+    if _qstat_cache['time'] is not None and time.time()-_qstat_cache['time'] < ttl:
+      return _qstat_cache['jobs']
+  loop=asyncio.get_running_loop()
+  task=_qstat_inflight.get(loop)
+  if task is None:
+    task=loop.create_task(async_qstat())
+    _qstat_inflight[loop]=task
   try:
-    qstat = sub.check_output(
-        "qstat ", stderr=sub.STDOUT, shell=True
-      ).decode()
+    jobs=parse_qstat(await asyncio.shield(task))
   except sub.CalledProcessError:
-    return "unknown"
-  qstat=qstat.split('\n')
+    jobs=None
+  finally:
+    if _qstat_inflight.get(loop) is task:
+      del _qstat_inflight[loop]
+  with _qstat_lock:
+    _qstat_cache['time']=time.time()
+    _qstat_cache['jobs']=jobs
+  queuestats.observe(jobs)
+  return jobs
+
+#-------------------------------------------------------
+def invalidate_queue_snapshot():
+  """Force the next queue_snapshot to call qstat, for example after a submission."""
+  with _qstat_lock:
+    _qstat_cache['time']=None
+
+#-------------------------------------------------------
+def stati_from_snapshot(queueid,jobs):
+  """Status of a set of jobs given a queue snapshot: 'running' if any of them is queued or running."""
   for qid in queueid:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[4]
-        if stat == "R" or stat == "Q":
-          return "running"
+    if qid in jobs and jobs[qid]['state'] in ACTIVE_STATES:
+      return "running"
   return 'unknown'
 
+#-------------------------------------------------------
+def check_PBS_stati(queueid):
+  """Utility function to determine the status of a set PBS job.
+  Uses the shared queue snapshot, so many calls cost one qstat."""
+  jobs=queue_snapshot()
+  if jobs is None:
+    return "unknown"
+  return stati_from_snapshot(queueid,jobs)
+
+#-------------------------------------------------------
+def prune_queueid(queueid,jobs=None):
+  """Remove ids of jobs that have left the queue or completed.
+  Uses the shared queue snapshot unless jobs is given.
+  Returns queueid unchanged if the queue state is unknown."""
+  if jobs is None:
+    jobs=queue_snapshot()
+  if jobs is None:
+    return queueid
+  return [qid for qid in queueid if qid in jobs and jobs[qid]['state']!='C']
+
+#-------------------------------------------------------
+def walltime_seconds(walltime):
+  """Seconds in a walltime string like '48:00:00', '30:00', or '90'."""
+  return sum(int(x)*60**i for i,x in enumerate(reversed(str(walltime).split(':'))))
+
+#-------------------------------------------------------
+def format_walltime(seconds):
+  """Walltime string ('hh:mm:ss') for a number of seconds, rounded up to a minute."""
+  minutes=int(-(-seconds//60))
+  return "%d:%02d:00"%(minutes//60,minutes%60)
+
+#-------------------------------------------------------
+# Detached local jobs. A job is identified by its job file base name (directory and job name):
+# <job>.sh holds its commands, <job>.pid the process id of its wrapper, and <job>.exit its exit code.
+# Jobs run in their own session, so they survive the driver, and a new driver finds their state from these files.
+
+#-------------------------------------------------------
+def launch_detached(jobfile,commands,env=None):
+  """Run commands (list of str, run by bash in order, stopping at the first failure) in the background,
+  in the directory of jobfile, detached from this process. Returns the Popen object of the wrapper."""
+  for ext in ('.pid','.exit'):
+    if os.path.exists(jobfile+ext):
+      os.remove(jobfile+ext)
+  with open(jobfile+'.sh','w') as outf:
+    outf.write('\n'.join(['set -e']+commands)+'\n')
+  # Manager job names start with '-' (their path with '/' replaced), so names are quoted and never taken as options.
+  base=os.path.basename(jobfile)
+  wrapper="bash {0}; echo $? > {1}; mv -f -- {1} {2}".format(
+      shlex.quote('./'+base+'.sh'),shlex.quote(base+'.exit.tmp'),shlex.quote(base+'.exit'))
+  proc=sub.Popen(['/bin/bash','-c',wrapper],cwd=os.path.dirname(jobfile) or None,env=env,
+      stdout=sub.DEVNULL,start_new_session=True)
+  # Written before returning, so the job never looks unstarted while it runs.
+  with open(jobfile+'.pid.tmp','w') as outf:
+    outf.write('%d\n'%proc.pid)
+  os.replace(jobfile+'.pid.tmp',jobfile+'.pid')
+  return proc
+
+#-------------------------------------------------------
+def _pid_alive(pid,jobfile):
+  """Whether process pid is alive and is the wrapper of jobfile (pids are reused)."""
+  try:
+    with open('/proc/%d/cmdline'%pid,'rb') as inpf:
+      cmdline=inpf.read()
+    if len(cmdline)>0:
+      return (os.path.basename(jobfile)+'.sh').encode() in cmdline
+    # Empty while the process is starting, or a zombie.
+    with open('/proc/%d/stat'%pid,'r') as inpf:
+      return inpf.read().rsplit(')',1)[1].split()[0]!='Z'
+  except (OSError,IndexError):
+    if os.path.isdir('/proc'):
+      return False
+  try:
+    os.kill(pid,0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+#-------------------------------------------------------
+def _read_int(fname):
+  try:
+    with open(fname,'r') as inpf:
+      return int(inpf.read().split()[0])
+  except (OSError,ValueError,IndexError):
+    return None
+
+#-------------------------------------------------------
+def job_status(jobfile):
+  """State of a detached job from its files: 'running', 'finished' (exit code 0), 'failed' (nonzero exit code,
+  or the process died without writing one), or 'unknown' (never started)."""
+  for check in range(2):
+    code=_read_int(jobfile+'.exit')
+    if code is not None:
+      return 'finished' if code==0 else 'failed'
+    if check==1:
+      return 'failed'
+    pid=_read_int(jobfile+'.pid')
+    if pid is None:
+      return 'unknown'
+    if _pid_alive(pid,jobfile):
+      return 'running'
+    # The job may have finished since the exit file was checked.
+
+#-------------------------------------------------------
+# Pool for jobs run on this machine. The cores held by running jobs are recorded in an SQLite file,
+# so that all drivers on the machine share one budget.
+LOCAL_CORES=None # Cores the local pool may use (None means all cores of the machine). Set before the pool is first used.
+LOCAL_POOL_DB=None # Cores held by local jobs, shared by all processes (None means autogen_localpool.db in the temporary directory).
+CLAIM_GRACE=60 # Seconds a job may hold cores before its pid file is written.
+_local_pool=None
+_local_pool_lock=threading.Lock()
+
+LOCAL_POOL_SCHEMA=[
+    '''create table if not exists claims (
+         jobfile text primary key,
+         ncores integer,
+         claimed real
+       )''',
+  ]
+
+#-------------------------------------------------------
+class LocalPool:
+  """Runs detached jobs (see launch_detached) on this machine concurrently, within a budget of cores.
+  Each job holds the cores it asked for while it runs, in a database shared by all pools on the machine.
+  Jobs that don't fit in the free cores wait, and are started as soon as enough cores are released;
+  a waiting job that fits may start before an earlier one that doesn't, so that cores aren't left idle.
+  Waiting jobs only exist in this process; started jobs are tracked through their files (see job_status)."""
+  def __init__(self,ncores=None,dbfile=None):
+    if ncores is None: ncores=os.cpu_count() or 1
+    if dbfile is None: dbfile=LOCAL_POOL_DB
+    if dbfile is None: dbfile=os.path.join(tempfile.gettempdir(),'autogen_localpool.db')
+    self.ncores=ncores
+    self.dbfile=dbfile
+    self._waiting=[] # (job file, cores, commands, environment), in submission order.
+    self._lock=threading.Lock()
+    self._local=threading.local()
+    conn=self._connection()
+    for statement in LOCAL_POOL_SCHEMA:
+      conn.execute(statement)
+
+  #-------------------------------------------------------
+  def _connection(self):
+    """One connection per thread, since sqlite connections can't be shared between threads."""
+    conn=getattr(self._local,'conn',None)
+    if conn is None:
+      conn=sqlite3.connect(self.dbfile,timeout=60,isolation_level=None)
+      self._local.conn=conn
+    return conn
+
+  #-------------------------------------------------------
+  def _held(self,conn):
+    """Cores held by running jobs on the machine. Forgets the claims of jobs that have ended."""
+    now=time.time()
+    held=0
+    for jobfile,ncores,claimed in conn.execute('select jobfile,ncores,claimed from claims').fetchall():
+      status=job_status(jobfile)
+      if status in ('finished','failed') or (status=='unknown' and now-claimed>CLAIM_GRACE):
+        conn.execute('delete from claims where jobfile=?',(jobfile,))
+      else:
+        held+=ncores
+    return held
+
+  #-------------------------------------------------------
+  def free(self):
+    """Cores of the budget not held by any job on the machine."""
+    conn=self._connection()
+    conn.execute('begin immediate')
+    try:
+      held=self._held(conn)
+      conn.execute('commit')
+    except Exception:
+      conn.execute('rollback')
+      raise
+    return self.ncores-held
+
+  #-------------------------------------------------------
+  def submit(self,jobfile,commands,ncores,env=None):
+    """Queue commands (list of str) to run as the detached job jobfile, holding ncores cores. Returns immediately.
+    Returns the queue id of the job, which is jobfile."""
+    ncores=max(1,min(ncores,self.ncores))
+    with self._lock:
+      self._waiting.append((jobfile,ncores,commands,env))
+      self._dispatch()
+    return jobfile
+
+  #-------------------------------------------------------
+  def status(self,qid):
+    """'queued' (waiting for cores in this process), or the job_status of qid.
+    Jobs of other processes may have released cores, so waiting jobs are dispatched again first."""
+    with self._lock:
+      if qid in [job[0] for job in self._waiting]:
+        self._dispatch()
+        if qid in [job[0] for job in self._waiting]:
+          return 'queued'
+    return job_status(qid)
+
+  #-------------------------------------------------------
+  def _dispatch(self):
+    """Start the waiting jobs that fit in the free cores. Called with the lock held."""
+    if len(self._waiting)==0:
+      return
+    conn=self._connection()
+    conn.execute('begin immediate')
+    try:
+      free=self.ncores-self._held(conn)
+      waiting=[]
+      starting=[]
+      for job in self._waiting:
+        if job[1]<=free:
+          conn.execute('insert or replace into claims (jobfile,ncores,claimed) values (?,?,?)',
+              (job[0],job[1],time.time()))
+          free-=job[1]
+          starting.append(job)
+        else:
+          waiting.append(job)
+      conn.execute('commit')
+    except Exception:
+      conn.execute('rollback')
+      raise
+    self._waiting=waiting
+    for job in starting:
+      self._start(*job)
+
+  #-------------------------------------------------------
+  def adopt(self,jobfile,ncores):
+    """Charge the cores of a job started by an earlier driver, if it is still running and holds none."""
+    if job_status(jobfile)!='running':
+      return
+    self._connection().execute('insert or ignore into claims (jobfile,ncores,claimed) values (?,?,?)',
+        (jobfile,max(1,min(ncores,self.ncores)),time.time()))
+
+  #-------------------------------------------------------
+  def _release(self,jobfile):
+    self._connection().execute('delete from claims where jobfile=?',(jobfile,))
+
+  #-------------------------------------------------------
+  def _start(self,jobfile,ncores,commands,env):
+    try:
+      proc=launch_detached(jobfile,commands,env=env)
+    except OSError as err:
+      print(self.__class__.__name__,": Error starting %s: %s"%(jobfile,err))
+      self._release(jobfile)
+      return
+    watcher=threading.Thread(target=self._watch,args=(jobfile,proc))
+    watcher.daemon=True
+    watcher.start()
+
+  #-------------------------------------------------------
+  def _watch(self,jobfile,proc):
+    """Wait for a job in its own thread, then release its cores to the waiting jobs."""
+    proc.wait()
+    if job_status(jobfile)=='failed':
+      print(self.__class__.__name__,": %s failed."%jobfile)
+    with self._lock:
+      self._release(jobfile)
+      self._dispatch()
+
+#-------------------------------------------------------
+def local_pool():
+  """The pool shared by all local pool runners of this process (created with LOCAL_CORES and LOCAL_POOL_DB on first use)."""
+  global _local_pool
+  with _local_pool_lock:
+    if _local_pool is None:
+      _local_pool=LocalPool(LOCAL_CORES)
+    return _local_pool
@@ -15,6 +15,7 @@ from variance import VarianceWriter,VarianceReader
 from linear import LinearWriter,LinearReader
 from dmc import DMCWriter,DMCReader
 from trialfunc import SlaterJastrow
+from workflow import Workflow
 import sys
 
 h2='\n'.join([
@@ -236,7 +237,7 @@ def mno_test():
   return jobs
 
 def run_tests():
-  ''' Choose which tests to run and execute `nextstep()`.'''
+  ''' Choose which tests to run and advance them with a `Workflow`.'''
   jobs=[]
   jobs+=h2_test_local()
   jobs+=h2_test_PBS()
@@ -244,8 +245,7 @@ def run_tests():
   jobs+=si_pyscf_test()
   jobs+=mno_test()
 
-  for job in jobs:
-    job.nextstep()
+  Workflow(jobs).sweep()
 
 if __name__=='__main__':
   run_tests()
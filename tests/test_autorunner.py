@@ -0,0 +1,21 @@
+'''
+Checks of the status of PBS runners (autorunner.RunnerPBS).
+'''
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import autorunner
+import bundler
+
+def test_backfill_kept_when_qstat_fails(tmp_path):
+  ''' A backfill task is followed until it exits, even through failed qstat calls.'''
+  runner=autorunner.RunnerPBS()
+  qid=bundler.backfill_id('123.server',str(tmp_path/'task.run'))
+  runner.queueid=[qid]
+  assert runner.status_from_snapshot(None)=='running'
+  assert runner.queueid==[qid]
+  assert runner.status_from_snapshot(None)=='running'
+  assert runner.status_from_snapshot({'123.server':{'state':'R'}})=='running'
+  (tmp_path/'task.run.exit').write_text('0\n')
+  assert runner.status_from_snapshot({'123.server':{'state':'R'}})=='unknown'
+  assert runner.queueid==[]
@@ -0,0 +1,39 @@
+'''
+Checks of the submission coordinator (coordinator.SubmissionCoordinator).
+'''
+import os
+import sys
+import subprocess as sub
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import coordinator
+import submitter
+
+def test_failed_submission_does_not_block(tmp_path,monkeypatch):
+  ''' A job that can't be submitted doesn't hold up the rest of its queue, and is dropped after MAX_FAILURES tries.'''
+  submitted=[]
+  def qsub(qsubfile,path):
+    if qsubfile=='bad.qsub':
+      raise sub.CalledProcessError(1,'qsub')
+    submitted.append(qsubfile)
+    return '%d.server'%len(submitted)
+  monkeypatch.setattr(submitter,'qsub',qsub)
+  monkeypatch.setattr(submitter,'queue_snapshot',lambda ttl=None:{})
+  for name in ('bad','good1','good2'):
+    (tmp_path/(name+'.qsub')).write_text('#PBS -q normal\necho %s\n'%name)
+  coord=coordinator.SubmissionCoordinator(limits={'normal':0},statefile=str(tmp_path/'state.json'),drain_interval=3600)
+  bad=coord.submit('bad.qsub',str(tmp_path),'normal',1,1,'1:00:00')
+  good=coord.submit('good1.qsub',str(tmp_path),'normal',1,1,'1:00:00')
+  coord.limits['normal']=None
+
+  coord.drain(force=True)
+  assert coord.resolve(bad)==bad
+  coord.drain(force=True)
+  assert submitted==['good1.qsub']
+  assert coord.resolve(good)=='1.server'
+
+  later=coord.submit('good2.qsub',str(tmp_path),'normal',1,1,'1:00:00')
+  assert coord.resolve(later)=='2.server'
+  for i in range(coordinator.MAX_FAILURES):
+    coord.drain(force=True)
+  assert coord.resolve(bad) is None
+  assert coord.backlog()==[]
@@ -0,0 +1,53 @@
+'''
+Checks of the scheduling of the workflow daemon (daemon.WorkflowDaemon).
+'''
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import daemon
+
+class Runner:
+  def __init__(self):
+    self.queueid=[]
+    self.walltime='1:00:00'
+  def check_status(self):
+    return 'unknown'
+
+class Reader:
+  completed=False
+
+class Manager:
+  ''' Stand-in for a manager: submits a job on its first step, and is never finished.'''
+  def __init__(self,name,path,trialfunc=None,chain=False):
+    self.name=name
+    self.path=path
+    self.trialfunc=trialfunc
+    self.chain=chain
+    self.completed=False
+    self.runner=Runner()
+    self.reader=Reader()
+    self.outfile=name+'.o'
+    self.steps=0
+  def nextstep(self):
+    self.steps+=1
+    if len(self.runner.queueid)==0:
+      self.runner.queueid=['%s.server'%self.name]
+  def export_qwalk(self):
+    self.nextstep()
+    return False
+  def chain_ids(self):
+    return list(self.runner.queueid)
+
+class TrialFunction:
+  def __init__(self,mgr):
+    self.slatman=mgr
+    self.jastman=mgr
+
+def test_chain_manager_scheduled_when_upstream_queues(tmp_path):
+  ''' A chain manager is stepped once its upstream manager has a job in the queue, before it finishes.'''
+  up=Manager('up',str(tmp_path)+'/')
+  down=Manager('down',str(tmp_path)+'/',trialfunc=TrialFunction(up),chain=True)
+  driver=daemon.WorkflowDaemon([down],min_interval=3600,watch_interval=3600)
+  assert driver.tick()==[up.path+up.name]
+  assert driver.tick()==[down.path+down.name]
+  assert down.steps==1
@@ -0,0 +1,32 @@
+'''
+Checks of the local pool of detached jobs (submitter.LocalPool).
+'''
+import os
+import sys
+import time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import submitter
+
+def wait(pool,qid,timeout=10):
+  start=time.time()
+  while pool.status(qid) in ('queued','running') and time.time()-start<timeout:
+    time.sleep(0.1)
+  return pool.status(qid)
+
+def test_manager_job_name(tmp_path):
+  ''' Managers name jobs after their path, so the job file name starts with '-'.'''
+  pool=submitter.LocalPool(2,dbfile=str(tmp_path/'pool.db'))
+  jobfile=str(tmp_path/(str(tmp_path).replace('/','-')+'job'))
+  pool.submit(jobfile,['echo hi > out.txt'],1)
+  assert wait(pool,jobfile)=='finished'
+  assert (tmp_path/'out.txt').read_text()=='hi\n'
+
+def test_adopt_running_job(tmp_path):
+  ''' A job started by an earlier driver holds its cores in a new pool.'''
+  jobfile=str(tmp_path/'old')
+  proc=submitter.launch_detached(jobfile,['sleep 2'])
+  pool=submitter.LocalPool(2,dbfile=str(tmp_path/'pool.db'))
+  pool.adopt(jobfile,2)
+  assert pool.free()==0
+  proc.wait()
+  assert pool.free()==2
@@ -0,0 +1,63 @@
+'''
+Checks of the bulk status resolution (manager_tools.resolve_status_many).
+'''
+import os
+import sys
+import copy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import autorunner
+import submitter
+from manager_tools import resolve_status, resolve_status_many, status_inputs
+
+class Reader:
+  def __init__(self,completed=False):
+    self.completed=completed
+
+class Manager:
+  def __init__(self,name,path,queueid=(),completed=False):
+    self.name=name
+    self.path=path
+    self.runner=autorunner.RunnerPBS()
+    self.runner.queueid=list(queueid)
+    self.reader=Reader(completed)
+    self.outfile=name+'.o'
+
+class StagedManager(Manager):
+  ''' Manager of several stages, like QMCPipelineManager.'''
+  def __init__(self,name,path,queueid=()):
+    Manager.__init__(self,name,path,queueid)
+    del self.reader,self.outfile
+    self.readers={'first':Reader(True),'second':Reader()}
+  def outfile(self,stage):
+    return '%s_%s.o'%(self.name,stage)
+  def status_inputs(self):
+    return self.runner,self.readers['second'],self.outfile('second')
+
+def test_same_as_resolve_status(tmp_path,monkeypatch):
+  ''' One queue snapshot for all managers, and the same status as resolve_status for each.'''
+  calls=[]
+  def queue_snapshot(ttl=None):
+    calls.append(ttl)
+    return {'1.server':{'state':'R'},'2.server':{'state':'C'}}
+  monkeypatch.setattr(submitter,'queue_snapshot',queue_snapshot)
+  paths=[str(tmp_path/'a')+'/',str(tmp_path/'b')+'/']
+  for path in paths:
+    os.mkdir(path)
+  open(paths[0]+'finished.o','w').close()
+  open(paths[1]+'staged_second.o','w').close()
+  managers=[
+      Manager('queued',paths[0],['1.server']),
+      Manager('finished',paths[0],['2.server']),
+      Manager('new',paths[0]),
+      Manager('done',paths[1],completed=True),
+      StagedManager('staged',paths[1]),
+      StagedManager('staged_queued',paths[1],['1.server']),
+    ]
+  expected={}
+  for mgr in copy.deepcopy(managers):
+    runner,reader,outfile=status_inputs(mgr)
+    expected[mgr.path+mgr.name]=resolve_status(runner,reader,mgr.path+outfile)
+  del calls[:]
+  assert resolve_status_many(managers)==expected
+  assert len(calls)==1
+  assert set(expected.values())==set(['running','ready_for_analysis','not_started','done'])
@@ -2,6 +2,25 @@
 # The only requirement is to define the export() method, which defines how to generate the QWalk input. 
 import os
 
+#######################################################################
+def slater_jastrow_section(sysfile,slaterfile,jastfile):
+  ''' System and Slater-Jastrow wave function section for QWalk, including the given files.
+  Args:
+    sysfile (str): system file, relative to where QWalk runs. Same for the others.
+    slaterfile (str): Slater determinant file.
+    jastfile (str): Jastrow factor file.
+  Returns:
+    str: section for a QWalk input.
+  '''
+  outlines=[
+      'include %s'%sysfile,
+      'trialfunc { slater-jastrow ',
+      '  wf1 { include %s }'%slaterfile,
+      '  wf2 { include %s }'%jastfile,
+      '}'
+    ]
+  return '\n'.join(outlines)
+
 #######################################################################
 class TrialFunction:
   ''' Skeleton class to define API for Trial Functions.'''
@@ -38,19 +57,35 @@ class SlaterJastrow(TrialFunction):
     Returns:
       str: system and wave fumction section for QWalk. Empty string if not ready.
     '''
+    return self.export_chained(qmcpath,chain=False)[0]
+
+  #------------------------------------------------
+  def export_chained(self,qmcpath,chain=True):
+    ''' Export the wavefunction section, possibly before the managers have finished.
+    Managers with chain set, whose jobs are in the queue, contribute the files their jobs will write
+    (see QWalkManager.chain_ids), and the ids of these jobs are returned, to run after them.
+    Args: 
+      qmcpath (str): QWalkManager.path
+      chain (bool): whether queued chain managers can contribute.
+    Returns:
+      tuple: system and wave function section ('' if not ready), and the queue ids it depends on.
+    '''
     # This assumes you're using 2-body, should be easy to make a new object or maybe an arg for 3body.
+    depend=[]
 
     # Ensure files are correctly generated.
-    if not (self.slatman.export_qwalk() and self.jastman.export_qwalk()):
-      return ''
+    slatfiles=self._qwfiles(self.slatman,chain,depend)
+    jastfiles=self._qwfiles(self.jastman,chain,depend)
+    if slatfiles is None or jastfiles is None:
+      return '',[]
 
-    if type(self.slatman.qwfiles['slater'])==str:
-      slater=self.slatman.qwfiles['slater']
-      sys=self.slatman.qwfiles['sys']
+    if type(slatfiles['slater'])==str:
+      slater=slatfiles['slater']
+      sys=slatfiles['sys']
     else:
-      slater=self.slatman.qwfiles['slater'][self.kpoint]
-      sys=self.slatman.qwfiles['sys'][self.kpoint]
-    jastrow=self.jastman.qwfiles['jastrow2']
+      slater=slatfiles['slater'][self.kpoint]
+      sys=slatfiles['sys'][self.kpoint]
+    jastrow=jastfiles['jastrow2']
 
     # There may be a use case for these two to be different, but I want to check the first time this happens. 
     # You can have weird bugs if you use different system files for each wave function term, I think.
@@ -60,12 +95,21 @@ class SlaterJastrow(TrialFunction):
     #    (self.slatman.path+self.slatman.name),\
     #    'System file probably should be the same between Jastrow and Slater files. '
 
-    outlines=[
-        'include %s'%os.path.relpath(self.slatman.path+sys,qmcpath),
-        'trialfunc { slater-jastrow ',
-        '  wf1 { include %s }'%os.path.relpath(self.slatman.path+slater,qmcpath),
-        '  wf2 { include %s }'%os.path.relpath(self.slatman.path+jastrow,qmcpath),
-        '}'
-      ]
-    return '\n'.join(outlines)
+    section=slater_jastrow_section(
+        os.path.relpath(self.slatman.path+sys,qmcpath),
+        os.path.relpath(self.slatman.path+slater,qmcpath),
+        os.path.relpath(self.jastman.path+jastrow,qmcpath))
+    return section,depend
 
+  #------------------------------------------------
+  def _qwfiles(self,mgr,chain,depend):
+    ''' QWalk files of a manager: the exported ones, or, for a queued chain manager, the ones its jobs
+    will write (their ids are added to depend). None if not ready.'''
+    if chain and hasattr(mgr,'chain_ids'):
+      ids=mgr.chain_ids()
+      if len(ids)>0:
+        depend+=[qid for qid in ids if qid not in depend]
+        return mgr.chain_qwfiles()
+    if mgr.export_qwalk():
+      return mgr.qwfiles
+    return None
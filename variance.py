@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+from manager_tools import content_hash
 ####################################################
 class VarianceWriter:
   def __init__(self,options={}):
@@ -31,6 +32,11 @@ class VarianceWriter:
         raise AssertionError("Error:",k,"not a keyword for VarianceWriter.")
       selfdict[k]=d[k]
     
+  #-----------------------------------------------
+  def fingerprint(self):
+    ''' Hash of the options that go into the input file. The trial function is exported by the manager, so it is excluded.'''
+    return content_hash(self,skip_keys=['completed','trialfunc'])
+
   #-----------------------------------------------
   def qwalk_input(self,infile):
     if self.trialfunc=='':
@@ -0,0 +1,248 @@
+''' Drive many managers at once, respecting the dependencies between them.'''
+from __future__ import print_function
+import time
+from concurrent.futures import ThreadPoolExecutor
+import coordinator
+import runtimes
+import submitter
+from manager_tools import resolve_status_many
+
+MAX_PRIORITY=1023 # PBS priority hint of the nodes on the longest critical path.
+
+#######################################################################
+def manager_key(mgr):
+  ''' Identifier of a manager. Managers with the same key share the same state on disk.'''
+  return mgr.path+mgr.name
+
+#----------------------------------------------------------------------
+def upstream_managers(mgr):
+  ''' Managers whose results mgr needs before it can run (through its trial function).'''
+  trialfunc=getattr(mgr,'trialfunc',None)
+  if trialfunc is None:
+    return []
+  ups=[]
+  for attr in ('slatman','jastman'):
+    up=getattr(trialfunc,attr,None)
+    if up is not None and manager_key(up) not in [manager_key(u) for u in ups]:
+      ups.append(up)
+  return ups
+
+#----------------------------------------------------------------------
+def estimate(mgr):
+  ''' Estimated runtime in seconds of a manager's next job: predicted from the runtime history (see runtimes.estimate),
+  or else the walltime its runner requests.'''
+  runtime=runtimes.estimate(mgr)
+  if runtime is None:
+    walltime=getattr(mgr.runner,'walltime','auto')
+    if walltime=='auto':
+      walltime=runtimes.DEFAULT_WALLTIME
+    runtime=submitter.walltime_seconds(walltime)
+  return runtime
+
+#----------------------------------------------------------------------
+def _signature(mgr,finished):
+  ''' Cheap summary of a manager's state, used to detect changes between steps.'''
+  return (finished,mgr.completed,tuple(getattr(mgr.runner,'queueid',None) or []))
+
+#----------------------------------------------------------------------
+def _step(mgr,export):
+  ''' Advance one manager. Runs in a worker thread.
+  Returns:
+    tuple: (finished (bool), the advanced manager).
+  '''
+  if export:
+    finished=mgr.export_qwalk()
+  else:
+    mgr.nextstep()
+    finished=mgr.completed
+  return finished,mgr
+
+#######################################################################
+class Workflow:
+  ''' Dependency graph of managers, advanced concurrently in a bounded worker pool.
+
+  Managers are connected through the managers of their trial functions
+  (`SlaterJastrow.slatman` and `jastman`), and identified by `path+name`, so different
+  instances of the same manager are the same node.
+  A manager is only stepped once all its upstream managers are finished, and a
+  waiting manager is only reconsidered when one of its upstream managers changes state.
+  Chain managers may be stepped in the same sweep as their upstream managers, whose results they export:
+  managers lock their state while they step (see statecache.deferred), so each is stepped by one thread at a time.
+
+  Ready managers are stepped, and so submit, in order of their critical path: the estimated time
+  left through them to the end of the longest chain of managers that depend on them (see `critical_path`).
+  A Bundler given `priority` packs and submits its bundles in the same order.
+  '''
+  def __init__(self,managers=(),nworkers=4,priority_hints=False):
+    '''
+    Args:
+      managers (list): managers to run. Upstream managers are added automatically.
+      nworkers (int): maximum number of managers advanced at the same time.
+      priority_hints (bool): also pass the order to PBS, as job priorities from 0 to MAX_PRIORITY
+        (#PBS -p, for sites that let users set them).
+    '''
+    self.nworkers=nworkers
+    self.priority_hints=priority_hints
+    self.critical={}
+    self.nodes={}
+    self.upstream={}
+    self.downstream={}
+    self.state={}
+    self.finished=set()
+    self._waiting={}
+    for mgr in managers:
+      self.add(mgr)
+
+  #------------------------------------------------
+  def add(self,mgr):
+    ''' Add a manager and (recursively) the managers it depends on.
+    Returns:
+      str: key of the node.'''
+    key=manager_key(mgr)
+    if key in self.nodes:
+      return key
+    self.nodes[key]=mgr
+    self.downstream.setdefault(key,set())
+    self.upstream[key]=set()
+    self._waiting[key]=set()
+    for up in upstream_managers(mgr):
+      upkey=self.add(up)
+      self.upstream[key].add(upkey)
+      self.downstream[upkey].add(key)
+      if upkey not in self.finished:
+        self._waiting[key].add(upkey)
+    return key
+
+  #------------------------------------------------
+  def is_ready(self,key):
+    ''' Whether node key is not finished and has all upstream nodes finished.
+    Chain managers (see QWalkManager) are also ready when the upstream nodes they wait on have jobs in the queue
+    that they can be submitted behind.'''
+    if key in self.finished:
+      return False
+    if len(self._waiting[key])==0:
+      return True
+    if not getattr(self.nodes[key],'chain',False):
+      return False
+    return all(len(getattr(self.nodes[up],'chain_ids',list)())>0 for up in self._waiting[key])
+
+  #------------------------------------------------
+  def ready(self):
+    ''' Keys of the nodes that are ready to be stepped, longest critical path first.'''
+    keys=[key for key in self.nodes if self.is_ready(key)]
+    return sorted(keys,key=lambda key:-self.critical.get(key,0.0))
+
+  #------------------------------------------------
+  def idle(self,keys):
+    ''' Keys among keys whose managers have no job queued or running, and so something to do when stepped.
+    Found with one queue snapshot and one listing per directory for all of them (see resolve_status_many).'''
+    if len(keys)==0:
+      return []
+    table=resolve_status_many([self.nodes[key] for key in keys])
+    return [key for key in keys if table[key]!='running']
+
+  #------------------------------------------------
+  def critical_path(self):
+    ''' Estimated seconds left through each node: its own estimated runtime (0 if finished) plus the
+    longest critical path of the nodes downstream of it. Stored in self.critical.
+    Returns:
+      dict: critical path of each node.
+    '''
+    lengths={}
+    def length(key):
+      if key not in lengths:
+        own=0.0 if key in self.finished else estimate(self.nodes[key])
+        lengths[key]=own+max([length(down) for down in self.downstream[key]]+[0.0])
+      return lengths[key]
+    for key in self.nodes:
+      length(key)
+    self.critical=lengths
+    return lengths
+
+  #------------------------------------------------
+  def priority(self,mgr):
+    ''' Critical path of a manager, from the last sweep. Can be used as the priority of a Bundler.'''
+    return self.critical.get(manager_key(mgr),0.0)
+
+  #------------------------------------------------
+  def _hint(self,keys):
+    ''' Set the PBS priority of the runners of nodes keys, in proportion to their critical paths.'''
+    longest=max(list(self.critical.values())+[0.0])
+    for key in keys:
+      hint=0
+      if longest>0:
+        hint=int(round(MAX_PRIORITY*self.critical.get(key,0.0)/longest))
+      for attr in ('runner','prunner'):
+        runner=getattr(self.nodes[key],attr,None)
+        if runner is not None and hasattr(runner,'priority'):
+          runner.priority=hint
+
+  #------------------------------------------------
+  def _finish(self,key):
+    ''' Mark node as finished and release the nodes waiting on it.'''
+    self.finished.add(key)
+    for down in self.downstream[key]:
+      self._waiting[down].discard(key)
+
+  #------------------------------------------------
+  def advance(self,keys):
+    ''' Step the managers for keys concurrently.
+    Nodes that feed other nodes export their results (export_qwalk), others just perform nextstep.
+    Returns:
+      list: keys whose state changed.
+    '''
+    changed=[]
+    if len(keys)==0:
+      return changed
+    with ThreadPoolExecutor(max_workers=self.nworkers) as pool:
+      futures={}
+      for key in keys:
+        export=len(self.downstream[key])>0
+        futures[key]=pool.submit(_step,self.nodes[key],export)
+      for key in keys:
+        try:
+          finished,mgr=futures[key].result()
+        except Exception as err:
+          print(self.__class__.__name__,": Error advancing %s: %s"%(key,err))
+          continue
+        self.nodes[key]=mgr
+        sig=_signature(mgr,finished)
+        if sig!=self.state.get(key):
+          changed.append(key)
+        self.state[key]=sig
+        if finished:
+          self._finish(key)
+    return changed
+
+  #------------------------------------------------
+  def sweep(self):
+    ''' Advance every ready node once, except those whose jobs are still queued or running.
+    Returns:
+      list: keys whose state changed.'''
+    self.critical_path()
+    keys=self.idle(self.ready())
+    if self.priority_hints:
+      self._hint(keys)
+    return self.advance(keys)
+
+  #------------------------------------------------
+  def done(self):
+    return len(self.finished)==len(self.nodes)
+
+  #------------------------------------------------
+  def run(self,interval=60,maxsweeps=None):
+    ''' Sweep until all nodes are finished.
+    Args:
+      interval (float): seconds to wait between sweeps.
+      maxsweeps (int): stop after this many sweeps (None means no limit).
+    '''
+    nsweeps=0
+    while not self.done():
+      changed=self.sweep()
+      coordinator.drain()
+      nsweeps+=1
+      print(self.__class__.__name__,": sweep %d, %d changed, %d/%d finished."%\
+          (nsweeps,len(changed),len(self.finished),len(self.nodes)))
+      if self.done() or (maxsweeps is not None and nsweeps>=maxsweeps):
+        break
+      time.sleep(interval)